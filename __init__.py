@@ -26,22 +26,56 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from threading import Lock
+from copy import copy
+from datetime import datetime
+from os.path import isabs, join
+from typing import Callable, List, Optional
+
+from lingua_franca.format import nice_date_time, nice_time
+from ovos_bus_client.message import Message
 from ovos_utils.log import LOG
 from ovos_utils import classproperty
+from ovos_utils.dialog import join_list
 from ovos_utils.process_utils import RuntimeRequirements
 from neon_utils.skills.neon_skill import NeonSkill
 from neon_utils.signal_utils import check_for_signal
 from ovos_workshop.decorators import intent_handler
 from ovos_workshop.intents import IntentBuilder
 
+from .batch import split_recipients
+from .broker import CommonQueryBroker, QueryLimitExceeded, QueryType
+from .deferred import DeferredQueue, extract_delivery_time
+from .recorder import BusRecorder
+from .registry import get_contact_type
+from .session import QuerySession
+from .store import create_session_store
+from .timers import AsyncioTimers
+from .workers import WorkerPool
+
+QUERY_TYPES = (
+    QueryType("call", request_msg="communication:request.call",
+              dispatch_msg="communication:place.call", cacheable=True,
+              priority=0),
+    QueryType("message", request_msg="communication:request.message",
+              dispatch_msg="communication:send.message", priority=1),
+)
+
 
 class CommunicationSkill(NeonSkill):
     def __init__(self, **kwargs):
+        self.broker = CommonQueryBroker(emit=self._emit,
+                                        schedule=self._schedule_timeout,
+                                        cancel=self._cancel_timeout,
+                                        on_no_match=self._handle_no_match,
+                                        on_deferred=self._handle_deferred)
+        for query_type in QUERY_TYPES:
+            # Settings may change wait windows per skill instance
+            self.broker.register_query_type(copy(query_type))
+        self._timers = None
+        self._recorder = None
+        self._deferred = None
+        self._workers = WorkerPool()
         super(CommunicationSkill, self).__init__(**kwargs)
-        self.query_replies = {}
-        self.query_extensions = {}
-        self.lock = Lock()
 
     @classproperty
     def runtime_requirements(self):
@@ -55,11 +89,117 @@ class CommunicationSkill(NeonSkill):
                                    no_network_fallback=False,
                                    no_gui_fallback=True)
 
+    @property
+    def query_sessions(self) -> dict:
+        """
+        Active query sessions by `query_id`
+        """
+        return self.broker.sessions
+
     def initialize(self):
-        self.add_event("communication:request.call.response",
-                       self.handle_place_call_response)
-        self.add_event("communication:request.message.response",
-                       self.handle_send_message_response)
+        self.broker.configure(self.settings)
+        self.broker.priors.path = join(self.file_system.path,
+                                       "handler_priors.json")
+        backend = self.settings.get("session_store", "memory")
+        if backend != "memory":
+            # Share sessions with other instances of this skill
+            path = self.settings.get("session_store_path") or \
+                join(self.file_system.path, "sessions.db")
+            self.broker.use_store(create_session_store(backend, path))
+        self._deferred = DeferredQueue(self._deliver_deferred,
+                                       join(self.file_system.path,
+                                            "deferred.jsonl"))
+        self._deferred.start()
+        # Handle replies and timeouts off the bus and scheduler threads
+        self._workers.workers = self.settings.get("worker_threads", 4)
+        self._workers.max_queue = self.settings.get("worker_queue_size", 1000)
+        self._workers.start()
+        if self.settings.get("record_file"):
+            path = self.settings["record_file"]
+            self._recorder = BusRecorder(
+                path if isabs(path) else join(self.file_system.path, path),
+                self.settings.get("record_max_bytes", 10_000_000),
+                self.settings.get("record_backups", 3))
+        if self.settings.get("query_engine") == "asyncio":
+            # Time out sessions on a dedicated event loop instead of the
+            # skill event scheduler; expired timeouts are handled by workers
+            self._timers = AsyncioTimers(self._submit_timeout, max_workers=1)
+            self._timers.start()
+            self.broker.use_timers(self._timers.schedule,
+                                   self._timers.cancel)
+        for query_type in self.broker.query_types.values():
+            self.add_event(query_type.response_msg,
+                           self._recorded(self.broker.handle_response,
+                                          pooled=True))
+            self.add_event(query_type.result_msg,
+                           self._recorded(self.broker.handle_result,
+                                          pooled=True))
+        self.add_event("communication:register",
+                       self._recorded(self.handle_register))
+        self.add_event("communication:deregister",
+                       self._recorded(self.handle_deregister))
+        self.add_event("communication:metrics", self.handle_get_metrics)
+        self.add_event("communication:contacts.update",
+                       self._recorded(self.handle_contacts_update,
+                                      pooled=True))
+        self.schedule_repeating_event(self._sweep_sessions, None,
+                                      self.settings.get("sweep_interval", 30),
+                                      name="SweepSessions")
+        if self.broker.metrics.enabled and self.settings.get("metrics_file"):
+            self.schedule_repeating_event(self._write_metrics, None,
+                                          self.settings.get(
+                                              "metrics_interval", 60),
+                                          name="WriteMetrics")
+        # Ask any handlers that loaded before this skill to register
+        self.bus.emit(Message("communication:register.request"))
+
+    def handle_register(self, message):
+        """
+        Handle a handler skill registering (or refreshing) its capabilities.
+        @param message: `communication:register` Message
+        """
+        registration = self.broker.register_handler(message.data)
+        data = {"skill_id": message.data.get("skill_id"),
+                "registered": registration is not None}
+        if registration:
+            # Handlers should refresh well before their registration expires
+            data["heartbeat"] = registration.ttl / 3
+        self.bus.emit(message.response(data))
+
+    def handle_deregister(self, message):
+        """
+        Handle a handler skill removing its registration.
+        @param message: `communication:deregister` Message
+        """
+        skill_id = message.data.get("skill_id")
+        if skill_id:
+            self.broker.deregister_handler(skill_id)
+
+    def handle_contacts_update(self, message):
+        """
+        Handle a handler skill pushing a snapshot or changes of its contacts.
+        @param message: `communication:contacts.update` Message
+        """
+        self.broker.update_contacts(message.data)
+
+    def handle_get_metrics(self, message):
+        """
+        Handle a request for query metrics.
+        @param message: `communication:metrics` Message
+        """
+        self.bus.emit(message.response({**self.broker.metrics.snapshot(),
+                                        "usage": self.broker.get_usage(),
+                                        "breakers":
+                                            self.broker.circuits.snapshot(),
+                                        "workers":
+                                            self._workers.snapshot()}))
+
+    def _write_metrics(self, _=None):
+        try:
+            self.broker.metrics.write_prometheus(
+                self.settings["metrics_file"])
+        except OSError as e:
+            LOG.error(f"Failed to write metrics: {e}")
 
     @intent_handler("call.intent")
     def handle_place_call(self, message):
@@ -67,18 +207,9 @@ class CommunicationSkill(NeonSkill):
             # TODO: Move hesitation to user preference DM
             if check_for_signal('CORE_useHesitation', -1):
                 self.speak_dialog("one_moment")
-            utt = message.data.get("utterance")
             request = message.data.get("contact")
-            # TODO: This should use a UID, rather than the requested contact DM
-            self.query_replies[request] = []
-            self.query_extensions[request] = []
-            self.bus.emit(message.forward("communication:request.call",
-                                          data={"utterance": utt,
-                                                "request": request}))
-            # Give skills one second to reply to this request
-            self.schedule_event(self._place_call_timeout, 1,
-                                data={"request": request},
-                                name="PlaceCallTimeout")
+            self._start_query("call", request, message,
+                              get_contact_type(request))
 
     @intent_handler(IntentBuilder("SendMessageIntent")
                     .optionally("neon").require("draft").require("message"))
@@ -87,177 +218,128 @@ class CommunicationSkill(NeonSkill):
             if check_for_signal('CORE_useHesitation', -1):
                 self.speak_dialog("one_moment")
             utt = message.data.get("utterance")
-            # TODO: This should use a UID, rather than the request utterance DM
             request = utt.replace(message.data.get("neon", ""), "").strip()
-            self.query_replies[request] = []
-            self.query_extensions[request] = []
-            self.bus.emit(message.forward("communication:request.message",
-                                          data={"utterance": utt,
-                                                "request": request}))
-            # Give skills one second to reply to this request
-            self.schedule_event(self._send_message_timeout, 1,
-                                data={"request": request},
-                                name="SendMessageTimeout")
-
-    def handle_place_call_response(self, message):
-        with self.lock:
-            request = message.data["request"]
-            skill_id = message.data["skill_id"]
-
-            # Skill has requested more time to complete search
-            if "searching" in message.data and request in self.query_extensions:
-                # Manage requests for time to complete searches
-                if message.data["searching"]:
-                    # extend the timeout by 5 seconds
-                    self.cancel_scheduled_event("PlaceCallTimeout")
-                    LOG.debug(f"Timeout in 5s for {skill_id}")
-                    self.schedule_event(self._place_call_timeout, 5,
-                                        data={"request": request},
-                                        name='PlaceCallTimeout')
-
-                    # TODO: Perhaps block multiple extensions?
-                    if skill_id not in self.query_extensions[request]:
-                        self.query_extensions[request].append(skill_id)
-                else:
-                    LOG.debug(f"{skill_id} has a response")
-                    # Search complete, don't wait on this skill any longer
-                    if skill_id in self.query_extensions[request]:
-                        self.query_extensions[request].remove(skill_id)
-                        if not self.query_extensions[request]:
-                            self.cancel_scheduled_event("PlaceCallTimeout")
-                            self.schedule_event(self._place_call_timeout, 1,
-                                                data={"request": request},
-                                                name='PlaceCallTimeout')
-
-            elif request in self.query_replies:
-                # Collect all replies until the timeout
-                self.query_replies[request].append(message.data)
-                # Search complete, don't wait on this skill any longer
-                if skill_id in self.query_extensions[request]:
-                    self.query_extensions[request].remove(skill_id)
-                    if not self.query_extensions[request]:
-                        self.cancel_scheduled_event("PlaceCallTimeout")
-                        self.schedule_event(self._place_call_timeout, 0,
-                                            data={"request": request},
-                                            name='PlaceCallTimeout')
+            deliver_at, request = extract_delivery_time(request, self.lang)
+            batch = split_recipients(request) \
+                if self.settings.get("batch_messages", True) else None
+            session = self._start_query(
+                "message", request, message, batch=batch,
+                deliver_at=deliver_at.timestamp() if deliver_at else None)
+            if session and deliver_at:
+                self.speak_dialog("message_scheduled",
+                                  {"time": self._nice_time(deliver_at)})
 
-    def handle_send_message_response(self, message):
-        with self.lock:
-            request = message.data["request"]
-            skill_id = message.data["skill_id"]
+    def _start_query(self, query_type: str, request: str, message: Message,
+                     contact_type: Optional[str] = None,
+                     batch: Optional[list] = None,
+                     deliver_at: Optional[float] = None) -> \
+            Optional[QuerySession]:
+        try:
+            session = self.broker.start_query(query_type, request, message,
+                                              contact_type, batch, deliver_at)
+            if self._recorder:
+                self._recorder.record("start", message,
+                                      query_type=query_type, request=request,
+                                      contact_type=contact_type, batch=batch,
+                                      deliver_at=deliver_at,
+                                      query_id=session.query_id)
+            return session
+        except QueryLimitExceeded as e:
+            LOG.warning(f"Rejected {query_type} request: {e}")
+            self.speak_dialog("too_busy", private=True)
+            return None
 
-            # Skill has requested more time to complete search
-            if "searching" in message.data and request in self.query_extensions:
-                # Manage requests for time to complete searches
-                if message.data["searching"]:
-                    # extend the timeout by 5 seconds
-                    self.cancel_scheduled_event("SendMessageTimeout")
-                    LOG.debug(f"Timeout in 5s for {skill_id}")
-                    self.schedule_event(self._send_message_timeout, 5,
-                                        data={"request": request},
-                                        name='SendMessageTimeout')
+    def _nice_time(self, when: datetime) -> str:
+        if when.date() == datetime.now(when.tzinfo).date():
+            return nice_time(when, self.lang, use_ampm=True)
+        return nice_date_time(when, self.lang, use_ampm=True)
 
-                    # TODO: Perhaps block multiple extensions?
-                    if skill_id not in self.query_extensions[request]:
-                        self.query_extensions[request].append(skill_id)
-                else:
-                    LOG.debug(f"{skill_id} has a response")
-                    # Search complete, don't wait on this skill any longer
-                    if skill_id in self.query_extensions[request]:
-                        self.query_extensions[request].remove(skill_id)
-                        if not self.query_extensions[request]:
-                            self.cancel_scheduled_event("SendMessageTimeout")
-                            self.schedule_event(self._send_message_timeout, 1,
-                                                data={"request": request},
-                                                name='SendMessageTimeout')
+    def _handle_deferred(self, session: QuerySession, message: Message):
+        if not self._deferred:
+            self._emit(message)
+            return
+        self._deferred.add(session.deliver_at, message)
 
-            elif request in self.query_replies:
-                # Collect all replies until the timeout
-                self.query_replies[request].append(message.data)
-                # Search complete, don't wait on this skill any longer
-                if skill_id in self.query_extensions[request]:
-                    self.query_extensions[request].remove(skill_id)
-                    if not self.query_extensions[request]:
-                        self.cancel_scheduled_event("SendMessageTimeout")
-                        self.schedule_event(self._send_message_timeout, 0,
-                                            data={"request": request},
-                                            name='SendMessageTimeout')
+    def _deliver_deferred(self, messages: List[Message]):
+        for message in messages:
+            self._emit(message)
 
-    def _place_call_timeout(self, message):
-        with self.lock:
-            # Prevent any late-comers from retriggering this query handler
-            request = message.data["request"]
-            self.query_extensions[request] = []
+    def _emit(self, message: Message):
+        if self._recorder:
+            self._recorder.record("out", message)
+        self.bus.emit(message)
 
-            # Look at any replies that arrived before the timeout
-            # Find response(s) with the highest confidence
-            best = None
-            ties = []
-            LOG.debug(f"CommonMessage Resolution for: {request}")
-            for handler in self.query_replies[request]:
-                LOG.debug(f'{handler["conf"]} using {handler["skill_id"]}')
-                if not best or handler["conf"] > best["conf"]:
-                    best = handler
-                    ties = []
-                elif handler["conf"] == best["conf"]:
-                    ties.append(handler)
-
-            if best:
-                if ties:
-                    # TODO: Ask user to pick between ties or do it automagically
-                    pass
+    def _recorded(self, handler: Callable[[Message], None],
+                  pooled: bool = False) -> Callable[[Message], None]:
+        """
+        Wrap a message handler to record the messages it handles.
+        @param handler: message handler to wrap
+        @param pooled: if True, handle messages on a worker thread
+        @returns: wrapped handler
+        """
+        def wrapper(message: Message):
+            if self._recorder:
+                self._recorder.record("in", message)
+            if pooled:
+                # Keep the order of messages about the same query or handler
+                self._workers.submit(handler, message,
+                                     key=message.data.get("query_id") or
+                                     message.data.get("skill_id"),
+                                     priority=self.broker.get_priority(
+                                         message))
+            else:
+                handler(message)
+        wrapper.__name__ = handler.__name__
+        return wrapper
 
-                LOG.info(f"match={best}")
-                # invoke best match
-                send_data = {"skill_id": best["skill_id"],
-                             "request": best["request"],
-                             "skill_data": best["skill_data"]}
-                self.bus.emit(message.forward("communication:place.call", send_data))
+    def _schedule_timeout(self, session: QuerySession, timeout: float):
+        self.schedule_event(self._handle_query_timeout, timeout,
+                            data={"query_id": session.query_id},
+                            name=session.timer_name)
 
-            else:
-                LOG.info("   No matches")
-                self.speak_dialog("cant_send", private=True)
+    def _cancel_timeout(self, session: QuerySession):
+        self.cancel_scheduled_event(session.timer_name)
 
-            if request in self.query_replies:
-                del self.query_replies[request]
-            if request in self.query_extensions:
-                del self.query_extensions[request]
+    def _handle_query_timeout(self, message):
+        self._submit_timeout(message.data["query_id"])
 
-    def _send_message_timeout(self, message):
-        with self.lock:
-            # Prevent any late-comers from retriggering this query handler
-            request = message.data["request"]
-            self.query_extensions[request] = []
+    def _submit_timeout(self, query_id: str):
+        """
+        Queue a query timeout on the worker that handles the query's
+        responses, ahead of less urgent queries.
+        @param query_id: ID of the timed out session
+        """
+        message = Message("communication:timeout", {"query_id": query_id})
+        self._workers.submit(self._on_query_timeout, query_id, key=query_id,
+                             priority=self.broker.get_priority(message))
 
-            # Look at any replies that arrived before the timeout
-            # Find response(s) with the highest confidence
-            best = None
-            ties = []
-            LOG.debug(f"CommonMessage Resolution for: {request}")
-            for handler in self.query_replies[request]:
-                LOG.debug(f'{handler["conf"]} using {handler["skill_id"]}')
-                if not best or handler["conf"] > best["conf"]:
-                    best = handler
-                    ties = []
-                elif handler["conf"] == best["conf"]:
-                    ties.append(handler)
+    def _on_query_timeout(self, query_id: str):
+        if self._recorder:
+            self._recorder.record("timeout", Message("communication:timeout",
+                                                     {"query_id": query_id}))
+        self.broker.handle_timeout(query_id)
 
-            if best:
-                if ties:
-                    # TODO: Ask user to pick between ties or do it automagically
-                    pass
+    def shutdown(self):
+        if self._timers:
+            self._timers.shutdown()
+        self._workers.shutdown()
+        self.broker.priors.save()
+        self.broker.store.close()
+        if self._deferred:
+            self._deferred.shutdown()
+        if self._recorder:
+            self._recorder.close()
+        super().shutdown()
 
-                LOG.info(f"match={best}")
-                # invoke best match
-                send_data = {"skill_id": best["skill_id"],
-                             "request": best["request"],
-                             "skill_data": best["skill_data"]}
-                self.bus.emit(message.forward("communication:send.message", send_data))
-            else:
-                LOG.info("   No matches")
-                self.speak_dialog("cant_send", private=True)
+    def _sweep_sessions(self, _=None):
+        self.broker.sweep()
+        self.broker.priors.save()
 
-            if request in self.query_replies:
-                del self.query_replies[request]
-            if request in self.query_extensions:
-                del self.query_extensions[request]
+    def _handle_no_match(self, session: QuerySession):
+        if session.unresolved:
+            recipients = join_list(session.unresolved, "and", lang=self.lang)
+            self.speak_dialog("cant_send_to", {"recipients": recipients},
+                              private=True)
+            return
+        dialog = self.broker.query_types[session.query_type].no_match_dialog
+        self.speak_dialog(dialog, private=True)
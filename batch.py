@@ -0,0 +1,60 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import re
+
+from typing import List, Optional
+
+# Recipients follow the last "to" before the message body
+_BATCH_REQUEST = re.compile(r"\bto\s+(?P<recipients>(?:(?!\bto\b).)+?)"
+                            r"(?:\s+(?:saying|that says|telling them)\s+|"
+                            r"\s*:\s*)(?P<message>.+)$", re.IGNORECASE)
+_RECIPIENT_SEPARATOR = re.compile(r"\s*(?:,|;|&|\band\b)\s*", re.IGNORECASE)
+
+
+def split_recipients(request: str) -> Optional[List[dict]]:
+    """
+    Split a message request addressed to multiple recipients into one
+    sub-request per recipient.
+    @param request: message request (i.e. `message to Alice and Bob saying hi`)
+    @returns: list of dict `recipient` and `message` if the request has more
+        than one recipient, else None
+    """
+    match = _BATCH_REQUEST.search(request)
+    if not match:
+        return None
+    recipients = dict()
+    for recipient in _RECIPIENT_SEPARATOR.split(match.group("recipients")):
+        if recipient:
+            # Keep the first spelling of each recipient
+            recipients.setdefault(recipient.lower(), recipient)
+    if len(recipients) < 2:
+        return None
+    message = match.group("message").strip()
+    return [{"recipient": recipient, "message": message}
+            for recipient in recipients.values()]
@@ -0,0 +1,1263 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import Counter, OrderedDict
+from os import getpid
+from socket import gethostname
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from ovos_bus_client.message import Message
+from ovos_bus_client.util import get_message_lang
+from ovos_utils.log import LOG
+from neon_utils.message_utils import get_message_user
+
+from .cache import MissCache, ResolutionCache, normalize_contact
+from .circuit import CircuitBreaker
+from .contacts import ContactIndex, ContactMatch
+from .latency import LatencyTracker
+from .metrics import QueryMetrics
+from .priors import HandlerPriors
+from .registry import HandlerRegistration, HandlerRegistry
+from .session import QuerySession
+from .store import MemorySessionStore, SessionStore
+
+
+class QueryLimitExceeded(RuntimeError):
+    """
+    Raised when a query is started while the maximum number of sessions of
+    its type are already in flight.
+    """
+
+
+class QueryType:
+    """
+    Declarative definition of a type of common query handled by the broker.
+    """
+    def __init__(self, name: str, request_msg: str,
+                 dispatch_msg: str, response_msg: Optional[str] = None,
+                 no_match_dialog: str = "cant_send",
+                 timeout: float = 1, extension_timeout: float = 5,
+                 cacheable: bool = False, priority: int = 1,
+                 max_timeout: Optional[float] = None):
+        """
+        @param name: unique name of this query type (i.e. `call`)
+        @param request_msg: message type emitted to query handler skills
+        @param dispatch_msg: message type emitted to invoke the best handler
+        @param response_msg: message type handlers reply with
+            (default `<request_msg>.response`)
+        @param no_match_dialog: dialog to speak when no handler replies
+        @param timeout: seconds to wait for handlers to reply
+        @param extension_timeout: seconds to wait after a handler indicates
+            it is still searching
+        @param cacheable: if True, the request is a contact and resolutions
+            may be cached and reused for repeat requests from the same user
+        @param priority: scheduling class of queries of this type; lower
+            values are more urgent
+        @param max_timeout: optional limit on the adaptive wait window
+        """
+        self.name = name
+        self.request_msg = request_msg
+        self.response_msg = response_msg or f"{request_msg}.response"
+        self.dispatch_msg = dispatch_msg
+        self.result_msg = f"{dispatch_msg}.response"
+        self.batch_msg = f"{dispatch_msg}.batch"
+        self.no_match_dialog = no_match_dialog
+        self.timeout = timeout
+        self.extension_timeout = extension_timeout
+        self.cacheable = cacheable
+        self.priority = priority
+        self.max_timeout = max_timeout
+
+    def __repr__(self):
+        return f"QueryType({self.name})"
+
+
+class CommonQueryBroker:
+    """
+    Broadcasts common queries to handler skills, collects their replies and
+    dispatches each query to the handler with the highest confidence.
+
+    Handlers that have registered for a query type, or that have answered
+    it before, are expected to answer later queries of that type; once all
+    of them have replied or declined, a query resolves without waiting for
+    its timeout. If exactly one registered handler can serve a query and it
+    accepts direct dispatch, the query is dispatched without a broadcast.
+
+    Wait windows are derived from the observed latency of the handlers
+    expected to answer, falling back to the QueryType defaults.
+
+    For cacheable query types, the handler that resolved a contact is cached
+    per user and repeat requests are dispatched to it immediately. Contacts
+    that no handler resolved are cached briefly, so repeat requests fail
+    without another broadcast until a handler registers or updates contacts.
+
+    The number of in-flight sessions per query type is capped, and sessions
+    whose timeout never fires are removed by `sweep`. A request identical to
+    one the same user made within `coalesce_window` seconds is attached to
+    the in-flight session, or to the session that dispatched it within that
+    window, instead of starting another query.
+
+    Handlers may push their contacts to a local index; requested contacts
+    that confidently match indexed contacts are only sent to the matching
+    handlers, or dispatched directly when the handler allows it.
+
+    A batch query carries a list of sub-requests in a single broadcast; each
+    sub-request is dispatched to its best handler when the query resolves
+    and the outcomes are emitted in one aggregated message.
+
+    While a query waits for replies, the handler with the best reply so far
+    is sent a `communication:prepare` hint so it may begin setting up before
+    it is dispatched; a handler that is overtaken is sent
+    `communication:prepare.cancel`.
+
+    Every reply to a query is kept as a ranked candidate. If the dispatched
+    handler reports a failure, or does not acknowledge the dispatch within
+    `ack_timeout` after registering to do so, the query is dispatched to the
+    next candidate without another broadcast; if a cached handler fails,
+    handlers are queried again. Candidates with equal confidence are ranked
+    by the prior success of their handlers for the same user and contact.
+
+    Each handler may extend a query `max_extensions` times, and no query is
+    extended past `extension_budget` seconds. Handlers that repeatedly time
+    out, over-extend, or send malformed replies trip a circuit breaker; while
+    it is open they are not waited on and their extensions are ignored.
+
+    In-flight sessions are shared through a `SessionStore` so that several
+    skill instances may serve one bus. Responses received by an instance
+    that did not start a query are stored for the owner, which collects them
+    and claims the query before dispatching it, so each query resolves once.
+
+    Sessions carry the priority of their QueryType so that their responses
+    and timeouts are handled by urgency (see `get_priority`), and each user
+    may only have `max_user_sessions` queries of a type in flight so one
+    client cannot starve the others.
+
+    A query may be resolved ahead of a requested delivery time; its dispatch
+    messages are then passed to `on_deferred` instead of being emitted.
+    """
+    def __init__(self, emit: Callable[[Message], None],
+                 schedule: Callable[[QuerySession, float], None],
+                 cancel: Callable[[QuerySession], None],
+                 on_no_match: Callable[[QuerySession], None],
+                 on_deferred: Optional[Callable[[QuerySession, Message],
+                                                None]] = None):
+        """
+        @param emit: callback to emit a Message to the bus
+        @param schedule: callback to schedule a session timeout in seconds
+        @param cancel: callback to cancel a scheduled session timeout
+        @param on_no_match: callback when a query resolves with no handler
+        @param on_deferred: callback with the dispatch message of a query to
+            deliver at its `deliver_at` time
+        """
+        self._emit = emit
+        self._schedule = schedule
+        self._cancel = cancel
+        self._on_no_match = on_no_match
+        self._on_deferred = on_deferred
+        self.query_types: Dict[str, QueryType] = dict()
+        self._response_types: Dict[str, QueryType] = dict()
+        self._result_types: Dict[str, QueryType] = dict()
+        self.sessions: Dict[str, QuerySession] = dict()
+        self.store: SessionStore = MemorySessionStore()
+        self.node_id = f"{gethostname()}.{getpid()}"
+        self._dispatched: Dict[str, QuerySession] = dict()
+        self._active: Counter = Counter()
+        self._user_active: Counter = Counter()
+        self._request_sessions: Dict[tuple, QuerySession] = dict()
+        # Recently resolved sessions and the handlers that replied late
+        self._recent: OrderedDict = OrderedDict()
+        self.max_recent = 256
+        self.coalesce_window = 5
+        self.max_sessions = 500
+        self.max_user_sessions = 20
+        self.session_ttl = 60
+        self.known_handlers: Dict[str, Set[str]] = dict()
+        self.registry = HandlerRegistry()
+        self.latency = LatencyTracker()
+        self.cache = ResolutionCache()
+        self.misses = MissCache()
+        self.metrics = QueryMetrics()
+        self.priors = HandlerPriors()
+        self.circuits = CircuitBreaker()
+        self.max_extensions = 2
+        self.extension_budget = 10
+        self.contacts = ContactIndex()
+        self.contact_threshold = 0.8
+        self.confirm_cached = False
+        self.prepare_leader = True
+        self.ack_timeout = 2
+        self.timer_tolerance = 0.05
+        # Guards `sessions`, `known_handlers` and `_recent`; never held while
+        # emitting and never acquired while holding a session lock
+        self.lock = Lock()
+
+    def configure(self, settings: dict):
+        """
+        Apply skill settings to this broker.
+        @param settings: dict skill settings
+        """
+        self.latency.min_timeout = settings.get("min_timeout",
+                                                self.latency.min_timeout)
+        self.latency.max_timeout = settings.get("max_timeout",
+                                                self.latency.max_timeout)
+        self.latency.max_extension_timeout = \
+            settings.get("max_extension_timeout",
+                         self.latency.max_extension_timeout)
+        for qtype in self.query_types.values():
+            qtype.timeout = settings.get(f"{qtype.name}_timeout",
+                                         qtype.timeout)
+            qtype.extension_timeout = \
+                settings.get(f"{qtype.name}_extension_timeout",
+                             qtype.extension_timeout)
+            qtype.max_timeout = settings.get(f"{qtype.name}_max_timeout",
+                                             qtype.max_timeout)
+        self.cache.max_size = settings.get("cache_size", self.cache.max_size)
+        self.cache.ttl = settings.get("cache_ttl", self.cache.ttl)
+        self.misses.ttl = settings.get("miss_cache_ttl", self.misses.ttl)
+        self.confirm_cached = settings.get("confirm_cached",
+                                           self.confirm_cached)
+        self.metrics.enabled = settings.get("metrics_enabled",
+                                            self.metrics.enabled)
+        self.max_sessions = settings.get("max_sessions", self.max_sessions)
+        self.max_user_sessions = settings.get("max_user_sessions",
+                                              self.max_user_sessions)
+        self.session_ttl = settings.get("session_ttl", self.session_ttl)
+        self.coalesce_window = settings.get("coalesce_window",
+                                            self.coalesce_window)
+        self.contact_threshold = settings.get("contact_match_threshold",
+                                              self.contact_threshold)
+        self.prepare_leader = settings.get("prepare_leader",
+                                           self.prepare_leader)
+        self.ack_timeout = settings.get("ack_timeout", self.ack_timeout)
+        self.priors.weight = settings.get("prior_weight", self.priors.weight)
+        self.max_extensions = settings.get("max_extensions",
+                                           self.max_extensions)
+        self.extension_budget = settings.get("extension_budget",
+                                             self.extension_budget)
+        self.circuits.threshold = settings.get("breaker_threshold",
+                                               self.circuits.threshold)
+        self.circuits.cooldown = settings.get("breaker_cooldown",
+                                              self.circuits.cooldown)
+
+    def use_timers(self, schedule: Callable[[QuerySession, float], None],
+                   cancel: Callable[[QuerySession], None]):
+        """
+        Replace the callbacks used to schedule and cancel session timeouts.
+        @param schedule: callback to schedule a session timeout in seconds
+        @param cancel: callback to cancel a scheduled session timeout
+        """
+        self._schedule = schedule
+        self._cancel = cancel
+
+    def use_store(self, store: SessionStore):
+        """
+        Replace the store used to share sessions with other instances.
+        @param store: SessionStore to use
+        """
+        self.store.close()
+        self.store = store
+
+    def register_query_type(self, query_type: QueryType):
+        """
+        Register a type of query to be handled by this broker.
+        @param query_type: QueryType to register
+        """
+        if query_type.name in self.query_types:
+            raise ValueError(f"{query_type.name} is already registered")
+        self.query_types[query_type.name] = query_type
+        self._response_types[query_type.response_msg] = query_type
+        self._result_types[query_type.result_msg] = query_type
+        self.known_handlers[query_type.name] = set()
+
+    def add_known_handler(self, query_type: str, skill_id: str):
+        """
+        Add a handler skill expected to answer queries of the given type.
+        @param query_type: name of a registered QueryType
+        @param skill_id: skill ID of the handler
+        """
+        self.known_handlers[query_type].add(skill_id)
+
+    def remove_known_handler(self, query_type: str, skill_id: str):
+        """
+        Stop expecting a handler skill to answer queries of the given type.
+        @param query_type: name of a registered QueryType
+        @param skill_id: skill ID of the handler
+        """
+        self.known_handlers[query_type].discard(skill_id)
+
+    def register_handler(self, data: dict) -> Optional[HandlerRegistration]:
+        """
+        Register or refresh a handler skill's capabilities.
+        @param data: `communication:register` message data
+        @returns: HandlerRegistration if the data was valid, else None
+        """
+        previous = self.registry.get(data.get("skill_id"))
+        registration = self.registry.register(data)
+        if registration and not (previous and previous.query_types ==
+                                 registration.query_types):
+            # A new handler may be a better match for cached contacts
+            self.cache.invalidate_query_types(registration.query_types)
+            self.misses.invalidate_query_types(registration.query_types)
+        return registration
+
+    def deregister_handler(self, skill_id: str):
+        """
+        Remove a handler skill from the registry and known handlers.
+        @param skill_id: skill ID of the handler
+        """
+        self.registry.deregister(skill_id)
+        self.cache.invalidate_skill(skill_id)
+        self.contacts.remove_handler(skill_id)
+        with self.lock:
+            for handlers in self.known_handlers.values():
+                handlers.discard(skill_id)
+
+    def update_contacts(self, data: dict):
+        """
+        Update the indexed contacts of a handler skill.
+        @param data: `communication:contacts.update` message data
+        """
+        skill_id = data.get("skill_id")
+        if not skill_id:
+            LOG.warning(f"Invalid contacts update: {data}")
+            return
+        self.contacts.update(skill_id, data.get("contacts"),
+                             data.get("added"), data.get("removed"))
+        # Previously unresolved contacts may now be served
+        self.misses.clear()
+        if "direct_dispatch" not in data:
+            return
+        if data["direct_dispatch"]:
+            self.contacts.direct_dispatch.add(skill_id)
+        else:
+            self.contacts.direct_dispatch.discard(skill_id)
+
+    def start_query(self, query_type: str, request: str,
+                    message: Message,
+                    contact_type: Optional[str] = None,
+                    batch: Optional[List[dict]] = None,
+                    deliver_at: Optional[float] = None) -> QuerySession:
+        """
+        Start a new query and send it to eligible handler skills.
+        @param query_type: name of a registered QueryType
+        @param request: requested contact or message string
+        @param message: Message associated with the user request
+        @param contact_type: type of the requested contact, if known
+        @param batch: optional sub-requests, each with a unique `recipient`
+        @param deliver_at: optional epoch time to dispatch the query at
+        @returns: new QuerySession, or the in-flight session for a duplicate
+        @raises QueryLimitExceeded: if too many queries are in flight
+        """
+        qtype = self.query_types[query_type]
+        user = get_message_user(message)
+        # Requests for different delivery times are different requests
+        request_key = (user or "", qtype.name, normalize_contact(request),
+                       deliver_at)
+        with self.lock:
+            existing = self._request_sessions.get(request_key)
+        if existing and self._can_coalesce(existing, monotonic()):
+            LOG.info(f"Attaching duplicate request to {existing}")
+            self.metrics.count(qtype.name, "coalesced")
+            return existing
+        user_key = (request_key[0], qtype.name)
+        with self.lock:
+            active = self._active[qtype.name]
+            user_active = self._user_active[user_key]
+            admitted = active < self.max_sessions and \
+                not (user and user_active >= self.max_user_sessions)
+            if admitted:
+                # Reserve a slot; released below unless the query is tracked
+                self._active[qtype.name] += 1
+                self._user_active[user_key] += 1
+        if active >= self.max_sessions:
+            self.metrics.count(qtype.name, "rejected")
+            raise QueryLimitExceeded(f"{active} {qtype.name} queries in "
+                                     f"flight")
+        if not admitted:
+            self.metrics.count(qtype.name, "rejected_user")
+            raise QueryLimitExceeded(f"{user} has {user_active} "
+                                     f"{qtype.name} queries in flight")
+        for skill_id in self.registry.prune():
+            self.deregister_handler(skill_id)
+        cached = self.cache.get(user, qtype.name, request) \
+            if qtype.cacheable else None
+        if qtype.cacheable and not cached and not batch and \
+                self.misses.get(user, qtype.name, request):
+            session = QuerySession(qtype.name, request, message)
+            session.request_key = request_key
+            LOG.info(f"No handler resolved {request} recently: {session}")
+            self.metrics.count(qtype.name, "queries")
+            self.metrics.count(qtype.name, "miss_cached")
+            self.metrics.count(qtype.name, "no_match")
+            self._release_slot(user_key)
+            self._on_no_match(session)
+            return session
+        eligible = self.registry.eligible(qtype.name,
+                                          get_message_lang(message),
+                                          contact_type)
+        registered = self.registry.registered(qtype.name)
+        with self.lock:
+            # Unregistered handlers learned from past responses are expected
+            # alongside eligible registered handlers
+            expected = eligible | (self.known_handlers[qtype.name] -
+                                   registered)
+        # Handlers in a cool-down period may answer but are not waited on
+        expected = {skill_id for skill_id in expected
+                    if not self.circuits.is_open(skill_id)}
+        matches = self._match_contact(request, expected) \
+            if qtype.cacheable and not cached and not batch else None
+        if matches:
+            # Only handlers with a matching contact need to answer
+            expected = {match.skill_id for match in matches}
+            # A contact that only sounds alike may be someone else, so it is
+            # never dispatched without asking its handler
+            if not matches[0].phonetic:
+                eligible = expected
+        timeout = self.latency.get_timeout(qtype.name, expected,
+                                           qtype.timeout)
+        if qtype.max_timeout:
+            timeout = min(timeout, qtype.max_timeout)
+        session = QuerySession(qtype.name, request, message,
+                               expected=expected, timeout=timeout,
+                               batch=batch)
+        session.request_key = request_key
+        session.deliver_at = deliver_at
+        session.priority = qtype.priority
+        self.metrics.count(qtype.name, "queries")
+        if cached:
+            LOG.info(f"Dispatching {session} to cached handler: "
+                     f"{cached['skill_id']}")
+            self.metrics.count(qtype.name, "cached")
+            session.dispatched_to = cached["skill_id"]
+            session.awaiting_ack = cached["skill_id"]
+            with self.lock:
+                # Query handlers again if the cached handler reports a failure
+                self._dispatched[session.query_id] = session
+            self._dispatch(session, cached["skill_id"],
+                           cached["skill_data"], cached=True)
+            if not self.confirm_cached:
+                session.resolved = True
+                session.deadline = monotonic() + self.ack_timeout
+                self._schedule(session, self.ack_timeout)
+                self._release_slot(user_key)
+                return session
+            # Confirm the cached resolution with a query in the background
+        elif matches and not matches[0].phonetic and \
+                matches[0].skill_id in self.contacts.direct_dispatch and \
+                (len(matches) == 1 or matches[0].score > matches[1].score):
+            match = matches[0]
+            LOG.info(f"Dispatching {session} to {match}")
+            self.metrics.count(qtype.name, "indexed")
+            self._dispatch(session, match.skill_id, match.entry.data,
+                           contact=match.entry.name)
+            self._release_slot(user_key)
+            return session
+        elif len(expected) == 1 and len(eligible) == 1 and \
+                self._accepts_direct_dispatch(next(iter(eligible))):
+            skill_id = next(iter(eligible))
+            LOG.info(f"Dispatching {session} directly to {skill_id}")
+            self.metrics.count(qtype.name, "direct")
+            if batch:
+                session.batch_best = {sub_request["recipient"]:
+                                      {"skill_id": skill_id}
+                                      for sub_request in batch}
+                self._dispatch_batch(session)
+            else:
+                self._dispatch(session, skill_id, None)
+            self._release_slot(user_key)
+            return session
+
+        with self.lock:
+            self.sessions[session.query_id] = session
+            self._request_sessions[request_key] = session
+        self.store.add(session, self.node_id)
+        data = {"utterance": message.data.get("utterance"),
+                "request": request,
+                "query_id": session.query_id}
+        if eligible:
+            data["handlers"] = sorted(eligible)
+        if batch:
+            data["requests"] = batch
+        if deliver_at:
+            data["deliver_at"] = deliver_at
+        LOG.debug(f"Started {session}")
+        self._emit(message.forward(qtype.request_msg, data))
+        self.metrics.phase(session, "broadcast")
+        # Give skills time to reply to this request
+        self._schedule(session, session.timeout)
+        return session
+
+    def get_session(self, query_type: str,
+                    data: dict) -> Optional[QuerySession]:
+        """
+        Get the active session a response refers to.
+        @param query_type: name of the QueryType of the response
+        @param data: response message data
+        @returns: matching QuerySession if one is active, else None
+        """
+        query_id = data.get("query_id")
+        if query_id:
+            session = self.sessions.get(query_id)
+            if session and session.query_type == query_type:
+                return session
+            return None
+        # Handler did not echo `query_id`; match the newest session for the
+        # same request for backwards-compatibility
+        request = data.get("request")
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in reversed(sessions):
+            if session.query_type == query_type and \
+                    session.request == request:
+                return session
+        return None
+
+    def get_priority(self, message: Message) -> int:
+        """
+        Get the scheduling priority of a message about a query.
+        @param message: response, result, or timeout Message
+        @returns: priority of the query's type; lower values are more urgent
+        """
+        qtype = self._response_types.get(message.msg_type) or \
+            self._result_types.get(message.msg_type)
+        if qtype:
+            return qtype.priority
+        query_id = message.data.get("query_id")
+        session = self.sessions.get(query_id) or self._dispatched.get(query_id)
+        return session.priority if session else 1
+
+    def handle_response(self, message: Message):
+        """
+        Handle a response from a handler skill to a query. Session state is
+        updated under the session's lock; timers are re-armed and queries
+        resolved after it is released.
+        @param message: `*.response` Message from a handler skill
+        """
+        qtype = self._response_types.get(message.msg_type)
+        if not qtype:
+            LOG.warning(f"Unhandled response type: {message.msg_type}")
+            return
+        session = self.get_session(qtype.name, message.data)
+        query_id = message.data.get("query_id")
+        with self.lock:
+            recent = self._recent.get(query_id) if not session else None
+        if not session and not recent:
+            # The query may have been started by another instance
+            if query_id and self.store.add_reply(query_id, message.data):
+                LOG.debug(f"Stored response to {query_id} for its owner")
+            return
+        skill_id = message.data.get("skill_id")
+        if not skill_id:
+            LOG.warning(f"Response without a skill_id: {message.data}")
+            self.metrics.count(qtype.name, "malformed")
+            return
+        if not self._is_valid_response(message.data):
+            LOG.warning(f"Malformed response from {skill_id}: "
+                        f"{message.data}")
+            self.metrics.count(qtype.name, "malformed")
+            self._strike(qtype.name, skill_id)
+            return
+        with self.lock:
+            self.known_handlers[qtype.name].add(skill_id)
+        if recent:
+            self._record_late_reply(recent, skill_id)
+            return
+
+        now = monotonic()
+        timeout = None
+        leader = overtaken = None
+        with session.lock:
+            if session.resolved:
+                return
+            if not session.has_answered(skill_id):
+                self.latency.record_reply(qtype.name, skill_id,
+                                          now - session.created)
+                self.metrics.phase(session, "first_reply", once=True)
+
+            # Skill has requested more time to complete search
+            if "searching" in message.data:
+                if message.data["searching"]:
+                    session.search_started.setdefault(skill_id, now)
+                    timeout = self._get_extension(session, skill_id, now)
+                    if timeout is not None:
+                        session.extensions.add(skill_id)
+                        self.metrics.count(qtype.name, "extensions")
+                        self.metrics.phase(session, "extension")
+                    else:
+                        self.metrics.count(qtype.name, "extensions_denied")
+                else:
+                    # Search complete, don't wait on this skill any longer
+                    timeout = self._end_extension(session, skill_id,
+                                                  session.timeout)
+            elif message.data.get("declined"):
+                self.circuits.success(skill_id)
+                session.add_decline(skill_id)
+                timeout = self._end_extension(session, skill_id, 0)
+            else:
+                self.circuits.success(skill_id)
+                # Collect all replies until the timeout
+                session.add_reply(message.data)
+                leader, overtaken = self._update_leader(session)
+                # Search complete, don't wait on this skill any longer
+                timeout = self._end_extension(session, skill_id, 0)
+            resolve_now = session.complete
+            if timeout is not None:
+                session.deadline = now + timeout
+
+        LOG.debug(f"{skill_id} answered {session} with "
+                  f"conf={message.data.get('conf')}")
+        if overtaken:
+            self._emit_prepare(session, overtaken, cancel=True)
+        if leader and not resolve_now:
+            # Dispatch follows immediately when resolving now
+            self._emit_prepare(session, leader["skill_id"],
+                               leader.get("skill_data"))
+        if resolve_now:
+            # Every expected handler has answered; the timeout is only
+            # an upper bound
+            LOG.debug(f"All handlers answered {session}")
+            self._cancel(session)
+            self._resolve(session, timed_out=False)
+        elif timeout is not None:
+            LOG.debug(f"Timeout in {timeout}s for {session}")
+            self._rearm(session, timeout)
+
+    def handle_timeout(self, query_id: str):
+        """
+        Resolve a query after its timeout, dispatching it to the best handler,
+        or fall back to the next candidate if a dispatch was not acknowledged.
+        @param query_id: ID of the session to resolve
+        """
+        session = self.sessions.get(query_id) or \
+            self._dispatched.get(query_id)
+        if not session:
+            return
+        with session.lock:
+            remaining = session.deadline - monotonic()
+        if remaining > self.timer_tolerance:
+            # The deadline was extended after this timer was scheduled
+            self._schedule(session, remaining)
+            return
+        if session.resolved:
+            self._handle_ack_timeout(session)
+        else:
+            self._resolve(session, timed_out=True)
+
+    def _record_late_reply(self, recent: Tuple[QuerySession, Set[str]],
+                           skill_id: str):
+        """
+        Record the latency of a reply to a recently resolved query, so wait
+        windows widen to include handlers that answer after them.
+        @param recent: tuple of resolved QuerySession and skill IDs of
+            handlers that already replied late
+        @param skill_id: skill ID of the handler that replied
+        """
+        session, late = recent
+        with self.lock:
+            if skill_id in late:
+                return
+            late.add(skill_id)
+        with session.lock:
+            answered = session.has_answered(skill_id)
+        if answered:
+            return
+        LOG.debug(f"{skill_id} answered {session} after it resolved")
+        self.latency.record_reply(session.query_type, skill_id,
+                                  monotonic() - session.created)
+        self.metrics.count(session.query_type, "late_replies")
+
+    def _resolve(self, session: QuerySession, timed_out: bool):
+        """
+        Resolve a query, dispatching it to the best handler.
+        @param session: QuerySession to resolve
+        @param timed_out: True if the query timed out, False if it resolved
+            early because all expected handlers answered
+        """
+        with session.lock:
+            # Prevent any late-comers from retriggering this query handler
+            if session.resolved:
+                return
+            session.resolved = True
+        if not self.store.claim(session.query_id, self.node_id):
+            LOG.info(f"{session} was already resolved")
+            self._remove_session(session)
+            return
+        self._merge_replies(session)
+        self._remove_session(session)
+
+        # Session state is no longer modified once resolved
+        qtype = self.query_types[session.query_type]
+        self.metrics.phase(session, "resolved")
+        self.metrics.count(qtype.name,
+                           "timeouts" if timed_out else "early_resolutions")
+        if timed_out:
+            # Handlers that never finished searching, or registered to answer
+            # and never did, held this query until its timeout. Handlers may
+            # otherwise stay silent when they have no match.
+            for skill_id in session.extensions | \
+                    {skill_id for skill_id in session.pending
+                     if self._promises_answer(skill_id)}:
+                self._strike(qtype.name, skill_id)
+        best = session.best
+        user = get_message_user(session.message)
+        LOG.debug(f"Resolution for: {session} with "
+                  f"{session.reply_count} replies")
+        if session.dispatched_to:
+            # Query was already dispatched to a cached handler; fall back to
+            # the other replies if it fails
+            session.fallbacks = [reply for reply in session.candidates
+                                 if reply["skill_id"] !=
+                                 session.dispatched_to]
+            with session.lock:
+                awaiting_ack = session.awaiting_ack
+                if awaiting_ack:
+                    session.deadline = monotonic() + self.ack_timeout
+            if awaiting_ack:
+                # Wait for the cached handler's result now that the
+                # background query no longer holds the session's timer
+                self._schedule(session, self.ack_timeout)
+            if not best:
+                LOG.info(f"Cached resolution not confirmed: {session}")
+                self.cache.invalidate(user, qtype.name, session.request)
+            elif best["skill_id"] != session.dispatched_to:
+                LOG.info(f"Cached resolution changed: {session} "
+                         f"{session.dispatched_to}->{best['skill_id']}")
+                self.cache.put(user, qtype.name, session.request,
+                               best["skill_id"], best.get("skill_data"))
+        elif session.batch_best:
+            self._dispatch_batch(session)
+        elif best:
+            ranked = session.candidates
+            if session.ties or self.priors.weight:
+                # Prefer handlers that succeeded for this user before
+                ranked = self.priors.rank(user, qtype.name,
+                                          self._get_contact(session),
+                                          session.replies)
+                best = ranked[0]
+            if session.ties:
+                self.metrics.count(qtype.name, "ties")
+
+            if session.prepared and session.prepared != best["skill_id"]:
+                # The prepared leader was outranked
+                self._emit_prepare(session, session.prepared, cancel=True)
+
+            LOG.info(f"match={best['skill_id']} conf={best.get('conf')}")
+            # Keep the other replies in case the best match fails
+            session.fallbacks = ranked[1:]
+            # invoke best match
+            self._dispatch_reply(session, best)
+        else:
+            LOG.info("   No matches")
+            if qtype.cacheable and not session.batch:
+                self.misses.put(user, qtype.name, session.request)
+            self.metrics.count(qtype.name, "no_match")
+            self._on_no_match(session)
+
+    def sweep(self) -> Set[str]:
+        """
+        Remove sessions older than `session_ttl`, i.e. sessions whose timeout
+        was lost or never fired.
+        @returns: query IDs of removed sessions
+        """
+        cutoff = monotonic() - self.session_ttl
+        with self.lock:
+            expired = [session for session in self.sessions.values()
+                       if session.created < cutoff]
+            for query_id in [query_id for query_id, session
+                             in self._dispatched.items()
+                             if session.created < cutoff]:
+                # Dispatched sessions whose acknowledgement timer was lost
+                self._dispatched.pop(query_id)
+            for request_key in [key for key, session
+                                in self._request_sessions.items()
+                                if session.created < cutoff]:
+                self._request_sessions.pop(request_key)
+            while self._recent and \
+                    next(iter(self._recent.values()))[0].created < cutoff:
+                self._recent.popitem(last=False)
+        # Sessions of instances that stopped before resolving them
+        self.store.prune(self.session_ttl)
+        for session in expired:
+            with session.lock:
+                if session.resolved:
+                    continue
+                session.resolved = True
+            self._remove_session(session)
+            self._cancel(session)
+            if session.prepared:
+                self._emit_prepare(session, session.prepared, cancel=True)
+            LOG.warning(f"Removed expired session: {session}")
+            self.metrics.count(session.query_type, "expired")
+        return {session.query_id for session in expired}
+
+    def get_usage(self) -> dict:
+        """
+        Get the number of in-flight sessions and memory used by stored
+        replies.
+        @returns: dict `sessions` by query type and total `reply_bytes`
+        """
+        with self.lock:
+            sessions = list(self.sessions.values())
+            active = dict(self._active)
+        return {"sessions": active,
+                "reply_bytes": sum(s.reply_bytes for s in sessions)}
+
+    def handle_result(self, message: Message):
+        """
+        Handle a handler skill reporting the result of a dispatched query.
+        @param message: `<dispatch_msg>.response` Message from a handler
+        """
+        qtype = self._result_types.get(message.msg_type)
+        if not qtype:
+            LOG.warning(f"Unhandled result type: {message.msg_type}")
+            return
+        success = message.data.get("success", True)
+        skill_id = message.data.get("skill_id")
+        session = self._dispatched.get(message.data.get("query_id"))
+        if session and self._end_dispatch(session, skill_id):
+            self._cancel(session)
+            self._record_outcome(session, skill_id,
+                                 "success" if success else "failed")
+        else:
+            session = None
+        if success:
+            return
+        LOG.info(f"{skill_id} failed to handle: {message.data}")
+        if qtype.cacheable:
+            self.cache.invalidate(get_message_user(message), qtype.name,
+                                  message.data.get("request"), skill_id)
+        if session:
+            self._fallback(session)
+
+    def _dispatch(self, session: QuerySession, skill_id: str,
+                  skill_data: Optional[dict], **kwargs):
+        """
+        Emit a query's dispatch message to invoke a handler.
+        @param session: QuerySession being dispatched
+        @param skill_id: skill ID of the handler to invoke
+        @param skill_data: data the handler returned for this query
+        @param kwargs: additional data to include in the dispatch message
+        """
+        qtype = self.query_types[session.query_type]
+        data = {"skill_id": skill_id,
+                "request": session.request,
+                "skill_data": skill_data,
+                "query_id": session.query_id,
+                "utterance": session.message.data.get("utterance"),
+                **kwargs}
+        message = session.message.forward(qtype.dispatch_msg, data)
+        session.dispatched_at = monotonic()
+        if session.request_key:
+            # Repeats of this request are answered by this dispatch
+            with self.lock:
+                self._request_sessions[session.request_key] = session
+        if session.deliver_at and self._on_deferred:
+            self.metrics.count(qtype.name, "deferred")
+            self._on_deferred(session, message)
+        else:
+            self._emit(message)
+        self.metrics.phase(session, "dispatched")
+
+    def _dispatch_reply(self, session: QuerySession, reply: dict):
+        """
+        Dispatch a resolved query to the handler of a reply and wait for the
+        handler to acknowledge it.
+        @param session: resolved QuerySession
+        @param reply: reply of the handler to dispatch to
+        """
+        qtype = self.query_types[session.query_type]
+        skill_id = reply["skill_id"]
+        if session.deliver_at:
+            # Deferred dispatches are acknowledged after the delivery time
+            self._dispatch(session, skill_id, reply.get("skill_data"),
+                           request=reply.get("request", session.request))
+            return
+        with session.lock:
+            session.awaiting_ack = skill_id
+            session.deadline = monotonic() + self.ack_timeout
+        with self.lock:
+            self._dispatched[session.query_id] = session
+        self._dispatch(session, skill_id, reply.get("skill_data"),
+                       request=reply.get("request", session.request))
+        self._schedule(session, self.ack_timeout)
+        if qtype.cacheable:
+            self.cache.put(get_message_user(session.message), qtype.name,
+                           session.request, skill_id, reply.get("skill_data"))
+
+    def _end_dispatch(self, session: QuerySession, skill_id: str) -> bool:
+        """
+        Stop waiting for a handler to acknowledge a dispatch.
+        @param session: dispatched QuerySession
+        @param skill_id: skill ID of the handler
+        @returns: True if the session was waiting on this handler
+        """
+        with session.lock:
+            if session.awaiting_ack != skill_id:
+                return False
+            session.awaiting_ack = None
+        with self.lock:
+            self._dispatched.pop(session.query_id, None)
+        return True
+
+    def _handle_ack_timeout(self, session: QuerySession):
+        """
+        Handle a dispatched handler not acknowledging a dispatch in time.
+        @param session: dispatched QuerySession
+        """
+        skill_id = session.awaiting_ack
+        if not skill_id or not self._end_dispatch(session, skill_id):
+            return
+        registration = self.registry.get(skill_id)
+        if not (registration and registration.ack):
+            # Handler does not report results; assume it succeeded
+            self._record_outcome(session, skill_id, "assumed")
+            return
+        LOG.warning(f"{skill_id} did not acknowledge {session}")
+        self._record_outcome(session, skill_id, "timeout")
+        self._strike(session.query_type, skill_id)
+        self._fallback(session)
+
+    def _record_outcome(self, session: QuerySession, skill_id: str,
+                        outcome: str):
+        """
+        Record the outcome of a dispatch in metrics and handler priors.
+        @param session: dispatched QuerySession
+        @param skill_id: skill ID of the dispatched handler
+        @param outcome: `success`, `failed`, `timeout`, or `assumed`
+        """
+        self.metrics.handler_outcome(session.query_type, skill_id, outcome)
+        self.priors.record(get_message_user(session.message),
+                           session.query_type, self._get_contact(session),
+                           skill_id, outcome in ("success", "assumed"))
+
+    def _get_contact(self, session: QuerySession) -> Optional[str]:
+        """
+        Get the requested contact of a session, if its request is a contact.
+        @param session: QuerySession to get the contact of
+        @returns: requested contact, or None
+        """
+        if self.query_types[session.query_type].cacheable:
+            return session.request
+        return None
+
+    def _fallback(self, session: QuerySession):
+        """
+        Dispatch a query to the next ranked candidate after its handler
+        failed, or report no match if no candidates remain.
+        @param session: QuerySession whose dispatch failed
+        """
+        with self.lock:
+            confirming = session.query_id in self.sessions
+        with session.lock:
+            reply = session.fallbacks.pop(0) if session.fallbacks else None
+            cached = session.dispatched_to
+            if cached and confirming and not session.resolved:
+                # Dispatch the best reply to the background confirmation
+                session.dispatched_to = None
+                return
+        if reply:
+            LOG.info(f"Falling back to {reply['skill_id']} for {session}")
+            self.metrics.count(session.query_type, "fallbacks")
+            self._dispatch_reply(session, reply)
+        elif cached:
+            self._requery(session)
+        else:
+            # A repeat of this request should be queried again
+            with self.lock:
+                if self._request_sessions.get(session.request_key) is \
+                        session:
+                    del self._request_sessions[session.request_key]
+            self.metrics.count(session.query_type, "no_match")
+            self._on_no_match(session)
+
+    def _requery(self, session: QuerySession):
+        """
+        Query handlers for a request whose cached handler failed.
+        @param session: QuerySession dispatched to a cached handler
+        """
+        LOG.info(f"Cached handler {session.dispatched_to} failed; "
+                 f"querying handlers for {session}")
+        self.metrics.count(session.query_type, "requeries")
+        self.cache.invalidate(get_message_user(session.message),
+                              session.query_type, session.request)
+        with self.lock:
+            if self._request_sessions.get(session.request_key) is session:
+                del self._request_sessions[session.request_key]
+        try:
+            self.start_query(session.query_type, session.request,
+                             session.message)
+        except QueryLimitExceeded as e:
+            LOG.warning(f"Could not query handlers again: {e}")
+            self.metrics.count(session.query_type, "no_match")
+            self._on_no_match(session)
+
+    def _dispatch_batch(self, session: QuerySession):
+        """
+        Dispatch each sub-request of a batch query to its best handler and
+        emit the outcome for every recipient in one message.
+        @param session: resolved QuerySession with `batch` sub-requests
+        """
+        qtype = self.query_types[session.query_type]
+        outcomes = list()
+        for sub_request in session.batch:
+            recipient = sub_request["recipient"]
+            best = session.batch_best.get(recipient)
+            if best:
+                self._dispatch(session, best["skill_id"],
+                               best.get("skill_data"), **sub_request)
+            else:
+                session.unresolved.append(recipient)
+            outcomes.append({"recipient": recipient,
+                             "skill_id": best["skill_id"] if best else None,
+                             "dispatched": best is not None})
+        LOG.info(f"Dispatched {len(outcomes) - len(session.unresolved)}/"
+                 f"{len(outcomes)} sub-requests of {session}")
+        self._emit(session.message.forward(qtype.batch_msg,
+                                           {"query_id": session.query_id,
+                                            "request": session.request,
+                                            "outcomes": outcomes}))
+        if session.unresolved:
+            self.metrics.count(qtype.name, "no_match")
+            self._on_no_match(session)
+
+    def _update_leader(self, session: QuerySession) -> \
+            Tuple[Optional[dict], Optional[str]]:
+        """
+        Track the handler with the best reply to a query so far. Must be
+        called with the session's lock held.
+        @param session: QuerySession that received a reply
+        @returns: best reply if its handler became the leader, and skill ID
+            of the handler it overtook, if any
+        """
+        if not self.prepare_leader or session.batch is not None or \
+                session.dispatched_to or not session.best:
+            return None, None
+        leader = session.best["skill_id"]
+        if leader == session.prepared:
+            return None, None
+        overtaken = session.prepared
+        session.prepared = leader
+        return session.best, overtaken
+
+    def _emit_prepare(self, session: QuerySession, skill_id: str,
+                      skill_data: Optional[dict] = None,
+                      cancel: bool = False):
+        """
+        Hint a handler to prepare for, or stop preparing for, a dispatch.
+        @param session: QuerySession the handler is leading
+        @param skill_id: skill ID of the handler
+        @param skill_data: data the handler returned for this query
+        @param cancel: if True, the handler is no longer expected to be
+            dispatched
+        """
+        if cancel:
+            msg_type = "communication:prepare.cancel"
+            data = {"skill_id": skill_id, "query_id": session.query_id}
+            self.metrics.count(session.query_type, "prepare_cancelled")
+        else:
+            msg_type = "communication:prepare"
+            data = {"skill_id": skill_id, "query_id": session.query_id,
+                    "query_type": session.query_type,
+                    "request": session.request, "skill_data": skill_data}
+            self.metrics.count(session.query_type, "prepared")
+        self._emit(session.message.forward(msg_type, data))
+
+    def _match_contact(self, request: str,
+                       handlers: Set[str]) -> List[ContactMatch]:
+        """
+        Get indexed contacts confidently matching a requested contact.
+        @param request: requested contact
+        @param handlers: skill IDs of handlers that may serve the request
+        @returns: best match per handler, highest score first
+        """
+        return [match for match in self.contacts.match(request,
+                                                       self.contact_threshold)
+                if match.skill_id in handlers]
+
+    def _can_coalesce(self, session: QuerySession, now: float) -> bool:
+        """
+        Check if a repeated request may be attached to an earlier session
+        for the same request instead of starting another query.
+        @param session: earlier QuerySession for the same request
+        @param now: current monotonic time
+        @returns: True if the session is in flight, or was dispatched, within
+            `coalesce_window` seconds
+        """
+        if session.dispatched_at:
+            return now - session.dispatched_at < self.coalesce_window
+        return not session.resolved and \
+            now - session.created < self.coalesce_window
+
+    def _remove_session(self, session: QuerySession):
+        """
+        Stop tracking a session.
+        @param session: QuerySession to remove
+        """
+        with self.lock:
+            tracked = self.sessions.pop(session.query_id, None)
+            if self._request_sessions.get(session.request_key) is session:
+                del self._request_sessions[session.request_key]
+            if tracked:
+                self._recent[session.query_id] = (session, set())
+                while len(self._recent) > self.max_recent:
+                    self._recent.popitem(last=False)
+        if tracked:
+            self._release_slot((session.request_key[0], session.query_type))
+        self.store.remove(session.query_id)
+
+    def _release_slot(self, user_key: Tuple[str, str]):
+        """
+        Release an in-flight slot reserved by `start_query`.
+        @param user_key: tuple of user and query type name
+        """
+        with self.lock:
+            self._active[user_key[1]] -= 1
+            self._user_active[user_key] -= 1
+            if not self._user_active[user_key]:
+                del self._user_active[user_key]
+
+    def _merge_replies(self, session: QuerySession):
+        """
+        Add responses received by other instances to a session.
+        @param session: QuerySession owned by this instance
+        """
+        replies = self.store.get_replies(session.query_id)
+        with session.lock:
+            for data in replies:
+                skill_id = data.get("skill_id")
+                if not skill_id or not self._is_valid_response(data):
+                    continue
+                if data.get("declined"):
+                    session.add_decline(skill_id)
+                elif "searching" not in data:
+                    session.add_reply(data)
+
+    def _accepts_direct_dispatch(self, skill_id: str) -> bool:
+        """
+        Check if a registered handler accepts dispatch without a query.
+        @param skill_id: skill ID of the handler
+        @returns: True if the handler may be dispatched to directly
+        """
+        registration = self.registry.get(skill_id)
+        return bool(registration and registration.direct_dispatch)
+
+    def _promises_answer(self, skill_id: str) -> bool:
+        """
+        Check if a registered handler answers every query it is sent.
+        @param skill_id: skill ID of the handler
+        @returns: True if the handler registered with `ack`
+        """
+        registration = self.registry.get(skill_id)
+        return bool(registration and registration.ack)
+
+    def _rearm(self, session: QuerySession, timeout: float):
+        """
+        Replace the scheduled timeout for a session.
+        @param session: QuerySession to reschedule
+        @param timeout: seconds until the session should resolve
+        """
+        self._cancel(session)
+        self._schedule(session, timeout)
+
+    def _get_extension(self, session: QuerySession, skill_id: str,
+                       now: float) -> Optional[float]:
+        """
+        Get the time to extend a session by for a searching skill, within the
+        skill's and the session's extension budget. Must be called with the
+        session's lock held.
+        @param session: QuerySession the skill requested more time for
+        @param skill_id: skill requesting more time
+        @param now: current monotonic time
+        @returns: seconds until the session should resolve, or None if the
+            extension is denied
+        """
+        if self.circuits.is_open(skill_id):
+            return None
+        session.extension_counts[skill_id] += 1
+        if session.extension_counts[skill_id] > self.max_extensions:
+            LOG.info(f"{skill_id} exceeded extensions for {session}")
+            self._strike(session.query_type, skill_id)
+            return None
+        remaining = session.created + self.extension_budget - now
+        if remaining <= 0:
+            return None
+        return min(self.latency.get_extension_timeout(
+            session.query_type, skill_id,
+            self.query_types[session.query_type].extension_timeout),
+            remaining)
+
+    def _strike(self, query_type: str, skill_id: str):
+        """
+        Record a handler misbehaving, opening its breaker after repeated
+        strikes.
+        @param query_type: type of query the handler misbehaved on
+        @param skill_id: skill ID of the handler
+        """
+        self.metrics.count(query_type, "strikes")
+        if self.circuits.strike(skill_id):
+            LOG.warning(f"Opened circuit breaker for {skill_id} for "
+                        f"{self.circuits.cooldown}s")
+            self.metrics.count(query_type, "breakers_opened")
+
+    @staticmethod
+    def _is_valid_response(data: dict) -> bool:
+        """
+        Check that a handler response has valid types.
+        @param data: response message data
+        @returns: True if the response can be handled
+        """
+        def _valid_conf(value: dict) -> bool:
+            conf = value.get("conf", 0)
+            return isinstance(conf, (int, float)) and \
+                not isinstance(conf, bool)
+
+        replies = data.get("replies", [])
+        return _valid_conf(data) and isinstance(replies, list) and \
+            all(isinstance(reply, dict) and _valid_conf(reply)
+                for reply in replies)
+
+    def _end_extension(self, session: QuerySession, skill_id: str,
+                       timeout: float) -> Optional[float]:
+        """
+        Stop waiting on a skill that previously requested more time. Must be
+        called with the session's lock held.
+        @param session: QuerySession the skill replied to
+        @param skill_id: skill no longer searching
+        @param timeout: seconds to wait if no other skills are searching
+        @returns: seconds until the session should resolve if it changed
+        """
+        if skill_id in session.extensions:
+            session.extensions.discard(skill_id)
+            self.latency.record_search(
+                session.query_type, skill_id,
+                monotonic() - session.search_started[skill_id])
+            if not session.extensions:
+                return timeout
+        return None
@@ -0,0 +1,217 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Iterable, Optional, Tuple
+
+
+def normalize_contact(contact: Optional[str]) -> str:
+    """
+    Normalize a requested contact for use as a cache key.
+    @param contact: requested contact string
+    @returns: lowercase contact with punctuation and extra whitespace removed
+    """
+    if not contact:
+        return ""
+    contact = "".join(c for c in contact.lower()
+                      if c.isalnum() or c.isspace())
+    return " ".join(contact.split())
+
+
+class ResolutionCache:
+    """
+    Per-user LRU cache of the handler that resolved a query for a contact.
+    Entries expire `ttl` seconds after they are added.
+    """
+    def __init__(self, max_size: int = 256, ttl: float = 3600):
+        """
+        @param max_size: maximum number of cached resolutions
+        @param ttl: seconds until a cached resolution expires
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def get_key(user: Optional[str], query_type: str,
+                contact: str) -> Tuple[str, str, str]:
+        return user or "", query_type, normalize_contact(contact)
+
+    def get(self, user: Optional[str], query_type: str,
+            contact: str) -> Optional[dict]:
+        """
+        Get a cached resolution.
+        @param user: username associated with the request
+        @param query_type: type of query
+        @param contact: requested contact
+        @returns: dict with `skill_id` and `skill_data` if cached, else None
+        """
+        key = self.get_key(user, query_type, contact)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            if entry[0] < monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, user: Optional[str], query_type: str, contact: str,
+            skill_id: str, skill_data: Optional[dict]):
+        """
+        Cache the handler that resolved a query.
+        @param user: username associated with the request
+        @param query_type: type of query
+        @param contact: requested contact
+        @param skill_id: skill ID of the handler
+        @param skill_data: data the handler returned for this contact
+        """
+        key = self.get_key(user, query_type, contact)
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl,
+                                  {"skill_id": skill_id,
+                                   "skill_data": skill_data})
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user: Optional[str], query_type: str, contact: str,
+                   skill_id: Optional[str] = None) -> bool:
+        """
+        Remove a cached resolution.
+        @param user: username associated with the request
+        @param query_type: type of query
+        @param contact: requested contact
+        @param skill_id: only remove the entry if it resolved to this skill
+        @returns: True if an entry was removed
+        """
+        key = self.get_key(user, query_type, contact)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or (skill_id and entry[1]["skill_id"] != skill_id):
+                return False
+            del self._entries[key]
+            return True
+
+    def invalidate_skill(self, skill_id: str):
+        """
+        Remove all cached resolutions to a handler.
+        @param skill_id: skill ID of the handler
+        """
+        with self._lock:
+            for key in [k for k, v in self._entries.items()
+                        if v[1]["skill_id"] == skill_id]:
+                del self._entries[key]
+
+    def invalidate_query_types(self, query_types: Iterable[str]):
+        """
+        Remove all cached resolutions for the given query types.
+        @param query_types: types of query to remove entries for
+        """
+        query_types = set(query_types)
+        with self._lock:
+            for key in [k for k in self._entries if k[1] in query_types]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MissCache:
+    """
+    Per-user LRU cache of contacts that no handler could resolve, so repeat
+    requests can fail fast. Entries expire `ttl` seconds after they are added.
+    """
+    def __init__(self, max_size: int = 256, ttl: float = 30):
+        """
+        @param max_size: maximum number of cached misses
+        @param ttl: seconds until a cached miss expires; 0 disables caching
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user: Optional[str], query_type: str,
+            contact: str) -> bool:
+        """
+        Check if a contact recently failed to resolve.
+        @param user: username associated with the request
+        @param query_type: type of query
+        @param contact: requested contact
+        @returns: True if no handler resolved this contact within `ttl`
+        """
+        key = ResolutionCache.get_key(user, query_type, contact)
+        with self._lock:
+            expires = self._entries.get(key)
+            if not expires:
+                return False
+            if expires < monotonic():
+                del self._entries[key]
+                return False
+            return True
+
+    def put(self, user: Optional[str], query_type: str, contact: str):
+        """
+        Cache a contact that no handler resolved.
+        @param user: username associated with the request
+        @param query_type: type of query
+        @param contact: requested contact
+        """
+        if not self.ttl:
+            return
+        key = ResolutionCache.get_key(user, query_type, contact)
+        with self._lock:
+            self._entries[key] = monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_query_types(self, query_types: Iterable[str]):
+        """
+        Remove all cached misses for the given query types.
+        @param query_types: types of query to remove entries for
+        """
+        query_types = set(query_types)
+        with self._lock:
+            for key in [k for k in self._entries if k[1] in query_types]:
+                del self._entries[key]
+
+    def clear(self):
+        """
+        Remove all cached misses.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
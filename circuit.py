@@ -0,0 +1,117 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import Counter
+from threading import Lock
+from time import monotonic
+from typing import Dict
+
+
+class CircuitBreaker:
+    """
+    Per-skill circuit breaker for handlers that repeatedly misbehave, i.e.
+    time out, over-extend, or send malformed replies. A handler accumulates
+    strikes until it answers correctly; after `threshold` consecutive strikes
+    its breaker opens for `cooldown` seconds. Once the cooldown elapses the
+    breaker is half-open: the next answer closes it, and the next strike
+    opens it again.
+    """
+    def __init__(self, threshold: int = 3, cooldown: float = 300):
+        """
+        @param threshold: consecutive strikes that open a breaker
+        @param cooldown: seconds a breaker stays open
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._strikes: Counter = Counter()
+        self._opened: Dict[str, float] = dict()
+        self._lock = Lock()
+
+    def strike(self, skill_id: str) -> bool:
+        """
+        Record a handler misbehaving.
+        @param skill_id: skill ID of the handler
+        @returns: True if this opened the handler's breaker
+        """
+        now = monotonic()
+        with self._lock:
+            opened = self._opened.get(skill_id)
+            if opened is not None:
+                if now - opened < self.cooldown:
+                    return False
+                # Half-open; a single strike re-opens the breaker
+                self._opened[skill_id] = now
+                return True
+            self._strikes[skill_id] += 1
+            if self._strikes[skill_id] < self.threshold:
+                return False
+            del self._strikes[skill_id]
+            self._opened[skill_id] = now
+            return True
+
+    def success(self, skill_id: str):
+        """
+        Record a handler answering correctly.
+        @param skill_id: skill ID of the handler
+        """
+        with self._lock:
+            self._strikes.pop(skill_id, None)
+            opened = self._opened.get(skill_id)
+            if opened is not None and monotonic() - opened >= self.cooldown:
+                del self._opened[skill_id]
+
+    def is_open(self, skill_id: str) -> bool:
+        """
+        Check if a handler is in its cool-down period.
+        @param skill_id: skill ID of the handler
+        @returns: True if the handler's breaker is open
+        """
+        opened = self._opened.get(skill_id)
+        return opened is not None and monotonic() - opened < self.cooldown
+
+    def get_state(self, skill_id: str) -> str:
+        """
+        Get the state of a handler's breaker.
+        @param skill_id: skill ID of the handler
+        @returns: `closed`, `open`, or `half_open`
+        """
+        if skill_id not in self._opened:
+            return "closed"
+        return "open" if self.is_open(skill_id) else "half_open"
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        Get the state of every handler with strikes or an open breaker.
+        @returns: dict of skill ID to `state` and `strikes`
+        """
+        with self._lock:
+            skill_ids = set(self._strikes) | set(self._opened)
+            strikes = dict(self._strikes)
+        return {skill_id: {"state": self.get_state(skill_id),
+                           "strikes": strikes.get(skill_id, 0)}
+                for skill_id in sorted(skill_ids)}
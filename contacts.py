@@ -0,0 +1,236 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import Counter, defaultdict
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from ovos_utils.log import LOG
+
+from .cache import normalize_contact
+
+_SOUNDEX_CODES = {c: str(code) for code, letters in
+                  enumerate(("bfpv", "cgjkqsxz", "dt", "l", "mn", "r"),
+                            start=1) for c in letters}
+
+
+def get_trigrams(name: str) -> Set[str]:
+    """
+    Get character trigrams of a normalized name, padded at word boundaries.
+    @param name: normalized contact name
+    @returns: set of trigrams
+    """
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def get_phonetic_key(name: str) -> str:
+    """
+    Get a phonetic key for a normalized name by joining the Soundex codes of
+    each word.
+    @param name: normalized contact name
+    @returns: phonetic key string
+    """
+    keys = list()
+    for word in name.split():
+        code = word[0]
+        last = _SOUNDEX_CODES.get(word[0])
+        for char in word[1:]:
+            digit = _SOUNDEX_CODES.get(char)
+            if digit and digit != last:
+                code += digit
+            if char not in "hw":
+                last = digit
+        keys.append(f"{code}000"[:4])
+    return " ".join(keys)
+
+
+class ContactEntry:
+    """
+    A contact known to a handler skill.
+    """
+    __slots__ = ("skill_id", "name", "normalized", "data", "trigrams",
+                 "phonetic")
+
+    def __init__(self, skill_id: str, name: str, data: Optional[dict] = None):
+        self.skill_id = skill_id
+        self.name = name
+        self.normalized = normalize_contact(name)
+        self.data = data
+        self.trigrams = frozenset(get_trigrams(self.normalized))
+        self.phonetic = get_phonetic_key(self.normalized)
+
+
+class ContactMatch:
+    """
+    Best matching contact of one handler skill for a requested contact.
+    `phonetic` is True if the contact only matched by pronunciation, i.e.
+    it may be a different contact that sounds alike.
+    """
+    __slots__ = ("skill_id", "score", "entry", "phonetic")
+
+    def __init__(self, skill_id: str, score: float, entry: ContactEntry,
+                 phonetic: bool = False):
+        self.skill_id = skill_id
+        self.score = score
+        self.entry = entry
+        self.phonetic = phonetic
+
+    def __repr__(self):
+        return f"ContactMatch({self.skill_id}, {self.entry.name}, " \
+               f"{self.score:.2f})"
+
+
+class ContactIndex:
+    """
+    Index of contacts pushed by handler skills, scoring a requested contact
+    against every handler's contacts by exact name, character trigram
+    similarity and phonetic key.
+    """
+    def __init__(self, phonetic_score: float = 0.85):
+        """
+        @param phonetic_score: minimum score of a phonetic match
+        """
+        self.phonetic_score = phonetic_score
+        self._contacts: Dict[str, Dict[str, ContactEntry]] = dict()
+        self._trigrams: Dict[str, Set[Tuple[str, str]]] = defaultdict(set)
+        self._phonetic: Dict[str, Set[Tuple[str, str]]] = defaultdict(set)
+        self.direct_dispatch: Set[str] = set()
+        self._lock = Lock()
+
+    @property
+    def handlers(self) -> Set[str]:
+        """
+        Skill IDs of handlers that have pushed contacts
+        """
+        return set(self._contacts)
+
+    def update(self, skill_id: str,
+               contacts: Optional[Iterable[Union[str, dict]]] = None,
+               added: Optional[Iterable[Union[str, dict]]] = None,
+               removed: Optional[Iterable[str]] = None):
+        """
+        Update the contacts of a handler skill.
+        @param skill_id: skill ID of the handler
+        @param contacts: full snapshot of the handler's contacts, replacing
+            any previously indexed contacts
+        @param added: contacts to add or update
+        @param removed: names of contacts to remove
+        """
+        with self._lock:
+            if contacts is not None:
+                for normalized in list(self._contacts.get(skill_id, {})):
+                    self._remove(skill_id, normalized)
+                self._contacts[skill_id] = dict()
+                added = contacts
+            self._contacts.setdefault(skill_id, dict())
+            for name in removed or ():
+                if isinstance(name, str):
+                    self._remove(skill_id, normalize_contact(name))
+            for contact in added or ():
+                if isinstance(contact, str):
+                    contact = {"name": contact}
+                if not isinstance(contact, dict) or \
+                        not isinstance(contact.get("name"), str) or \
+                        not normalize_contact(contact["name"]):
+                    LOG.warning(f"Invalid contact from {skill_id}: {contact}")
+                    continue
+                self._add(ContactEntry(skill_id, contact["name"],
+                                       contact.get("data")))
+
+    def remove_handler(self, skill_id: str):
+        """
+        Remove all contacts of a handler skill.
+        @param skill_id: skill ID of the handler
+        """
+        with self._lock:
+            for normalized in list(self._contacts.get(skill_id, {})):
+                self._remove(skill_id, normalized)
+            self._contacts.pop(skill_id, None)
+            self.direct_dispatch.discard(skill_id)
+
+    def match(self, contact: str, min_score: float = 0.5) -> \
+            List[ContactMatch]:
+        """
+        Score a requested contact against all indexed contacts.
+        @param contact: requested contact
+        @param min_score: minimum score of returned matches
+        @returns: best match per handler, highest score first
+        """
+        normalized = normalize_contact(contact)
+        if not normalized:
+            return list()
+        trigrams = get_trigrams(normalized)
+        phonetic = get_phonetic_key(normalized)
+        best: Dict[str, ContactMatch] = dict()
+        with self._lock:
+            shared = Counter()
+            for trigram in trigrams:
+                for key in self._trigrams.get(trigram, ()):
+                    shared[key] += 1
+            phonetic_keys = self._phonetic.get(phonetic, set())
+            for key in set(shared) | phonetic_keys:
+                skill_id, entry_name = key
+                entry = self._contacts[skill_id][entry_name]
+                sounds_alike = False
+                if entry_name == normalized:
+                    score = 1.0
+                else:
+                    # Dice coefficient of trigram sets
+                    score = 2 * shared[key] / (len(trigrams) +
+                                               len(entry.trigrams))
+                    if key in phonetic_keys and score < self.phonetic_score:
+                        score = self.phonetic_score
+                        sounds_alike = True
+                if score >= min_score and \
+                        (skill_id not in best or score > best[skill_id].score):
+                    best[skill_id] = ContactMatch(skill_id, score, entry,
+                                                  sounds_alike)
+        return sorted(best.values(), key=lambda m: m.score, reverse=True)
+
+    def _add(self, entry: ContactEntry):
+        key = (entry.skill_id, entry.normalized)
+        if entry.normalized in self._contacts[entry.skill_id]:
+            self._remove(*key)
+        self._contacts[entry.skill_id][entry.normalized] = entry
+        for trigram in entry.trigrams:
+            self._trigrams[trigram].add(key)
+        self._phonetic[entry.phonetic].add(key)
+
+    def _remove(self, skill_id: str, normalized: str):
+        entry = self._contacts.get(skill_id, {}).pop(normalized, None)
+        if not entry:
+            return
+        key = (skill_id, normalized)
+        for trigram in entry.trigrams:
+            self._trigrams[trigram].discard(key)
+            if not self._trigrams[trigram]:
+                del self._trigrams[trigram]
+        self._phonetic[entry.phonetic].discard(key)
+        if not self._phonetic[entry.phonetic]:
+            del self._phonetic[entry.phonetic]
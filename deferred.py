@@ -0,0 +1,319 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import re
+
+from datetime import datetime
+from os import replace
+from os.path import isfile
+from threading import Event, Lock, Thread
+from time import time
+from typing import Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from lingua_franca.parse import extract_datetime
+from ovos_bus_client.message import Message
+from ovos_utils.log import LOG
+
+# A colon between digits is part of a clock time, not a separator
+_MESSAGE_BODY = re.compile(r"(?P<head>.+?)(?P<separator>\s+(?:saying|"
+                           r"that says|telling them)\s+|"
+                           r"\s*(?:(?<!\d):|:(?!\d))\s*)"
+                           r"(?P<message>.+)$", re.IGNORECASE)
+# An explicit time of day or a time relative to now, with an optional day
+_DELIVERY_TIME = re.compile(r"\s+(?P<time>(?:(?:today|tonight|tomorrow|"
+                            r"on\s+\w+day)\s+)?"
+                            r"(?:at\s+(?:\d{1,2}(?::\d{2})?(?:\s*(?:am|pm|"
+                            r"a\.m\.|p\.m\.|o'?clock))?|noon|midnight)|"
+                            r"in\s+(?:\d+|an?|a few)\s+"
+                            r"(?:minutes?|hours?|days?))"
+                            r"(?:\s+(?:today|tonight|tomorrow|"
+                            r"on\s+\w+day))?)(?=\s|$)", re.IGNORECASE)
+
+
+def extract_delivery_time(request: str, lang: str,
+                          now: Optional[datetime] = None) -> \
+        Tuple[Optional[datetime], str]:
+    """
+    Extract a requested delivery time from a message request. Only an
+    explicit time of day or relative time before the message body is
+    considered, so times in the message itself, and dates or names such as
+    `May` alone, are not mistaken for a delivery time.
+    @param request: message request (i.e. `message Bob at 5 pm saying hi`)
+    @param lang: language of the request
+    @param now: current time, default now
+    @returns: delivery time if one was requested in the future, and the
+        request with the delivery time removed
+    """
+    match = _MESSAGE_BODY.match(request)
+    if not match:
+        return None, request
+    head = match.group("head")
+    time_match = _DELIVERY_TIME.search(head)
+    if not time_match:
+        return None, request
+    now = now or datetime.now().astimezone()
+    extracted = extract_datetime(time_match.group("time"), now, lang=lang)
+    if not extracted or extracted[0] <= now:
+        return None, request
+    head = f"{head[:time_match.start()]}{head[time_match.end():]}"
+    return extracted[0], f"{head}{match.group('separator')}" \
+                         f"{match.group('message')}"
+
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel. Each level has a fixed number of slots, each
+    spanning the whole of the level below; timers are placed in the lowest
+    level that spans their deadline and move down a level when the wheel
+    reaches their slot, so adding and expiring a timer is O(1) regardless of
+    how many timers are pending. Deadlines beyond the highest level are
+    kept in an overflow list that is re-checked each time the highest level
+    advances.
+    """
+    def __init__(self, now: float, tick: float = 1,
+                 slots: Tuple[int, ...] = (60, 60, 24)):
+        """
+        @param now: current time in seconds
+        @param tick: seconds per slot of the lowest level
+        @param slots: number of slots in each level, lowest first
+        """
+        self.tick = tick
+        self._slots = slots
+        self._units = [1]
+        for count in slots[:-1]:
+            self._units.append(self._units[-1] * count)
+        self._spans = [unit * count for unit, count in zip(self._units,
+                                                           slots)]
+        self._levels = [[list() for _ in range(count)] for count in slots]
+        self._overflow = list()
+        self._current = int(now // tick)
+
+    def add(self, deadline: float, item) -> bool:
+        """
+        Add a timer.
+        @param deadline: time in seconds the timer expires
+        @param item: value to return when the timer expires
+        @returns: False if the deadline has already passed
+        """
+        # Round up so timers never expire early
+        return self._insert(int(-(-deadline // self.tick)), item)
+
+    def advance(self, now: float) -> list:
+        """
+        Advance the wheel to the current time.
+        @param now: current time in seconds
+        @returns: items of all timers that expired since the last advance
+        """
+        due = list()
+        target = int(now // self.tick)
+        while self._current < target:
+            self._current += 1
+            # Cascade higher levels first so their timers can expire now
+            for level in range(len(self._slots) - 1, 0, -1):
+                if self._current % self._units[level]:
+                    continue
+                if level == len(self._slots) - 1:
+                    overflow, self._overflow = self._overflow, list()
+                    for deadline, item in overflow:
+                        self._insert(deadline, item, due)
+                slot = self._levels[level][(self._current //
+                                            self._units[level]) %
+                                           self._slots[level]]
+                entries = list(slot)
+                slot.clear()
+                for deadline, item in entries:
+                    self._insert(deadline, item, due)
+            slot = self._levels[0][self._current % self._slots[0]]
+            due.extend(item for _, item in slot)
+            slot.clear()
+        return due
+
+    def _insert(self, deadline: int, item, due: Optional[list] = None) -> \
+            bool:
+        delta = deadline - self._current
+        if delta <= 0:
+            if due is not None:
+                due.append(item)
+            return False
+        for level, span in enumerate(self._spans):
+            if delta < span:
+                self._levels[level][(deadline // self._units[level]) %
+                                    self._slots[level]].append((deadline,
+                                                                item))
+                return True
+        self._overflow.append((deadline, item))
+        return True
+
+
+class DeferredQueue:
+    """
+    Dispatch messages resolved ahead of their delivery time. Pending
+    messages are kept in a `TimerWheel` advanced by a single thread, and in
+    an append-only journal so they survive restarts. Messages that come due
+    in the same tick are delivered in one batch.
+    """
+    def __init__(self, on_due: Callable[[List[Message]], None],
+                 journal_path: Optional[str] = None, tick: float = 1):
+        """
+        @param on_due: callback with messages that are due for delivery
+        @param journal_path: file to persist pending messages to
+        @param tick: seconds between checks for due messages
+        """
+        self._on_due = on_due
+        self.journal_path = journal_path
+        self.tick = tick
+        self._pending: Dict[str, Tuple[float, Message]] = dict()
+        self._wheel = TimerWheel(time(), tick)
+        self._journal = None
+        self._lock = Lock()
+        self._stopping = Event()
+        self._thread: Optional[Thread] = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        """
+        Load pending messages from the journal and start delivering them.
+        """
+        if self._thread:
+            return
+        if self.journal_path:
+            self._load()
+        self._thread = Thread(target=self._run, daemon=True,
+                              name="DeferredDelivery")
+        self._thread.start()
+
+    def shutdown(self):
+        """
+        Stop delivering messages. Pending messages remain in the journal.
+        """
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+        with self._lock:
+            if self._journal:
+                self._journal.close()
+                self._journal = None
+
+    def add(self, deliver_at: float, message: Message) -> str:
+        """
+        Add a message to deliver later.
+        @param deliver_at: epoch time to deliver the message at
+        @param message: Message to emit at `deliver_at`
+        @returns: ID of the pending delivery
+        """
+        send_id = str(uuid4())
+        with self._lock:
+            self._pending[send_id] = (deliver_at, message)
+            self._schedule(send_id, deliver_at)
+            self._write([{"op": "add", "id": send_id, "at": deliver_at,
+                          "msg": message.serialize()}])
+        return send_id
+
+    def advance(self, now: Optional[float] = None) -> List[Message]:
+        """
+        Remove and return messages that are due for delivery.
+        @param now: current epoch time, default now
+        @returns: Messages due for delivery
+        """
+        with self._lock:
+            due = [send_id for send_id in self._wheel.advance(now or time())
+                   if send_id in self._pending]
+            messages = [self._pending.pop(send_id)[1] for send_id in due]
+            if due:
+                self._write([{"op": "done", "id": send_id}
+                             for send_id in due])
+        return messages
+
+    def _schedule(self, send_id: str, deliver_at: float):
+        """
+        Add a pending message to the wheel. Must be called with the lock held.
+        """
+        if not self._wheel.add(deliver_at, send_id):
+            # Already due; deliver on the next tick
+            self._wheel.add(time() + self.tick, send_id)
+
+    def _run(self):
+        while not self._stopping.wait(self.tick - time() % self.tick):
+            messages = self.advance()
+            if not messages:
+                continue
+            LOG.info(f"Delivering {len(messages)} deferred messages")
+            try:
+                self._on_due(messages)
+            except Exception as e:
+                LOG.exception(f"Failed to deliver deferred messages: {e}")
+
+    def _write(self, entries: List[dict]):
+        """
+        Append entries to the journal. Must be called with the lock held.
+        """
+        if not self._journal:
+            return
+        try:
+            self._journal.write("".join(json.dumps(entry) + "\n"
+                                        for entry in entries))
+            self._journal.flush()
+        except OSError as e:
+            LOG.error(f"Failed to write deferred delivery journal: {e}")
+
+    def _load(self):
+        """
+        Read pending messages from the journal and compact it so it only
+        contains pending messages.
+        """
+        pending = dict()
+        if isfile(self.journal_path):
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partial line from an interrupted write
+                        continue
+                    if entry["op"] == "add":
+                        pending[entry["id"]] = entry
+                    else:
+                        pending.pop(entry["id"], None)
+        tmp_path = f"{self.journal_path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("".join(json.dumps(entry) + "\n"
+                            for entry in pending.values()))
+        replace(tmp_path, self.journal_path)
+        with self._lock:
+            for send_id, entry in pending.items():
+                self._pending[send_id] = (entry["at"],
+                                          Message.deserialize(entry["msg"]))
+                self._schedule(send_id, entry["at"])
+            self._journal = open(self.journal_path, "a")
+        if pending:
+            LOG.info(f"Loaded {len(pending)} deferred messages")
@@ -0,0 +1,195 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from bisect import bisect_left
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+def _bucket_bounds(minimum: float = 0.01, maximum: float = 30,
+                   factor: float = 1.25) -> List[float]:
+    """
+    Get geometrically spaced histogram bucket upper bounds in seconds.
+    """
+    bounds = [minimum]
+    while bounds[-1] < maximum:
+        bounds.append(round(bounds[-1] * factor, 4))
+    return bounds
+
+
+BUCKET_BOUNDS = _bucket_bounds()
+
+
+class LatencyHistogram:
+    """
+    Compact rolling histogram of latencies. Samples are counted in fixed
+    buckets; once `window` samples are recorded, older samples are dropped
+    by rotating the current counts into a single previous generation.
+    """
+    def __init__(self, window: int = 100):
+        """
+        @param window: number of samples per generation
+        """
+        self.window = window
+        self._current = [0] * (len(BUCKET_BOUNDS) + 1)
+        self._previous = [0] * (len(BUCKET_BOUNDS) + 1)
+        self._current_count = 0
+
+    @property
+    def count(self) -> int:
+        return self._current_count + sum(self._previous)
+
+    def record(self, latency: float):
+        """
+        Record a latency sample.
+        @param latency: observed latency in seconds
+        """
+        if self._current_count >= self.window:
+            self._previous = self._current
+            self._current = [0] * (len(BUCKET_BOUNDS) + 1)
+            self._current_count = 0
+        self._current[bisect_left(BUCKET_BOUNDS, latency)] += 1
+        self._current_count += 1
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """
+        Get an upper bound for the given percentile of recorded latencies.
+        @param pct: percentile to get (0-100)
+        @returns: bucket upper bound in seconds, None if there are no samples
+        """
+        total = self.count
+        if not total:
+            return None
+        target = total * pct / 100
+        cumulative = 0
+        for idx, (cur, prev) in enumerate(zip(self._current,
+                                              self._previous)):
+            cumulative += cur + prev
+            if cumulative >= target:
+                break
+        return BUCKET_BOUNDS[min(idx, len(BUCKET_BOUNDS) - 1)]
+
+
+class LatencyTracker:
+    """
+    Tracks handler response latency per query type and skill and derives
+    query wait windows from the p95 latency of the handlers involved.
+    """
+    def __init__(self, min_timeout: float = 0.2, max_timeout: float = 3,
+                 max_extension_timeout: float = 10, min_samples: int = 5,
+                 percentile: float = 95, window: int = 100):
+        """
+        @param min_timeout: minimum seconds to wait for handlers to reply
+        @param max_timeout: maximum seconds to wait for handlers to reply
+        @param max_extension_timeout: maximum seconds to wait for a handler
+            that is still searching
+        @param min_samples: samples required before a handler's latency is
+            used instead of the default timeout
+        @param percentile: latency percentile to wait for
+        @param window: samples per histogram generation
+        """
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_extension_timeout = max_extension_timeout
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.window = window
+        self._replies: Dict[Tuple[str, str], LatencyHistogram] = dict()
+        self._searches: Dict[Tuple[str, str], LatencyHistogram] = dict()
+        self._lock = Lock()
+
+    def record_reply(self, query_type: str, skill_id: str, latency: float):
+        """
+        Record the time a handler took to first answer a query.
+        @param query_type: type of query
+        @param skill_id: skill ID of the handler
+        @param latency: seconds from the query to the handler's answer
+        """
+        self._record(self._replies, query_type, skill_id, latency)
+
+    def record_search(self, query_type: str, skill_id: str, latency: float):
+        """
+        Record the time a handler took to complete an extended search.
+        @param query_type: type of query
+        @param skill_id: skill ID of the handler
+        @param latency: seconds from the handler's extension to its reply
+        """
+        self._record(self._searches, query_type, skill_id, latency)
+
+    def get_timeout(self, query_type: str, skill_ids: Iterable[str],
+                    default: float) -> float:
+        """
+        Get the time to wait for the given handlers to answer a query.
+        @param query_type: type of query
+        @param skill_ids: skill IDs of handlers expected to answer
+        @param default: timeout to use if any handler has too few samples
+        @returns: seconds to wait for handlers to reply
+        """
+        timeout = self._get_p95(self._replies, query_type, skill_ids)
+        if timeout is None:
+            return default
+        return min(max(timeout, self.min_timeout), self.max_timeout)
+
+    def get_extension_timeout(self, query_type: str, skill_id: str,
+                              default: float) -> float:
+        """
+        Get the time to wait for a handler that is still searching.
+        @param query_type: type of query
+        @param skill_id: skill ID of the searching handler
+        @param default: timeout to use if the handler has too few samples
+        @returns: seconds to wait for the handler to reply
+        """
+        timeout = self._get_p95(self._searches, query_type, [skill_id])
+        if timeout is None:
+            return default
+        return min(max(timeout, self.min_timeout), self.max_extension_timeout)
+
+    def _record(self, histograms: Dict[Tuple[str, str], LatencyHistogram],
+                query_type: str, skill_id: str, latency: float):
+        with self._lock:
+            key = (query_type, skill_id)
+            if key not in histograms:
+                histograms[key] = LatencyHistogram(self.window)
+            histograms[key].record(latency)
+
+    def _get_p95(self, histograms: Dict[Tuple[str, str], LatencyHistogram],
+                 query_type: str, skill_ids: Iterable[str]) -> Optional[float]:
+        """
+        Get the highest latency percentile of the given handlers.
+        @returns: latency in seconds, None if any handler lacks samples
+        """
+        timeout = None
+        with self._lock:
+            for skill_id in skill_ids:
+                histogram = histograms.get((query_type, skill_id))
+                if not histogram or histogram.count < self.min_samples:
+                    return None
+                latency = histogram.percentile(self.percentile)
+                timeout = latency if timeout is None else max(timeout,
+                                                              latency)
+        return timeout
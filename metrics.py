@@ -0,0 +1,168 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import Counter
+from os import replace
+from threading import Lock
+from time import monotonic
+from typing import Dict, Tuple
+
+from .latency import LatencyHistogram
+from .session import QuerySession
+
+PHASES = ("broadcast", "first_reply", "extension", "resolved", "dispatched")
+
+
+class QueryMetrics:
+    """
+    Counters and per-phase latency for query sessions. Phase latencies are
+    measured from the time the session was created (when the intent was
+    received). All methods return immediately when disabled.
+    """
+    def __init__(self, enabled: bool = False):
+        """
+        @param enabled: if True, collect metrics
+        """
+        self.enabled = enabled
+        self._counters: Counter = Counter()
+        self._phases: Dict[Tuple[str, str], LatencyHistogram] = dict()
+        self._outcomes: Counter = Counter()
+        self._lock = Lock()
+
+    def count(self, query_type: str, name: str, value: int = 1):
+        """
+        Increment a counter.
+        @param query_type: type of query the counter applies to
+        @param name: name of the counter (i.e. `timeouts`)
+        @param value: amount to increment the counter by
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[(query_type, name)] += value
+
+    def handler_outcome(self, query_type: str, skill_id: str, outcome: str):
+        """
+        Count the outcome of dispatching a query to a handler.
+        @param query_type: type of query that was dispatched
+        @param skill_id: skill ID of the handler
+        @param outcome: `success`, `failed`, `timeout`, or `assumed` if the
+            handler does not report results
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._outcomes[(query_type, skill_id, outcome)] += 1
+
+    def phase(self, session: QuerySession, phase: str, once: bool = False):
+        """
+        Record the time a session reached a phase.
+        @param session: QuerySession that reached the phase
+        @param phase: name of the phase (one of `PHASES`)
+        @param once: if True, only record the first time a session reaches
+            this phase
+        """
+        if not self.enabled:
+            return
+        if once:
+            if phase in session.phases:
+                return
+            session.phases.add(phase)
+        latency = monotonic() - session.created
+        key = (session.query_type, phase)
+        with self._lock:
+            if key not in self._phases:
+                self._phases[key] = LatencyHistogram()
+            self._phases[key].record(latency)
+            self._counters[(session.query_type, f"{phase}_total")] += 1
+
+    def snapshot(self) -> dict:
+        """
+        Get current metric values.
+        @returns: dict of `counters`, `phases`, and handler `outcomes` by
+            query type
+        """
+        snapshot = {"enabled": self.enabled, "counters": dict(),
+                    "phases": dict(), "outcomes": dict()}
+        with self._lock:
+            for (query_type, name), value in self._counters.items():
+                snapshot["counters"].setdefault(query_type, dict())[name] = \
+                    value
+            for (query_type, phase), histogram in self._phases.items():
+                snapshot["phases"].setdefault(query_type, dict())[phase] = {
+                    "p50": histogram.percentile(50),
+                    "p95": histogram.percentile(95),
+                    "samples": histogram.count}
+            for (query_type, skill_id, outcome), value in \
+                    self._outcomes.items():
+                snapshot["outcomes"].setdefault(query_type, dict()) \
+                    .setdefault(skill_id, dict())[outcome] = value
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        """
+        Format current metric values in the Prometheus text exposition format.
+        @returns: string metrics
+        """
+        snapshot = self.snapshot()
+        lines = ["# TYPE neon_communication_events_total counter"]
+        for query_type, counters in sorted(snapshot["counters"].items()):
+            for name, value in sorted(counters.items()):
+                lines.append(f'neon_communication_events_total{{'
+                             f'query_type="{query_type}",event="{name}"}} '
+                             f'{value}')
+        lines.append("# TYPE neon_communication_phase_seconds summary")
+        for query_type, phases in sorted(snapshot["phases"].items()):
+            for phase, values in sorted(phases.items()):
+                labels = f'query_type="{query_type}",phase="{phase}"'
+                for quantile in ("p50", "p95"):
+                    lines.append(f'neon_communication_phase_seconds{{'
+                                 f'{labels},quantile="0.{quantile[1:]}"}} '
+                                 f'{values[quantile]}')
+        lines.append("# TYPE neon_communication_handler_outcomes_total "
+                     "counter")
+        for query_type, handlers in sorted(snapshot["outcomes"].items()):
+            for skill_id, outcomes in sorted(handlers.items()):
+                for outcome, value in sorted(outcomes.items()):
+                    lines.append(f'neon_communication_handler_outcomes_total{{'
+                                 f'query_type="{query_type}",'
+                                 f'skill_id="{skill_id}",'
+                                 f'outcome="{outcome}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        """
+        Write metrics to a file for collection by a Prometheus node exporter.
+        @param path: file path to write
+        """
+        if not self.enabled:
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        replace(tmp_path, path)
@@ -0,0 +1,162 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+
+from collections import OrderedDict
+from os import replace
+from os.path import isfile
+from threading import Lock
+from typing import Dict, List, Optional
+
+from ovos_utils.log import LOG
+
+from .cache import normalize_contact
+
+
+class HandlerPriors:
+    """
+    Persisted history of which handler each user's queries were dispatched
+    to, and whether the handler succeeded. Used to rank replies with equal
+    confidence, preferring the handler that succeeded for the same contact,
+    or for the same user and query type if the contact is new. The history
+    file is read the first time it is needed and written by `save`.
+    """
+    def __init__(self, path: Optional[str] = None, weight: float = 0,
+                 max_entries: int = 1000):
+        """
+        @param path: JSON file to persist history to, or None to keep it in
+            memory only
+        @param weight: amount of confidence a handler's prior success rate
+            adds to or removes from its replies; 0 only breaks ties
+        @param max_entries: maximum number of users and contacts to keep
+            history for
+        """
+        self.path = path
+        self.weight = weight
+        self.max_entries = max_entries
+        self._entries: Optional[OrderedDict] = None
+        self._dirty = False
+        self._lock = Lock()
+
+    @staticmethod
+    def get_key(user: Optional[str], query_type: str,
+                contact: Optional[str] = None) -> str:
+        return f"{user or ''}|{query_type}|{normalize_contact(contact)}"
+
+    def record(self, user: Optional[str], query_type: str,
+               contact: Optional[str], skill_id: str, success: bool):
+        """
+        Record the outcome of dispatching a query to a handler.
+        @param user: username associated with the request
+        @param query_type: type of query
+        @param contact: requested contact, or None if not a contact query
+        @param skill_id: skill ID of the dispatched handler
+        @param success: True if the handler succeeded
+        """
+        keys = {self.get_key(user, query_type),
+                self.get_key(user, query_type, contact)}
+        with self._lock:
+            entries = self._load()
+            for key in keys:
+                counts = entries.setdefault(key, dict()).setdefault(skill_id,
+                                                                    [0, 0])
+                counts[0 if success else 1] += 1
+                entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._dirty = True
+
+    def get_scores(self, user: Optional[str], query_type: str,
+                   contact: Optional[str] = None) -> Dict[str, float]:
+        """
+        Get the prior success rate of handlers for a query.
+        @param user: username associated with the request
+        @param query_type: type of query
+        @param contact: requested contact, or None if not a contact query
+        @returns: dict of skill ID to success rate between 0 and 1
+        """
+        with self._lock:
+            entries = self._load()
+            history = entries.get(self.get_key(user, query_type, contact)) \
+                or entries.get(self.get_key(user, query_type)) or dict()
+            # Laplace smoothing so a single outcome is not decisive
+            return {skill_id: (success + 1) / (success + failure + 2)
+                    for skill_id, (success, failure) in history.items()}
+
+    def rank(self, user: Optional[str], query_type: str,
+             contact: Optional[str], replies: List[dict]) -> List[dict]:
+        """
+        Rank replies to a query by confidence, adjusted by `weight`, and then
+        by the prior success rate of their handlers.
+        @param user: username associated with the request
+        @param query_type: type of query
+        @param contact: requested contact, or None if not a contact query
+        @param replies: handler replies to the query
+        @returns: replies, best first
+        """
+        scores = self.get_scores(user, query_type, contact)
+
+        def _score(reply: dict):
+            prior = scores.get(reply["skill_id"], 0.5)
+            return reply.get("conf", 0) + self.weight * (prior - 0.5), prior
+
+        return sorted(replies, key=_score, reverse=True)
+
+    def save(self):
+        """
+        Write history to `path` if it changed since it was loaded.
+        """
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            data = json.dumps(self._entries)
+            self._dirty = False
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(data)
+            replace(tmp_path, self.path)
+        except OSError as e:
+            LOG.error(f"Failed to save handler priors: {e}")
+            self._dirty = True
+
+    def _load(self) -> OrderedDict:
+        """
+        Get history, reading it from `path` on first use. Must be called with
+        the lock held.
+        """
+        if self._entries is None:
+            self._entries = OrderedDict()
+            if self.path and isfile(self.path):
+                try:
+                    with open(self.path) as f:
+                        self._entries.update(json.load(f))
+                except (OSError, ValueError) as e:
+                    LOG.error(f"Failed to load handler priors: {e}")
+        return self._entries
@@ -0,0 +1,120 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+
+from os import rename
+from os.path import getsize, isfile
+from threading import Lock
+from time import monotonic
+from typing import Iterator
+
+from ovos_bus_client.message import Message
+from ovos_utils.log import LOG
+
+
+class BusRecorder:
+    """
+    Append-only JSONL log of the messages and timer events that drive query
+    sessions, with monotonic timestamps, for offline replay. The log is
+    rotated when it reaches `max_bytes`, keeping `backups` older files as
+    `<path>.1` (newest) to `<path>.<backups>`.
+    """
+    def __init__(self, path: str, max_bytes: int = 10_000_000,
+                 backups: int = 3):
+        """
+        @param path: file to append events to
+        @param max_bytes: size at which the file is rotated
+        @param backups: number of rotated files to keep
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = Lock()
+        self._file = open(path, "a")
+        self._size = getsize(path)
+
+    def record(self, kind: str, message: Message, **kwargs):
+        """
+        Append an event to the log.
+        @param kind: `in` for handled messages, `out` for emitted messages,
+            `start` for started queries, or `timeout` for session timeouts
+        @param message: Message associated with the event
+        @param kwargs: additional values to record with the event
+        """
+        line = json.dumps({"t": round(monotonic(), 6), "kind": kind,
+                           "type": message.msg_type, "data": message.data,
+                           "context": message.context, **kwargs},
+                          separators=(",", ":"), default=str) + "\n"
+        with self._lock:
+            if not self._file:
+                return
+            try:
+                if self._size + len(line) > self.max_bytes:
+                    self._rotate()
+                self._file.write(line)
+                self._file.flush()
+                self._size += len(line)
+            except OSError as e:
+                LOG.error(f"Failed to record {kind} event: {e}")
+
+    def close(self):
+        """
+        Close the log file. Further events are discarded.
+        """
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def _rotate(self):
+        """
+        Move the current file to `<path>.1`, shifting older files. Must be
+        called with the lock held.
+        """
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if isfile(f"{self.path}.{i}"):
+                rename(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            rename(self.path, f"{self.path}.1")
+        self._file = open(self.path, "w")
+        self._size = 0
+
+
+def read_recording(*paths: str) -> Iterator[dict]:
+    """
+    Read events from recorded log files.
+    @param paths: files to read, oldest first
+    @returns: iterator of recorded events
+    """
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
@@ -0,0 +1,195 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional, Set
+
+from ovos_utils.log import LOG
+
+
+def get_contact_type(contact: Optional[str]) -> Optional[str]:
+    """
+    Get the type of a requested contact.
+    @param contact: requested contact string
+    @returns: `number` for phone numbers, `name` for other contacts
+    """
+    if not contact:
+        return None
+    stripped = contact.replace(" ", "").replace("-", "").replace("(", "")\
+        .replace(")", "").lstrip("+")
+    return "number" if stripped.isdigit() else "name"
+
+
+class HandlerRegistration:
+    """
+    Capabilities announced by a call or message handler skill.
+    """
+    def __init__(self, skill_id: str, query_types: List[str],
+                 contact_types: Optional[List[str]] = None,
+                 langs: Optional[List[str]] = None,
+                 direct_dispatch: bool = False, ttl: float = 300,
+                 ack: bool = False):
+        """
+        @param skill_id: skill ID of the handler
+        @param query_types: query types the handler serves (i.e. `call`)
+        @param contact_types: contact types the handler supports (default any)
+        @param langs: languages the handler supports (default any)
+        @param direct_dispatch: if True, the handler accepts a dispatch
+            without first being queried when it is the only eligible handler
+        @param ttl: seconds until this registration expires unless refreshed
+        @param ack: if True, the handler reports the result of every dispatch
+            and is considered failed if it does not
+        """
+        self.skill_id = skill_id
+        self.query_types = set(query_types)
+        self.contact_types = set(contact_types or ())
+        self.langs = {lang.lower().split('-')[0] for lang in langs or ()}
+        self.direct_dispatch = direct_dispatch
+        self.ttl = ttl
+        self.ack = ack
+        self.last_seen = monotonic()
+
+    @property
+    def expired(self) -> bool:
+        return monotonic() - self.last_seen > self.ttl
+
+    def supports(self, query_type: str, lang: Optional[str] = None,
+                 contact_type: Optional[str] = None) -> bool:
+        """
+        Check if this handler can serve a query.
+        @param query_type: type of query
+        @param lang: language of the request
+        @param contact_type: type of requested contact, if known
+        @returns: True if this handler is eligible for the query
+        """
+        if query_type not in self.query_types:
+            return False
+        if lang and self.langs and lang.lower().split('-')[0] \
+                not in self.langs:
+            return False
+        if contact_type and self.contact_types and \
+                contact_type not in self.contact_types:
+            return False
+        return True
+
+
+class HandlerRegistry:
+    """
+    Tracks handler skills that have registered their capabilities via
+    `communication:register`. Registrations expire unless refreshed by a
+    heartbeat (repeated registration) within their TTL.
+    """
+    def __init__(self, default_ttl: float = 300):
+        """
+        @param default_ttl: seconds until a registration expires if the
+            handler does not specify a TTL
+        """
+        self.default_ttl = default_ttl
+        self._handlers: Dict[str, HandlerRegistration] = dict()
+        self._lock = Lock()
+
+    def register(self, data: dict) -> Optional[HandlerRegistration]:
+        """
+        Register or refresh a handler from `communication:register` data.
+        @param data: registration message data
+        @returns: HandlerRegistration if the data was valid, else None
+        """
+        skill_id = data.get("skill_id")
+        query_types = data.get("query_types")
+        if not skill_id or not query_types:
+            LOG.warning(f"Invalid handler registration: {data}")
+            return None
+        registration = HandlerRegistration(
+            skill_id, query_types, data.get("contact_types"),
+            data.get("langs"), data.get("direct_dispatch", False),
+            data.get("ttl") or self.default_ttl, data.get("ack", False))
+        with self._lock:
+            new = skill_id not in self._handlers
+            self._handlers[skill_id] = registration
+        if new:
+            LOG.info(f"Registered handler: {skill_id}")
+        return registration
+
+    def deregister(self, skill_id: str) -> bool:
+        """
+        Remove a handler from the registry.
+        @param skill_id: skill ID of the handler
+        @returns: True if the handler was registered
+        """
+        with self._lock:
+            return self._handlers.pop(skill_id, None) is not None
+
+    def prune(self) -> Set[str]:
+        """
+        Remove expired registrations.
+        @returns: skill IDs of removed handlers
+        """
+        with self._lock:
+            expired = {skill_id for skill_id, handler in self._handlers.items()
+                       if handler.expired}
+            for skill_id in expired:
+                LOG.info(f"Handler registration expired: {skill_id}")
+                self._handlers.pop(skill_id)
+        return expired
+
+    def get(self, skill_id: str) -> Optional[HandlerRegistration]:
+        """
+        Get the registration for a handler.
+        @param skill_id: skill ID of the handler
+        @returns: HandlerRegistration if registered and not expired
+        """
+        handler = self._handlers.get(skill_id)
+        if handler and not handler.expired:
+            return handler
+        return None
+
+    def registered(self, query_type: str) -> Set[str]:
+        """
+        Get all registered handlers for a query type.
+        @param query_type: type of query
+        @returns: skill IDs of registered handlers
+        """
+        with self._lock:
+            return {skill_id for skill_id, handler in self._handlers.items()
+                    if query_type in handler.query_types
+                    and not handler.expired}
+
+    def eligible(self, query_type: str, lang: Optional[str] = None,
+                 contact_type: Optional[str] = None) -> Set[str]:
+        """
+        Get registered handlers able to serve a query.
+        @param query_type: type of query
+        @param lang: language of the request
+        @param contact_type: type of requested contact, if known
+        @returns: skill IDs of eligible handlers
+        """
+        with self._lock:
+            return {skill_id for skill_id, handler in self._handlers.items()
+                    if handler.supports(query_type, lang, contact_type)
+                    and not handler.expired}
@@ -0,0 +1,203 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import Counter
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional, Set
+from sys import getsizeof
+from uuid import uuid4
+
+from ovos_bus_client.message import Message
+
+
+def estimate_size(data, depth: int = 3) -> int:
+    """
+    Estimate the memory used by response data.
+    @param data: object to estimate the size of
+    @param depth: levels of nested containers to include
+    @returns: approximate size in bytes
+    """
+    size = getsizeof(data)
+    if depth <= 0:
+        return size
+    if isinstance(data, dict):
+        size += sum(estimate_size(k, depth - 1) + estimate_size(v, depth - 1)
+                    for k, v in data.items())
+    elif isinstance(data, (list, tuple, set)):
+        size += sum(estimate_size(v, depth - 1) for v in data)
+    return size
+
+
+class QuerySession:
+    """
+    State for a single in-flight call or message query. Each session is
+    identified by a unique `query_id` which is sent with the request and
+    echoed back by handler skills in their responses. Session state should
+    only be modified while holding `lock`.
+    """
+    def __init__(self, query_type: str, request: str, message: Message,
+                 query_id: Optional[str] = None,
+                 expected: Optional[Set[str]] = None, timeout: float = 1,
+                 batch: Optional[List[dict]] = None):
+        """
+        @param query_type: type of query (i.e. `call`, `message`)
+        @param request: requested contact or message string
+        @param message: Message that triggered this query
+        @param query_id: optional unique ID for this query
+        @param expected: skill IDs of handlers expected to answer this query
+        @param timeout: seconds to wait for handlers to answer this query
+        @param batch: optional sub-requests, each with a unique `recipient`,
+            to be resolved and dispatched independently
+        """
+        self.query_id = query_id or str(uuid4())
+        self.query_type = query_type
+        self.request = request
+        self.message = message
+        self.timeout = timeout
+        self.priority = 1
+        self.extensions: Set[str] = set()
+        self.extension_counts: Counter = Counter()
+        self.search_started: Dict[str, float] = dict()
+        self.responders: Set[str] = set()
+        self.declined: Set[str] = set()
+        self.expected: Set[str] = set(expected or ())
+        self.pending: Set[str] = set(self.expected)
+        self.best: Optional[dict] = None
+        self.replies: List[dict] = list()
+        self.fallbacks: List[dict] = list()
+        self.awaiting_ack: Optional[str] = None
+        self.dispatched_to: Optional[str] = None
+        self.dispatched_at: Optional[float] = None
+        self.prepared: Optional[str] = None
+        self.request_key: Optional[tuple] = None
+        self.phases: Set[str] = set()
+        self.ties: list = list()
+        self.batch = batch
+        self.deliver_at: Optional[float] = None
+        self.batch_best: Dict[str, dict] = dict()
+        self.unresolved: List[str] = list()
+        self.reply_bytes = 0
+        self.created = monotonic()
+        self.deadline = self.created + timeout
+        self.resolved = False
+        self.lock = Lock()
+
+    @property
+    def reply_count(self) -> int:
+        """
+        Number of handler skills that have replied to this query
+        """
+        return len(self.responders)
+
+    @property
+    def complete(self) -> bool:
+        """
+        True if every expected handler has replied or declined and no
+        handlers are still searching
+        """
+        return bool(self.expected) and not self.pending and \
+            not self.extensions
+
+    def has_answered(self, skill_id: str) -> bool:
+        """
+        Check if a handler has replied, declined or started searching.
+        @param skill_id: skill ID of the handler
+        @returns: True if the handler has answered this query
+        """
+        return skill_id in self.responders or skill_id in self.declined or \
+            skill_id in self.search_started
+
+    def add_decline(self, skill_id: str):
+        """
+        Record a handler declining to handle this query.
+        @param skill_id: skill that declined
+        """
+        self.declined.add(skill_id)
+        self.pending.discard(skill_id)
+
+    def add_reply(self, data: dict) -> bool:
+        """
+        Record a handler reply, keeping track of the highest confidence reply.
+        @param data: response data from a handler skill
+        @returns: True if the reply was recorded, False if it was a duplicate
+        """
+        skill_id = data["skill_id"]
+        if skill_id in self.responders:
+            return False
+        self.responders.add(skill_id)
+        self.pending.discard(skill_id)
+        if self.batch is not None and "replies" in data:
+            self._add_batch_replies(data)
+            return True
+        self.replies.append(data)
+        self.reply_bytes += estimate_size(data)
+        conf = data.get("conf", 0)
+        if not self.best or conf > self.best.get("conf", 0):
+            self.best = data
+            self.ties = list()
+        elif conf == self.best.get("conf", 0):
+            self.ties.append(data)
+        return True
+
+    @property
+    def candidates(self) -> List[dict]:
+        """
+        All replies to this query, highest confidence first. Replies with
+        equal confidence are in the order they were received.
+        """
+        return sorted(self.replies, key=lambda reply: reply.get("conf", 0),
+                      reverse=True)
+
+    def _add_batch_replies(self, data: dict):
+        """
+        Record a handler's replies to sub-requests, keeping track of the
+        highest confidence reply for each recipient.
+        @param data: response data with a list of `replies`
+        """
+        recipients = {sub_request["recipient"] for sub_request in self.batch}
+        for reply in data["replies"]:
+            recipient = reply.get("recipient")
+            if recipient not in recipients:
+                continue
+            best = self.batch_best.get(recipient)
+            if not best or reply.get("conf", 0) > best.get("conf", 0):
+                self.batch_best[recipient] = {**reply,
+                                              "skill_id": data["skill_id"]}
+        self.reply_bytes += estimate_size(data)
+
+    @property
+    def timer_name(self) -> str:
+        """
+        Name of the scheduled event used to time out this session
+        """
+        return f"CommunicationTimeout.{self.query_id}"
+
+    def __repr__(self):
+        return f"QuerySession({self.query_type}, {self.query_id}, " \
+               f"request={self.request})"
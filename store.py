@@ -0,0 +1,243 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import sqlite3
+
+from threading import Lock
+from time import time
+from typing import Dict, List, Optional
+
+from .session import QuerySession
+
+
+class SessionStore:
+    """
+    Session state shared by every skill instance connected to the same bus.
+    The instance that starts a query owns it; responses received by other
+    instances are stored for the owner to collect when it resolves the
+    query, and each query may only be claimed for resolution once.
+    """
+    def add(self, session: QuerySession, owner: str):
+        """
+        Add a new in-flight session.
+        @param session: QuerySession started by `owner`
+        @param owner: ID of the instance that started the session
+        """
+        raise NotImplementedError
+
+    def add_reply(self, query_id: str, data: dict) -> bool:
+        """
+        Store a handler response to a session owned by another instance.
+        @param query_id: ID of the session the response refers to
+        @param data: response message data
+        @returns: True if the session is in flight and the response was stored
+        """
+        raise NotImplementedError
+
+    def get_replies(self, query_id: str) -> List[dict]:
+        """
+        Get stored handler responses to a session.
+        @param query_id: ID of the session
+        @returns: list of response message data, oldest first
+        """
+        raise NotImplementedError
+
+    def claim(self, query_id: str, owner: str) -> bool:
+        """
+        Claim a session for resolution.
+        @param query_id: ID of the session
+        @param owner: ID of the instance resolving the session
+        @returns: True if the session was claimed by this call, False if it
+            was already claimed or is not in flight
+        """
+        raise NotImplementedError
+
+    def remove(self, query_id: str):
+        """
+        Remove a session and its stored responses.
+        @param query_id: ID of the session
+        """
+        raise NotImplementedError
+
+    def prune(self, ttl: float) -> int:
+        """
+        Remove sessions left behind by instances that stopped.
+        @param ttl: seconds after which a session is removed
+        @returns: number of removed sessions
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release any resources held by this store.
+        """
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Session state for a single skill instance.
+    """
+    def __init__(self):
+        self._sessions: Dict[str, dict] = dict()
+        self._lock = Lock()
+
+    def add(self, session: QuerySession, owner: str):
+        with self._lock:
+            self._sessions[session.query_id] = {"owner": owner,
+                                                "created": time(),
+                                                "claimed_by": None,
+                                                "replies": list()}
+
+    def add_reply(self, query_id: str, data: dict) -> bool:
+        with self._lock:
+            entry = self._sessions.get(query_id)
+            if not entry or entry["claimed_by"]:
+                return False
+            entry["replies"].append(data)
+            return True
+
+    def get_replies(self, query_id: str) -> List[dict]:
+        with self._lock:
+            entry = self._sessions.get(query_id)
+            return list(entry["replies"]) if entry else list()
+
+    def claim(self, query_id: str, owner: str) -> bool:
+        with self._lock:
+            entry = self._sessions.get(query_id)
+            if not entry or entry["claimed_by"]:
+                return False
+            entry["claimed_by"] = owner
+            return True
+
+    def remove(self, query_id: str):
+        with self._lock:
+            self._sessions.pop(query_id, None)
+
+    def prune(self, ttl: float) -> int:
+        cutoff = time() - ttl
+        with self._lock:
+            expired = [query_id for query_id, entry in self._sessions.items()
+                       if entry["created"] < cutoff]
+            for query_id in expired:
+                del self._sessions[query_id]
+        return len(expired)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Session state in a SQLite database file shared by skill instances on the
+    same host.
+    """
+    def __init__(self, path: str, timeout: float = 5):
+        """
+        @param path: path to the database file
+        @param timeout: seconds to wait for another instance's write lock
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._lock = Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                               "query_id TEXT PRIMARY KEY, "
+                               "query_type TEXT, owner TEXT, "
+                               "created REAL, claimed_by TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS replies ("
+                               "query_id TEXT, skill_id TEXT, data TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS replies_query_id "
+                               "ON replies (query_id)")
+
+    def add(self, session: QuerySession, owner: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sessions VALUES "
+                               "(?, ?, ?, ?, NULL)",
+                               (session.query_id, session.query_type, owner,
+                                time()))
+
+    def add_reply(self, query_id: str, data: dict) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO replies SELECT ?, ?, ? WHERE EXISTS ("
+                "SELECT 1 FROM sessions WHERE query_id = ? "
+                "AND claimed_by IS NULL)",
+                (query_id, data.get("skill_id"), json.dumps(data), query_id))
+            return cursor.rowcount == 1
+
+    def get_replies(self, query_id: str) -> List[dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM replies "
+                                      "WHERE query_id = ? ORDER BY rowid",
+                                      (query_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def claim(self, query_id: str, owner: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE sessions SET claimed_by = ? "
+                "WHERE query_id = ? AND claimed_by IS NULL",
+                (owner, query_id))
+            return cursor.rowcount == 1
+
+    def remove(self, query_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE query_id = ?",
+                               (query_id,))
+            self._conn.execute("DELETE FROM replies WHERE query_id = ?",
+                               (query_id,))
+
+    def prune(self, ttl: float) -> int:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM sessions "
+                                        "WHERE created < ?", (time() - ttl,))
+            self._conn.execute("DELETE FROM replies WHERE query_id NOT IN "
+                               "(SELECT query_id FROM sessions)")
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_session_store(backend: str,
+                         path: Optional[str] = None) -> SessionStore:
+    """
+    Create a session store from configuration.
+    @param backend: `memory` or `sqlite`
+    @param path: database file path for the `sqlite` backend
+    @returns: SessionStore instance
+    """
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "sqlite":
+        if not path:
+            raise ValueError("sqlite session store requires a path")
+        return SQLiteSessionStore(path)
+    raise ValueError(f"Unsupported session store: {backend}")
@@ -0,0 +1,288 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Load test for the CommunicationSkill query broker. Simulated call or message
+handler skills answer queries on an in-process FakeBus with configurable
+latency, `searching` extensions and confidence ties while many requests are
+resolved concurrently.
+
+Usage: python test/benchmark.py --handlers 5 --requests 1000
+"""
+
+import heapq
+import json
+import random
+import tracemalloc
+
+from argparse import ArgumentParser
+from threading import Condition, Event, Lock, Thread
+from time import monotonic
+from typing import Callable, List, Optional
+
+from neon_utils.signal_utils import check_for_signal
+from ovos_bus_client.message import Message
+from ovos_utils.fakebus import FakeBus
+
+QUERY_TYPES = {"call": ("communication:request.call",
+                        "communication:place.call"),
+               "message": ("communication:request.message",
+                           "communication:send.message")}
+
+
+class DelayedEmitter:
+    """
+    Runs callbacks after a delay from a single thread, so thousands of
+    simulated handler replies don't each need a timer thread.
+    """
+    def __init__(self):
+        self._queue = list()
+        self._condition = Condition()
+        self._counter = 0
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay: float, callback: Callable):
+        with self._condition:
+            self._counter += 1
+            heapq.heappush(self._queue, (monotonic() + delay, self._counter,
+                                         callback))
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and (not self._queue or
+                                         self._queue[0][0] > monotonic()):
+                    timeout = self._queue[0][0] - monotonic() \
+                        if self._queue else None
+                    self._condition.wait(timeout)
+                if not self._running:
+                    return
+                _, _, callback = heapq.heappop(self._queue)
+            callback()
+
+
+class SimulatedHandler:
+    """
+    Simulated handler skill answering queries of one type.
+    """
+    def __init__(self, bus: FakeBus, emitter: DelayedEmitter, skill_id: str,
+                 query_type: str, latency: float, jitter: float,
+                 search_rate: float, search_latency: float, tie_rate: float):
+        self.bus = bus
+        self.emitter = emitter
+        self.skill_id = skill_id
+        self.request_msg = QUERY_TYPES[query_type][0]
+        self.latency = latency
+        self.jitter = jitter
+        self.search_rate = search_rate
+        self.search_latency = search_latency
+        self.tie_rate = tie_rate
+        bus.on(self.request_msg, self.handle_request)
+
+    def _delay(self, mean: float) -> float:
+        return max(random.gauss(mean, self.jitter), 0)
+
+    def handle_request(self, message: Message):
+        response_msg = f"{self.request_msg}.response"
+        data = {"request": message.data["request"],
+                "query_id": message.data.get("query_id"),
+                "skill_id": self.skill_id}
+        conf = 0.5 if random.random() < self.tie_rate else random.random()
+        reply = message.reply(response_msg,
+                              {**data, "conf": conf,
+                               "skill_data": {"handler": self.skill_id}})
+        if random.random() < self.search_rate:
+            searching = message.reply(response_msg, {**data,
+                                                     "searching": True})
+            self.emitter.call_later(self._delay(self.latency),
+                                    lambda: self.bus.emit(searching))
+            self.emitter.call_later(self._delay(self.latency +
+                                                self.search_latency),
+                                    lambda: self.bus.emit(reply))
+        else:
+            self.emitter.call_later(self._delay(self.latency),
+                                    lambda: self.bus.emit(reply))
+
+
+def _percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+def run_benchmark(handlers: int = 5, requests: int = 500,
+                  concurrency: int = 50, query_type: str = "call",
+                  latency: float = 0.05, jitter: float = 0.02,
+                  search_rate: float = 0.0, search_latency: float = 0.2,
+                  tie_rate: float = 0.0, run_timeout: float = 60) -> dict:
+    """
+    Resolve `requests` queries against `handlers` simulated handler skills
+    with at most `concurrency` queries in flight.
+    @returns: dict benchmark results
+    """
+    from skill_communication import CommunicationSkill
+    from skill_communication.timers import AsyncioTimers
+
+    request_msg, dispatch_msg = QUERY_TYPES[query_type]
+    started = dict()
+    latencies = list()
+    lock = Lock()
+    slots = Condition(lock)
+    done = Event()
+    in_flight = [0]
+    no_match = [0]
+
+    def _on_resolved(query_id: Optional[str]):
+        with lock:
+            start = started.pop(query_id, None)
+            if start is None:
+                return
+            latencies.append(monotonic() - start)
+            in_flight[0] -= 1
+            slots.notify()
+            if len(latencies) == requests:
+                done.set()
+
+    def _on_request(message: Message):
+        with lock:
+            started[message.data["query_id"]] = monotonic()
+
+    class BenchmarkSkill(CommunicationSkill):
+        def _handle_no_match(self, session):
+            # Count queries nobody answered as resolved
+            no_match[0] += 1
+            _on_resolved(session.query_id)
+
+    bus = FakeBus()
+    skill = BenchmarkSkill(bus=bus, skill_id="communication.benchmark")
+    timers = AsyncioTimers(skill.broker.handle_timeout)
+    timers.start()
+    skill.broker.use_timers(timers.schedule, timers.cancel)
+    emitter = DelayedEmitter()
+    for i in range(handlers):
+        SimulatedHandler(bus, emitter, f"handler_{i}.benchmark", query_type,
+                         latency, jitter, search_rate, search_latency,
+                         tie_rate)
+
+    bus.on(request_msg, _on_request)
+    bus.on(dispatch_msg, lambda m: _on_resolved(m.data.get("query_id")))
+    # Initialize signal handling before timing any requests
+    check_for_signal("CORE_useHesitation", -1)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    peak_sessions = 0
+    peak_memory = 0
+    start = monotonic()
+    for i in range(requests):
+        with lock:
+            while in_flight[0] >= concurrency:
+                slots.wait()
+            in_flight[0] += 1
+        contact = f"contact {i}"
+        if query_type == "call":
+            message = Message("test", {"utterance": f"call {contact}",
+                                       "contact": contact},
+                              {"neon_should_respond": True,
+                               "username": f"user_{i}"})
+            skill.handle_place_call(message)
+        else:
+            message = Message("test", {"utterance": f"message {contact}"},
+                              {"neon_should_respond": True})
+            skill.handle_send_message(message)
+        sessions = len(skill.query_sessions)
+        if sessions > peak_sessions:
+            peak_sessions = sessions
+            peak_memory = tracemalloc.get_traced_memory()[0] - baseline
+    completed = done.wait(run_timeout)
+    elapsed = monotonic() - start
+    tracemalloc.stop()
+
+    emitter.stop()
+    # The skill's workers may still schedule timeouts until it is shut down
+    skill.shutdown()
+    timers.shutdown()
+    return {"handlers": handlers,
+            "requests": requests,
+            "concurrency": concurrency,
+            "resolved": len(latencies),
+            "no_match": no_match[0],
+            "completed": completed,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_per_s": round(len(latencies) / elapsed, 1),
+            "latency_p50_s": _percentile(latencies, 50),
+            "latency_p95_s": _percentile(latencies, 95),
+            "latency_p99_s": _percentile(latencies, 99),
+            "peak_sessions": peak_sessions,
+            "bytes_per_session": peak_memory // peak_sessions
+            if peak_sessions else None}
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--handlers", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--query-type", choices=list(QUERY_TYPES),
+                        default="call")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="mean handler reply latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02,
+                        help="standard deviation of handler latency")
+    parser.add_argument("--search-rate", type=float, default=0.0,
+                        help="fraction of replies preceded by `searching`")
+    parser.add_argument("--search-latency", type=float, default=0.2,
+                        help="mean extra latency of searching handlers")
+    parser.add_argument("--tie-rate", type=float, default=0.0,
+                        help="fraction of replies with a tied confidence")
+    parser.add_argument("--json", action="store_true",
+                        help="print results as JSON")
+    args = parser.parse_args()
+    results = run_benchmark(args.handlers, args.requests, args.concurrency,
+                            args.query_type, args.latency, args.jitter,
+                            args.search_rate, args.search_latency,
+                            args.tie_rate)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print(f"{key:>20}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Replay recorded query traffic into a CommunicationSkill under cProfile.
+Recordings are made with the `record_file` setting. Recorded queries are
+started on an in-process FakeBus with their original requests, and recorded
+handler messages are emitted at their recorded offsets divided by `--speed`.
+Query timeouts run in real time on the replay thread so every resolution is
+profiled.
+
+Usage: python test/replay.py recording.jsonl --speed 10 --profile-out out.prof
+"""
+
+import cProfile
+import heapq
+import json
+import pstats
+
+from argparse import ArgumentParser
+from time import monotonic, sleep
+from typing import Dict, List, Optional
+
+from ovos_bus_client.message import Message
+from ovos_utils.fakebus import FakeBus
+
+
+class ReplayTimers:
+    """
+    Session timeouts fired from the replay thread between recorded events.
+    """
+    def __init__(self, on_timeout):
+        """
+        @param on_timeout: callback with the `query_id` of a timed out session
+        """
+        self._on_timeout = on_timeout
+        self._deadlines: Dict[str, float] = dict()
+        self._queue = list()
+
+    def schedule(self, session, timeout: float):
+        deadline = monotonic() + timeout
+        self._deadlines[session.query_id] = deadline
+        heapq.heappush(self._queue, (deadline, session.query_id))
+
+    def cancel(self, session):
+        self._deadlines.pop(session.query_id, None)
+
+    def run_until(self, until: Optional[float]):
+        """
+        Fire timeouts that are due before `until`, sleeping between them.
+        @param until: monotonic time to return at, or None to run until no
+            timeouts are scheduled
+        """
+        while self._queue and (until is None or self._queue[0][0] <= until):
+            deadline, query_id = heapq.heappop(self._queue)
+            if self._deadlines.get(query_id) != deadline:
+                # Cancelled or re-armed
+                continue
+            sleep(max(deadline - monotonic(), 0))
+            del self._deadlines[query_id]
+            self._on_timeout(query_id)
+        if until is not None:
+            sleep(max(until - monotonic(), 0))
+
+
+def _map_query_id(data: dict, query_ids: Dict[str, str]) -> dict:
+    query_id = data.get("query_id")
+    if query_id in query_ids:
+        return {**data, "query_id": query_ids[query_id]}
+    return data
+
+
+def replay(events: List[dict], speed: float = 1.0,
+           settings: Optional[dict] = None,
+           profiler: Optional[cProfile.Profile] = None) -> dict:
+    """
+    Replay recorded events into a new CommunicationSkill.
+    @param events: recorded events, oldest first
+    @param speed: factor to accelerate the time between events by, or 0 to
+        replay events without waiting
+    @param settings: optional skill settings to apply before replaying
+    @param profiler: optional profiler to enable while replaying
+    @returns: dict replay results
+    """
+    from skill_communication import CommunicationSkill
+
+    bus = FakeBus()
+    skill = CommunicationSkill(bus=bus, skill_id="communication.replay")
+    skill.broker.configure(settings or dict())
+    # Handle responses on the replay thread so they are profiled
+    skill._workers.shutdown()
+    timers = ReplayTimers(skill.broker.handle_timeout)
+    skill.broker.use_timers(timers.schedule, timers.cancel)
+    dispatch_types = {qtype.dispatch_msg
+                      for qtype in skill.broker.query_types.values()}
+    dispatched = {"recorded": 0, "replayed": 0}
+
+    def _on_dispatch(_):
+        dispatched["replayed"] += 1
+
+    for msg_type in dispatch_types:
+        bus.on(msg_type, _on_dispatch)
+
+    query_ids = dict()
+    started = 0
+    if profiler:
+        profiler.enable()
+    start = monotonic()
+    first = events[0]["t"] if events else 0
+    for event in events:
+        if speed:
+            timers.run_until(start + (event["t"] - first) / speed)
+        message = Message(event["type"], _map_query_id(event["data"],
+                                                       query_ids),
+                          event.get("context"))
+        if event["kind"] == "start":
+            session = skill.broker.start_query(event["query_type"],
+                                               event["request"], message,
+                                               event.get("contact_type"),
+                                               event.get("batch"),
+                                               event.get("deliver_at"))
+            query_ids[event["query_id"]] = session.query_id
+            started += 1
+        elif event["kind"] == "in":
+            bus.emit(message)
+        elif event["kind"] == "out" and event["type"] in dispatch_types:
+            dispatched["recorded"] += 1
+    timers.run_until(None)
+    elapsed = monotonic() - start
+    if profiler:
+        profiler.disable()
+    skill.shutdown()
+    return {"events": len(events),
+            "queries": started,
+            "recorded_dispatches": dispatched["recorded"],
+            "replayed_dispatches": dispatched["replayed"],
+            "elapsed_s": round(elapsed, 3)}
+
+
+def main():
+    from skill_communication.recorder import read_recording
+
+    parser = ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("recordings", nargs="+",
+                        help="recorded files, oldest first")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed factor; 0 replays without waiting")
+    parser.add_argument("--settings", type=json.loads, default=None,
+                        help="JSON skill settings to replay with")
+    parser.add_argument("--profile-out",
+                        help="file to write profile stats to")
+    parser.add_argument("--top", type=int, default=25,
+                        help="number of functions to print")
+    args = parser.parse_args()
+    profiler = cProfile.Profile()
+    results = replay(list(read_recording(*args.recordings)), args.speed,
+                     args.settings, profiler)
+    for key, value in results.items():
+        print(f"{key:>20}: {value}")
+    stats = pstats.Stats(profiler).sort_stats("cumulative")
+    if args.profile_out:
+        stats.dump_stats(args.profile_out)
+    stats.print_stats(args.top)
+
+
+if __name__ == "__main__":
+    main()
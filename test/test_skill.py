@@ -18,9 +18,10 @@
 # China Patent: CN102017585  -  Europe Patent: EU2156652  -  Patents Pending
 
 import pytest
+import unittest
 
-from threading import Event
-from time import sleep
+from threading import Barrier, Event, Thread
+from time import monotonic, sleep
 from mock import Mock
 from ovos_bus_client.message import Message
 from neon_minerva.tests.skill_unit_test_base import SkillTestCase
@@ -31,19 +32,24 @@ class TestSkillMethods(SkillTestCase):
     def setUpClass(cls) -> None:
         SkillTestCase.setUpClass()
         cls.skill.schedule_event = Mock()
+        # Handle events on the bus thread so results can be checked directly
+        cls.skill._workers.shutdown()
 
     def tearDown(self):
         SkillTestCase.tearDown(self)
         self.skill.schedule_event.reset_mock()
+        for handlers in self.skill.broker.known_handlers.values():
+            handlers.clear()
 
     def test_00_skill_init(self):
         # Test any parameters expected to be set in init or initialize methods
         from neon_utils.skills import NeonSkill
 
         self.assertIsInstance(self.skill, NeonSkill)
-        self.assertIsInstance(self.skill.query_replies, dict)
-        self.assertIsInstance(self.skill.query_extensions, dict)
-        self.assertIsNotNone(self.skill.lock)
+        self.assertIsInstance(self.skill.query_sessions, dict)
+        self.assertIsNotNone(self.skill.broker.lock)
+        self.assertEqual(set(self.skill.broker.query_types),
+                         {"call", "message"})
 
         listeners = self.skill.bus.ee.listeners
 
@@ -53,15 +59,101 @@ class TestSkillMethods(SkillTestCase):
         self.assertIsNotNone(len(listeners(
             "communication:request.call.response")), 1)
 
+    def _get_session(self, request: str):
+        for session in self.skill.query_sessions.values():
+            if session.request == request:
+                return session
+
+    def test_handle_register(self):
+        responses = []
+        self.bus.on("communication:register.response", responses.append)
+        self.bus.emit(Message("communication:register",
+                              {"skill_id": "registered_skill",
+                               "query_types": ["call"], "ttl": 30}))
+        self.bus.emit(Message("communication:register", {"skill_id": "bad"}))
+        self.bus.remove("communication:register.response", responses.append)
+        self.assertEqual(responses[0].data, {"skill_id": "registered_skill",
+                                             "registered": True,
+                                             "heartbeat": 10})
+        self.assertFalse(responses[1].data["registered"])
+        self.assertEqual(self.skill.broker.registry.registered("call"),
+                         {"registered_skill"})
+
+        self.bus.emit(Message("communication:deregister",
+                              {"skill_id": "registered_skill"}))
+        self.assertEqual(self.skill.broker.registry.registered("call"), set())
+
+    def test_handle_get_metrics(self):
+        responses = []
+        self.bus.on("communication:metrics.response", responses.append)
+        self.bus.emit(Message("communication:metrics"))
+        self.bus.remove("communication:metrics.response", responses.append)
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(set(responses[0].data),
+                         {"enabled", "counters", "phases", "outcomes",
+                          "usage", "breakers", "workers"})
+
+    def test_query_limit(self):
+        self.skill.broker.max_sessions = 0
+        try:
+            self.skill.handle_place_call(
+                Message("test", {"utterance": "call mom", "contact": "mom"},
+                        {"neon_should_respond": True}))
+            self.skill.speak_dialog.assert_called_with("too_busy",
+                                                       private=True)
+            self.skill.schedule_event.assert_not_called()
+        finally:
+            self.skill.broker.max_sessions = 500
+
+    def test_record_and_replay(self):
+        from os.path import join
+        from tempfile import TemporaryDirectory
+        from skill_communication.recorder import BusRecorder, read_recording
+        from replay import replay
+        with TemporaryDirectory() as tmp_dir:
+            path = join(tmp_dir, "recording.jsonl")
+            self.skill._recorder = BusRecorder(path)
+            try:
+                self.skill._start_query("call", "recorded contact",
+                                        Message("test", {"utterance": "x"}))
+                session = list(self.skill.query_sessions.values())[-1]
+                self.bus.emit(Message("communication:request.call.response",
+                                      {"query_id": session.query_id,
+                                       "request": "recorded contact",
+                                       "skill_id": "recorded_skill",
+                                       "conf": 0.9}))
+                session.deadline = 0
+                self.skill._handle_query_timeout(
+                    Message("test", {"query_id": session.query_id}))
+            finally:
+                self.skill._recorder.close()
+                self.skill._recorder = None
+            events = list(read_recording(path))
+
+        self.assertEqual([e["kind"] for e in events],
+                         ["out", "start", "in", "out", "timeout", "out"])
+        self.assertEqual(events[1]["query_id"], session.query_id)
+        self.assertEqual(events[5]["data"]["skill_id"], "recorded_skill")
+        results = replay(events, speed=0, settings={"max_timeout": 0.2})
+        self.assertEqual(results["queries"], 1)
+        self.assertEqual(results["recorded_dispatches"], 1)
+        self.assertEqual(results["replayed_dispatches"], 1)
+
+    def test_handle_contacts_update(self):
+        self.bus.emit(Message("communication:contacts.update",
+                              {"skill_id": "contacts_skill",
+                               "contacts": ["Alice", "Bob"]}))
+        self.assertEqual(len(self.skill.broker.contacts.match("alice")), 1)
+        self.skill.broker.contacts.remove_handler("contacts_skill")
+
     def test_handle_place_call(self):
-        real_timeout = self.skill._place_call_timeout
-        self.skill._place_call_timeout = Mock()
         handled_event = Event()
         valid_response_data = {"request": "valid_contact",
                                "skill_id": "test_skill_id",
                                "callback_data": {"test": "data"}}
 
         def handle_place_call(message: Message):
+            self.assertIsInstance(message.data["query_id"], str)
             if message.data["request"] == "valid_contact":
                 self.bus.emit(message.reply(
                     "communication:request.call.response",
@@ -99,18 +191,19 @@ class TestSkillMethods(SkillTestCase):
 
         self.skill.handle_place_call(valid_message)
         handled_event.wait()
-        self.assertEqual(self.skill.query_extensions["valid_contact"], [])
-        self.assertEqual(self.skill.query_replies["valid_contact"],
-                         [valid_response_data])
+        self.assertEqual(self._get_session("valid_contact").extensions,
+                         set())
+        self.assertEqual(self._get_session("valid_contact").best,
+                         valid_response_data)
         self.assertEqual(self.skill.schedule_event.call_count, 3)
         self.skill.schedule_event.reset_mock()
 
         self.skill.handle_place_call(valid_extension)
         handled_event.wait()
-        self.assertEqual(self.skill.query_extensions["valid_extension"],
-                         ["test_skill_id"])
-        self.assertEqual(self.skill.query_replies["valid_extension"],
-                         [])
+        self.assertEqual(self._get_session("valid_extension").extensions,
+                         {"test_skill_id"})
+        self.assertEqual(self._get_session("valid_extension").reply_count,
+                         0)
         self.assertEqual(self.skill.schedule_event.call_count, 2)
         self.skill.schedule_event.reset_mock()
 
@@ -118,21 +211,22 @@ class TestSkillMethods(SkillTestCase):
         handled_event.wait()
         self.skill.schedule_event.assert_called_once()
         call_args = self.skill.schedule_event.call_args
-        self.assertEqual(call_args[0][0], self.skill._place_call_timeout)
+        self.assertEqual(call_args[0][0],
+                         self.skill._handle_query_timeout)
         self.assertEqual(call_args[0][1], 1)
         self.assertIsInstance(call_args[1]["data"], dict)
-        self.assertEqual(call_args[1]["name"], "PlaceCallTimeout")
-        self.assertEqual(self.skill.query_extensions["invalid_contact"],
-                         [])
-        self.assertEqual(self.skill.query_replies["invalid_contact"],
-                         [])
+        self.assertEqual(call_args[1]["name"],
+                         self._get_session("invalid_contact").timer_name)
+        self.assertEqual(call_args[1]["data"]["query_id"],
+                         self._get_session("invalid_contact").query_id)
+        self.assertEqual(self._get_session("invalid_contact").extensions,
+                         set())
+        self.assertEqual(self._get_session("invalid_contact").reply_count,
+                         0)
 
         self.bus.remove("communication:request.call", handle_place_call)
-        self.skill._place_call_timeout = real_timeout
 
     def test_handle_send_message(self):
-        real_timeout = self.skill._send_message_timeout
-        self.skill._send_message_timeout = Mock()
         handled_event = Event()
         valid_response_data = {"request": "valid test",
                                "skill_id": "test_skill_id",
@@ -174,18 +268,19 @@ class TestSkillMethods(SkillTestCase):
 
         self.skill.handle_send_message(valid_message)
         handled_event.wait()
-        self.assertEqual(self.skill.query_extensions["valid test"], [])
-        self.assertEqual(self.skill.query_replies["valid test"],
-                         [valid_response_data])
+        self.assertEqual(self._get_session("valid test").extensions,
+                         set())
+        self.assertEqual(self._get_session("valid test").best,
+                         valid_response_data)
         self.assertEqual(self.skill.schedule_event.call_count, 3)
         self.skill.schedule_event.reset_mock()
 
         self.skill.handle_send_message(valid_extension)
         handled_event.wait()
-        self.assertEqual(self.skill.query_extensions["valid extension"],
-                         ["test_skill_id"])
-        self.assertEqual(self.skill.query_replies["valid extension"],
-                         [])
+        self.assertEqual(self._get_session("valid extension").extensions,
+                         {"test_skill_id"})
+        self.assertEqual(self._get_session("valid extension").reply_count,
+                         0)
         self.assertEqual(self.skill.schedule_event.call_count, 2)
         self.skill.schedule_event.reset_mock()
 
@@ -193,19 +288,1611 @@ class TestSkillMethods(SkillTestCase):
         handled_event.wait()
         self.skill.schedule_event.assert_called_once()
         call_args = self.skill.schedule_event.call_args
-        self.assertEqual(call_args[0][0], self.skill._send_message_timeout)
+        self.assertEqual(call_args[0][0],
+                         self.skill._handle_query_timeout)
         self.assertEqual(call_args[0][1], 1)
         self.assertIsInstance(call_args[1]["data"], dict)
-        self.assertEqual(call_args[1]["name"], "SendMessageTimeout")
-        self.assertEqual(self.skill.query_extensions["invalid test"],
-                         [])
-        self.assertEqual(self.skill.query_replies["invalid test"],
-                         [])
+        self.assertEqual(call_args[1]["name"],
+                         self._get_session("invalid test").timer_name)
+        self.assertEqual(self._get_session("invalid test").extensions,
+                         set())
+        self.assertEqual(self._get_session("invalid test").reply_count,
+                         0)
 
         self.bus.remove("communication:request.message", handle_send_message)
-        self.skill._send_message_timeout = real_timeout
 
-    # TODO: Test timeout methods
+    def test_concurrent_sessions(self):
+        requests = []
+        self.bus.on("communication:request.call", requests.append)
+        # Two users request the same contact at once
+        for user in ("first", "second"):
+            self.skill.handle_place_call(
+                Message("test", {"utterance": "call mom", "contact": "mom"},
+                        {"neon_should_respond": True, "username": user}))
+        self.bus.remove("communication:request.call", requests.append)
+
+        self.assertEqual(len(requests), 2)
+        first_id = requests[0].data["query_id"]
+        second_id = requests[1].data["query_id"]
+        self.assertNotEqual(first_id, second_id)
+        timer_names = {c[1]["name"] for c in
+                       self.skill.schedule_event.call_args_list}
+        self.assertEqual(len(timer_names), 2)
+
+        # Responses are routed to the session they reference
+        self.skill.broker.handle_response(
+            requests[1].reply("communication:request.call.response",
+                              {"request": "mom", "query_id": second_id,
+                               "skill_id": "test_skill_id", "conf": 0.9,
+                               "skill_data": {}}))
+        self.assertEqual(self.skill.query_sessions[first_id].reply_count, 0)
+        self.assertEqual(self.skill.query_sessions[second_id].reply_count, 1)
+
+        # Timeout resolves only the referenced session
+        for session in self.skill.query_sessions.values():
+            session.deadline = 0
+        dispatched = []
+        self.bus.on("communication:place.call", dispatched.append)
+        self.skill._handle_query_timeout(Message("timeout",
+                                                 {"query_id": second_id}))
+        self.bus.remove("communication:place.call", dispatched.append)
+        self.assertEqual(len(dispatched), 1)
+        self.assertEqual(dispatched[0].data["query_id"], second_id)
+        self.assertNotIn(second_id, self.skill.query_sessions)
+        self.assertIn(first_id, self.skill.query_sessions)
+
+        self.skill._handle_query_timeout(Message("timeout",
+                                                 {"query_id": first_id}))
+        self.skill.speak_dialog.assert_called_with("cant_send", private=True)
+        self.assertNotIn(first_id, self.skill.query_sessions)
+
+    def test_submit_timeout(self):
+        workers = self.skill._workers
+        self.skill._workers = Mock()
+        try:
+            # Timeouts from either engine are queued with their query
+            self.skill._handle_query_timeout(Message("timeout",
+                                                     {"query_id": "first"}))
+            self.skill._submit_timeout("second")
+            submit = self.skill._workers.submit
+        finally:
+            self.skill._workers = workers
+        self.assertEqual(submit.call_count, 2)
+        for call, query_id in zip(submit.call_args_list,
+                                  ("first", "second")):
+            self.assertEqual(call[0], (self.skill._on_query_timeout,
+                                       query_id))
+            self.assertEqual(call[1], {"key": query_id, "priority": 1})
+
+
+class TestCommonQueryBroker(unittest.TestCase):
+    def setUp(self):
+        from skill_communication.broker import CommonQueryBroker, QueryType
+        self.emit = Mock()
+        self.schedule = Mock()
+        self.cancel = Mock()
+        self.no_match = Mock()
+        self.broker = CommonQueryBroker(self.emit, self.schedule, self.cancel,
+                                        self.no_match)
+        self.video = QueryType("video", request_msg="test:request.video",
+                               dispatch_msg="test:start.video")
+        self.broker.register_query_type(self.video)
+
+    def _expire(self, session):
+        session.deadline = 0
+        self.broker.handle_timeout(session.query_id)
+
+    def _reply(self, session, skill_id, **kwargs):
+        data = {"request": session.request, "query_id": session.query_id,
+                "skill_id": skill_id, **kwargs}
+        self.broker.handle_response(Message(self.video.response_msg, data))
+
+    def test_register_query_type(self):
+        from skill_communication.broker import QueryType
+        self.assertEqual(self.video.response_msg, "test:request.video.response")
+        with self.assertRaises(ValueError):
+            self.broker.register_query_type(
+                QueryType("video", "test:other", "test:other.dispatch"))
+
+    def test_resolve_best_reply(self):
+        session = self.broker.start_query("video", "mom",
+                                          Message("test", {"utterance": "x"}))
+        request = self.emit.call_args[0][0]
+        self.assertEqual(request.msg_type, "test:request.video")
+        self.assertEqual(request.data["query_id"], session.query_id)
+        self.schedule.assert_called_once_with(session, self.video.timeout)
+
+        self._reply(session, "low", conf=0.2, skill_data={"id": "low"})
+        self._reply(session, "high", conf=0.8, skill_data={"id": "high"})
+        self._reply(session, "tie", conf=0.8, skill_data={"id": "tie"})
+        # Duplicate replies are ignored
+        self._reply(session, "low", conf=1.0, skill_data={"id": "low"})
+        self.assertEqual(session.reply_count, 3)
+
+        # The leading handler is hinted to prepare until it is overtaken
+        hints = [(call[0][0].msg_type, call[0][0].data["skill_id"])
+                 for call in self.emit.call_args_list[1:]]
+        self.assertEqual(hints, [("communication:prepare", "low"),
+                                 ("communication:prepare.cancel", "low"),
+                                 ("communication:prepare", "high")])
+        self.assertEqual(self.emit.call_args[0][0].data["skill_data"],
+                         {"id": "high"})
+        self.assertEqual(session.best["skill_id"], "high")
+        self.assertEqual([t["skill_id"] for t in session.ties], ["tie"])
+
+        self._expire(session)
+        dispatch = self.emit.call_args[0][0]
+        self.assertEqual(dispatch.msg_type, "test:start.video")
+        self.assertEqual(dispatch.data["skill_data"], {"id": "high"})
+        self.assertNotIn(session.query_id, self.broker.sessions)
+        self.no_match.assert_not_called()
+
+        # Late replies and repeated timeouts are ignored
+        self._reply(session, "late", conf=1.0)
+        self._expire(session)
+        self.assertEqual(self.emit.call_count, 5)
+
+    def test_extensions(self):
+        session = self.broker.start_query("video", "mom",
+                                          Message("test", {"utterance": "x"}))
+        self._reply(session, "slow", searching=True)
+        self.assertEqual(session.extensions, {"slow"})
+        self.schedule.assert_called_with(session,
+                                         self.video.extension_timeout)
+        self._reply(session, "slow", conf=0.5)
+        self.assertEqual(session.extensions, set())
+        self.schedule.assert_called_with(session, 0)
+
+        self._expire(session)
+        self.assertEqual(self.emit.call_args[0][0].data["skill_id"], "slow")
+
+    def test_extension_budget(self):
+        self.broker.configure({"max_extensions": 1, "extension_budget": 3})
+        session = self.broker.start_query("video", "mom",
+                                          Message("test", {"utterance": "x"}))
+        self._reply(session, "slow", searching=True)
+        # Extensions are limited by the session's remaining budget
+        self.schedule.assert_called_with(session, pytest.approx(3, abs=0.1))
+        self.schedule.reset_mock()
+        deadline = session.deadline
+        self._reply(session, "slow", searching=True)
+        self.schedule.assert_not_called()
+        self.assertEqual(session.deadline, deadline)
+        self._reply(session, "other", searching=True)
+        self.schedule.assert_called_once()
+        self.assertEqual(self.broker.circuits.snapshot(),
+                         {"slow": {"state": "closed", "strikes": 1}})
+
+    def test_circuit_breaker(self):
+        self.broker.metrics.enabled = True
+        message = Message("test", {"utterance": "x"})
+        self.broker.register_handler({"skill_id": "stuck",
+                                      "query_types": ["video"], "ack": True})
+        self.broker.add_known_handler("video", "good")
+        self.broker.add_known_handler("video", "silent")
+        for request in ("a", "b", "c"):
+            session = self.broker.start_query("video", request, message)
+            self.assertEqual(session.expected, {"stuck", "good", "silent"})
+            self._reply(session, "good", conf=0.5)
+            self._expire(session)
+        self.assertTrue(self.broker.circuits.is_open("stuck"))
+        # Handlers without a match may stay silent without a strike
+        self.assertFalse(self.broker.circuits.is_open("silent"))
+        self.assertNotIn("silent", self.broker.circuits.snapshot())
+        self.assertEqual(self.broker.metrics.snapshot()["counters"]["video"]
+                         ["breakers_opened"], 1)
+
+        # Open handlers are not waited on and may not extend queries
+        session = self.broker.start_query("video", "d", message)
+        self.assertEqual(session.expected, {"good", "silent"})
+        self._reply(session, "stuck", searching=True)
+        self.assertEqual(session.extensions, set())
+        self._reply(session, "silent", declined=True)
+        self._reply(session, "good", conf=0.5)
+        self.assertNotIn(session.query_id, self.broker.sessions)
+
+        # Malformed replies are ignored and count as strikes
+        session = self.broker.start_query("video", "e", message)
+        self._reply(session, "good", conf="high")
+        self._reply(session, "bad", replies="none")
+        self.assertEqual(session.reply_count, 0)
+        self.assertEqual(self.broker.circuits.snapshot()["good"]["strikes"], 1)
+        self._reply(session, "good", conf=0.5)
+        self.assertNotIn("good", self.broker.circuits.snapshot())
+
+    def test_early_resolution(self):
+        # Repeat requests are queried again in this test
+        self.broker.coalesce_window = 0
+        message = Message("test", {"utterance": "x"})
+        # Handlers are learned from responses
+        session = self.broker.start_query("video", "mom", message)
+        self._reply(session, "first", conf=0.5)
+        self._reply(session, "second", declined=True)
+        self.assertIn(session.query_id, self.broker.sessions)
+        self.assertEqual(self.broker.known_handlers["video"],
+                         {"first", "second"})
+        self._expire(session)
+
+        # Query resolves as soon as every known handler answers
+        self.cancel.reset_mock()
+        session = self.broker.start_query("video", "mom", message)
+        self.assertEqual(session.expected, {"first", "second"})
+        self._reply(session, "first", conf=0.5)
+        self.assertIn(session.query_id, self.broker.sessions)
+        self._reply(session, "second", declined=True)
+        self.assertNotIn(session.query_id, self.broker.sessions)
+        self.cancel.assert_called_with(session)
+        dispatch = self.emit.call_args[0][0]
+        self.assertEqual(dispatch.msg_type, "test:start.video")
+        self.assertEqual(dispatch.data["skill_id"], "first")
+
+        # Searching handlers are still waited on
+        session = self.broker.start_query("video", "mom", message)
+        self._reply(session, "first", searching=True)
+        self._reply(session, "second", declined=True)
+        self.assertIn(session.query_id, self.broker.sessions)
+        self._reply(session, "first", conf=0.5)
+        self.assertNotIn(session.query_id, self.broker.sessions)
+
+    def test_targeted_dispatch(self):
+        self.broker.coalesce_window = 0
+        message = Message("test", {"utterance": "x"}, {"lang": "en-US"})
+        self.broker.registry.register({"skill_id": "en_skill",
+                                       "query_types": ["video"],
+                                       "langs": ["en-us"]})
+        self.broker.registry.register({"skill_id": "de_skill",
+                                       "query_types": ["video"],
+                                       "langs": ["de-de"]})
+        session = self.broker.start_query("video", "mom", message)
+        request = self.emit.call_args[0][0]
+        self.assertEqual(request.data["handlers"], ["en_skill"])
+        self.assertEqual(session.expected, {"en_skill"})
+        self._reply(session, "en_skill", conf=0.5)
+        self.assertNotIn(session.query_id, self.broker.sessions)
+
+        # A single eligible handler accepting direct dispatch is not queried
+        self.broker.registry.register({"skill_id": "en_skill",
+                                       "query_types": ["video"],
+                                       "langs": ["en-us"],
+                                       "direct_dispatch": True})
+        self.schedule.reset_mock()
+        session = self.broker.start_query("video", "mom", message)
+        dispatch = self.emit.call_args[0][0]
+        self.assertEqual(dispatch.msg_type, "test:start.video")
+        self.assertEqual(dispatch.data["skill_id"], "en_skill")
+        self.assertEqual(dispatch.data["query_id"], session.query_id)
+        self.assertNotIn(session.query_id, self.broker.sessions)
+        self.schedule.assert_not_called()
+
+        # Unregistered handlers learned from responses are still queried
+        self.broker.add_known_handler("video", "legacy_skill")
+        session = self.broker.start_query("video", "mom", message)
+        self.assertEqual(self.emit.call_args[0][0].msg_type,
+                         "test:request.video")
+        self.assertEqual(session.expected, {"en_skill", "legacy_skill"})
+
+    def test_adaptive_timeout(self):
+        self.broker.configure({"min_timeout": 0.1, "max_timeout": 2})
+        for _ in range(10):
+            self.broker.latency.record_reply("video", "fast", 0.05)
+            self.broker.latency.record_reply("video", "slow", 0.5)
+        message = Message("test", {"utterance": "x"})
+        self.broker.add_known_handler("video", "fast")
+        session = self.broker.start_query("video", "mom", message)
+        self.assertEqual(session.timeout, 0.1)
+        self.schedule.assert_called_with(session, 0.1)
+
+        # Window covers the slowest expected handler
+        self.broker.add_known_handler("video", "slow")
+        session = self.broker.start_query("video", "dad", message)
+        self.assertGreaterEqual(session.timeout, 0.5)
+        self.assertLess(session.timeout, 1)
+
+        # Handlers without enough samples use the default
+        self.broker.add_known_handler("video", "new")
+        session = self.broker.start_query("video", "bob", message)
+        self.assertEqual(session.timeout, self.video.timeout)
+
+    def test_query_type_settings(self):
+        self.broker.configure({"video_timeout": 0.5,
+                               "video_extension_timeout": 3,
+                               "video_max_timeout": 1.5})
+        self.assertEqual(self.video.timeout, 0.5)
+        self.assertEqual(self.video.extension_timeout, 3)
+        for _ in range(10):
+            self.broker.latency.record_reply("video", "slow", 2)
+        self.broker.add_known_handler("video", "slow")
+        session = self.broker.start_query("video", "mom",
+                                          Message("test", {"utterance": "x"}))
+        self.assertEqual(session.timeout, 1.5)
+
+    def test_late_reply_latency(self):
+        message = Message("test", {"utterance": "x"})
+        session = self.broker.start_query("video", "mom", message)
+        self._reply(session, "fast", conf=0.5)
+        self._expire(session)
+        self.assertNotIn(session.query_id, self.broker.sessions)
+
+        # Replies after the query resolved still widen later windows
+        session.created -= 0.5
+        self._reply(session, "slow", conf=0.9)
+        self._reply(session, "slow", conf=0.9)
+        self._reply(session, "fast", conf=0.5)
+        histograms = self.broker.latency._replies
+        self.assertEqual(histograms[("video", "slow")].count, 1)
+        self.assertGreaterEqual(histograms[("video", "slow")].percentile(95),
+                                0.5)
+        self.assertEqual(histograms[("video", "fast")].count, 1)
+        self.assertIn("slow", self.broker.known_handlers["video"])
+
+        # Only a bounded number of resolved queries are remembered
+        self.broker.max_recent = 1
+        other = self.broker.start_query("video", "dad", message)
+        self._expire(other)
+        self._reply(session, "late", conf=0.9)
+        self.assertNotIn(("video", "late"), histograms)
+
+    def test_priority_and_fair_share(self):
+        from skill_communication.broker import QueryLimitExceeded, QueryType
+        self.broker.register_query_type(QueryType(
+            "urgent", "test:request.urgent", "test:start.urgent", timeout=3,
+            priority=0, max_timeout=1.5))
+        message = Message("test", {"utterance": "x"}, {"username": "user"})
+        session = self.broker.start_query("urgent", "mom", message)
+        self.assertEqual(session.priority, 0)
+        self.assertEqual(session.timeout, 1.5)
+        # Responses and timeouts are handled by the priority of their query
+        self.assertEqual(self.broker.get_priority(
+            Message("test:request.urgent.response")), 0)
+        self.assertEqual(self.broker.get_priority(
+            Message("test:start.video.response")), 1)
+        self.assertEqual(self.broker.get_priority(
+            Message("timeout", {"query_id": session.query_id})), 0)
+
+        # One user cannot hold more than their share of sessions
+        self.broker.configure({"max_user_sessions": 2,
+                               "metrics_enabled": True})
+        self.broker.start_query("video", "mom", message)
+        self.broker.start_query("video", "dad", message)
+        with self.assertRaises(QueryLimitExceeded):
+            self.broker.start_query("video", "bob", message)
+        counters = self.broker.metrics.snapshot()["counters"]["video"]
+        self.assertEqual(counters["rejected_user"], 1)
+        other = Message("test", {"utterance": "x"}, {"username": "other"})
+        self.broker.start_query("video", "bob", other)
+
+        # Resolved sessions free the user's share
+        self._expire(self.broker.start_query("urgent", "dad", message))
+        self._expire(list(self.broker.sessions.values())[1])
+        self.broker.start_query("video", "bob", message)
+
+    def test_cached_resolution(self):
+        self.video.cacheable = True
+        message = Message("test", {"utterance": "x"}, {"username": "user"})
+        session = self.broker.start_query("video", "Mom", message)
+        self._reply(session, "handler", conf=0.5, skill_data={"id": 1})
+        self._expire(session)
+        self.assertEqual(len(self.broker.cache), 1)
+
+        # A repeat right after the dispatch is not dispatched again
+        self.emit.reset_mock()
+        self.assertIs(self.broker.start_query("video", "mom", message),
+                      session)
+        self.emit.assert_not_called()
+
+        # Later repeat requests are dispatched without a query
+        session.dispatched_at -= self.broker.coalesce_window
+        session = self.broker.start_query("video", "mom ", message)
+        self.emit.assert_called_once()
+        dispatch = self.emit.call_args[0][0]
+        self.assertEqual(dispatch.msg_type, "test:start.video")
+        self.assertEqual(dispatch.data["skill_data"], {"id": 1})
+        self.assertTrue(dispatch.data["cached"])
+        self.assertNotIn(session.query_id, self.broker.sessions)
+
+        # A failed cached dispatch queries handlers again
+        cached = session
+        self.broker.handle_result(message.forward(
+            self.video.result_msg, {"skill_id": "handler",
+                                    "query_id": cached.query_id,
+                                    "success": False}))
+        self.assertEqual(len(self.broker.cache), 0)
+        request = self.emit.call_args[0][0]
+        self.assertEqual(request.msg_type, "test:request.video")
+        self.assertNotEqual(request.data["query_id"], cached.query_id)
+        self.assertEqual(request.data["request"], "mom ")
+        self.no_match.assert_not_called()
+
+        # Other users are not served from the cache
+        other = Message("test", {"utterance": "x"}, {"username": "other"})
+        session = self.broker.start_query("video", "mom", other)
+        self.assertIn(session.query_id, self.broker.sessions)
+
+        # Reported failures invalidate the cache
+        self.broker.cache.put("user", "video", "mom", "handler", {"id": 1})
+        self.broker.handle_result(message.forward(
+            self.video.result_msg, {"skill_id": "handler", "request": "mom",
+                                    "success": False}))
+        self.assertEqual(len(self.broker.cache), 0)
+
+    def test_cached_ack_timeout(self):
+        self.video.cacheable = True
+        message = Message("test", {"utterance": "x"}, {"username": "user"})
+        self.broker.register_handler({"skill_id": "handler",
+                                      "query_types": ["video"], "ack": True})
+        self.broker.cache.put("user", "video", "mom", "handler", {"id": 1})
+        session = self.broker.start_query("video", "mom", message)
+        self.assertTrue(self.emit.call_args[0][0].data["cached"])
+        self.schedule.assert_called_once_with(session,
+                                              self.broker.ack_timeout)
+
+        # A cached handler that never reports a result is treated as failed
+        self._expire(session)
+        self.assertEqual(self.broker._dispatched, dict())
+        self.assertEqual(len(self.broker.cache), 0)
+        request = self.emit.call_args[0][0]
+        self.assertEqual(request.msg_type, "test:request.video")
+        self.assertNotEqual(request.data["query_id"], session.query_id)
+        self.assertEqual(self.broker.circuits.snapshot()["handler"]
+                         ["strikes"], 1)
+
+    def test_cached_miss(self):
+        self.video.cacheable = True
+        message = Message("test", {"utterance": "x"}, {"username": "user"})
+        session = self.broker.start_query("video", "Nobody", message)
+        self._expire(session)
+        self.no_match.assert_called_once_with(session)
+        self.assertEqual(len(self.broker.misses), 1)
+
+        # Repeat requests fail without a query
+        self.emit.reset_mock()
+        self.schedule.reset_mock()
+        session = self.broker.start_query("video", "nobody ", message)
+        self.no_match.assert_called_with(session)
+        self.emit.assert_not_called()
+        self.schedule.assert_not_called()
+        self.assertNotIn(session.query_id, self.broker.sessions)
+
+        # Other users still query handlers
+        other = Message("test", {"utterance": "x"}, {"username": "other"})
+        session = self.broker.start_query("video", "nobody", other)
+        self.assertIn(session.query_id, self.broker.sessions)
+
+        # Updated contacts may resolve the contact
+        self.broker.update_contacts({"skill_id": "phone", "contacts": []})
+        self.assertEqual(len(self.broker.misses), 0)
+        session = self.broker.start_query("video", "nobody", message)
+        self.assertIn(session.query_id, self.broker.sessions)
+        self._expire(session)
+        self.assertEqual(len(self.broker.misses), 1)
+
+        # So may a newly registered handler
+        self.broker.register_handler({"skill_id": "new",
+                                      "query_types": ["video"]})
+        self.assertEqual(len(self.broker.misses), 0)
+
+    def test_cached_resolution_confirmed(self):
+        self.video.cacheable = True
+        self.broker.configure({"confirm_cached": True})
+        message = Message("test", {"utterance": "x"}, {"username": "user"})
+        self.broker.cache.put("user", "video", "mom", "old", {"id": 0})
+        session = self.broker.start_query("video", "mom", message)
+        self.assertEqual(session.dispatched_to, "old")
+        self.assertEqual(self.emit.call_args_list[0][0][0].msg_type,
+                         "test:start.video")
+        self.assertEqual(self.emit.call_args_list[1][0][0].msg_type,
+                         "test:request.video")
+        self._reply(session, "new", conf=0.9, skill_data={"id": 1})
+        self._expire(session)
+        # Background confirmation updates the cache without dispatching
+        self.assertEqual(self.emit.call_count, 2)
+        self.assertEqual(self.broker.cache.get("user", "video", "mom"),
+                         {"skill_id": "new", "skill_data": {"id": 1}})
+
+        # If the cached handler fails, the confirmation is dispatched
+        self.broker.cache.put("user", "video", "dad", "old", {"id": 0})
+        session = self.broker.start_query("video", "dad", message)
+        self._reply(session, "new", conf=0.9, skill_data={"id": 2})
+        self.broker.handle_result(message.forward(
+            self.video.result_msg, {"skill_id": "old", "request": "dad",
+                                    "query_id": session.query_id,
+                                    "success": False}))
+        self._expire(session)
+        dispatch = self.emit.call_args[0][0]
+        self.assertEqual(dispatch.msg_type, "test:start.video")
+        self.assertEqual(dispatch.data["skill_id"], "new")
+
+    def test_extended_deadline(self):
+        session = self.broker.start_query("video", "mom",
+                                          Message("test", {"utterance": "x"}))
+        self._reply(session, "slow", searching=True)
+        # A timer scheduled before the extension does not resolve the query
+        self.broker.handle_timeout(session.query_id)
+        self.assertIn(session.query_id, self.broker.sessions)
+        remaining = self.schedule.call_args[0][1]
+        self.assertAlmostEqual(remaining, self.video.extension_timeout,
+                               delta=0.1)
+
+    def test_no_lock_held_while_dispatching(self):
+        dispatching = Event()
+        release = Event()
+
+        def _emit(message):
+            if message.msg_type == "test:start.video":
+                dispatching.set()
+                release.wait(5)
+        self.emit.side_effect = _emit
+        message = Message("test", {"utterance": "x"})
+        first = self.broker.start_query("video", "mom", message)
+        second = self.broker.start_query("video", "dad", message)
+        self._reply(first, "handler", conf=0.5)
+        thread = Thread(target=self._expire, args=(first,), daemon=True)
+        thread.start()
+        self.assertTrue(dispatching.wait(5))
+
+        # Other sessions are handled while the first is dispatching
+        self._reply(second, "handler", conf=0.5)
+        self.assertEqual(second.reply_count, 1)
+        third = self.broker.start_query("video", "bob", message)
+        self.assertIn(third.query_id, self.broker.sessions)
+        release.set()
+        thread.join(5)
+        self.assertNotIn(first.query_id, self.broker.sessions)
+
+    def test_concurrent_resolution_throughput(self):
+        delay = 0.05
+        self.emit.side_effect = lambda _: sleep(delay)
+        message = Message("test", {"utterance": "x"})
+        sessions = [self.broker.start_query("video", f"contact {i}", message)
+                    for i in range(20)]
+        for session in sessions:
+            self._reply(session, "handler", conf=0.5)
+        threads = [Thread(target=self._expire, args=(session,), daemon=True)
+                   for session in sessions]
+        start = monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        elapsed = monotonic() - start
+        self.assertEqual(self.broker.sessions, dict())
+        # Dispatches are not serialized behind a shared lock
+        self.assertLess(elapsed, delay * len(sessions) / 2)
+
+    def test_metrics(self):
+        self.broker.configure({"metrics_enabled": True})
+        message = Message("test", {"utterance": "x"})
+        session = self.broker.start_query("video", "mom", message)
+        self._reply(session, "slow", searching=True)
+        self._reply(session, "fast", conf=0.5)
+        self._reply(session, "tie", conf=0.5)
+        self._reply(session, "slow", conf=0.1)
+        self._expire(session)
+        self.assertEqual(session.phases, {"first_reply"})
+        session = self.broker.start_query("video", "dad", message)
+        self._expire(session)
+
+        metrics = self.broker.metrics.snapshot()
+        counters = metrics["counters"]["video"]
+        self.assertEqual(counters["queries"], 2)
+        self.assertEqual(counters["timeouts"], 2)
+        self.assertEqual(counters["extensions"], 1)
+        self.assertEqual(counters["ties"], 1)
+        self.assertEqual(counters["no_match"], 1)
+        self.assertEqual(counters["dispatched_total"], 1)
+        self.assertEqual(counters["broadcast_total"], 2)
+        self.assertEqual(metrics["phases"]["video"]["first_reply"]["samples"],
+                         1)
+
+    def test_admission_control(self):
+        from skill_communication.broker import QueryLimitExceeded
+        self.broker.configure({"max_sessions": 2})
+        message = Message("test", {"utterance": "x"})
+        first = self.broker.start_query("video", "a", message)
+        self.broker.start_query("video", "b", message)
+        with self.assertRaises(QueryLimitExceeded):
+            self.broker.start_query("video", "c", message)
+        self._expire(first)
+        self.broker.start_query("video", "c", message)
+        self.assertEqual(self.broker.get_usage()["sessions"], {"video": 2})
+
+        # Concurrent requests cannot exceed the limit
+        self.broker.configure({"max_sessions": 5})
+        barrier = Barrier(20)
+        started = list()
+
+        def _start(request):
+            barrier.wait()
+            try:
+                started.append(self.broker.start_query("video", request,
+                                                       message))
+            except QueryLimitExceeded:
+                pass
+
+        threads = [Thread(target=_start, args=(f"user {i}",))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(started), 3)
+        self.assertEqual(self.broker.get_usage()["sessions"], {"video": 5})
+
+    def test_sweep(self):
+        self.broker.configure({"session_ttl": 10})
+        message = Message("test", {"utterance": "x"})
+        orphan = self.broker.start_query("video", "a", message)
+        active = self.broker.start_query("video", "b", message)
+        self._reply(orphan, "handler", conf=0.5, skill_data={"a": "b" * 100})
+        self.assertGreater(self.broker.get_usage()["reply_bytes"], 100)
+        orphan.created -= 11
+        self.assertEqual(self.broker.sweep(), {orphan.query_id})
+        self.assertEqual(set(self.broker.sessions), {active.query_id})
+        self.cancel.assert_called_with(orphan)
+        # The prepared handler is told it will not be dispatched
+        cancel = self.emit.call_args[0][0]
+        self.assertEqual(cancel.msg_type, "communication:prepare.cancel")
+        self.assertEqual(cancel.data["skill_id"], "handler")
+        self.assertEqual(self.broker.get_usage(),
+                         {"sessions": {"video": 1}, "reply_bytes": 0})
+        # A late timeout for the removed session does nothing
+        self._expire(orphan)
+        self.assertEqual(self.emit.call_count, 4)
+
+    def test_coalesce_duplicates(self):
+        message = Message("test", {"utterance": "x"}, {"username": "user"})
+        session = self.broker.start_query("video", "Mom", message)
+        self.assertIs(self.broker.start_query("video", "mom", message),
+                      session)
+        self.assertEqual(self.emit.call_count, 1)
+        self.schedule.assert_called_once()
+
+        # Other users and requests start new queries
+        other = Message("test", {"utterance": "x"}, {"username": "other"})
+        self.assertIsNot(self.broker.start_query("video", "mom", other),
+                         session)
+        self.assertIsNot(self.broker.start_query("video", "dad", message),
+                         session)
+
+        # Requests outside the window or after resolution are not attached
+        session.created -= self.broker.coalesce_window
+        self.assertIsNot(self.broker.start_query("video", "mom", message),
+                         session)
+        self._reply(session, "handler", conf=0.5)
+        self._expire(session)
+        self.assertEqual(self.emit.call_args[0][0].msg_type,
+                         "test:start.video")
+        self.assertEqual(len(self.broker.sessions), 3)
+
+        # Repeats shortly after a dispatch are attached to its session
+        dispatched = list(self.broker.sessions.values())[-1]
+        self._reply(dispatched, "handler", conf=0.5)
+        self._expire(dispatched)
+        emitted = self.emit.call_count
+        self.assertIs(self.broker.start_query("video", "mom", message),
+                      dispatched)
+        self.assertEqual(self.emit.call_count, emitted)
+        dispatched.dispatched_at -= self.broker.coalesce_window
+        self.assertIsNot(self.broker.start_query("video", "mom", message),
+                         dispatched)
+
+    def test_contact_index(self):
+        self.video.cacheable = True
+        message = Message("test", {"utterance": "x"})
+        for skill_id in ("phone", "chat", "other"):
+            self.broker.add_known_handler("video", skill_id)
+        self.broker.update_contacts({"skill_id": "phone",
+                                     "contacts": ["Mom", "Robert Smith"]})
+        self.broker.update_contacts({"skill_id": "chat",
+                                     "contacts": ["Mom", "Alice"]})
+
+        # Only handlers with a matching contact are expected
+        session = self.broker.start_query("video", "mom", message)
+        self.assertEqual(session.expected, {"phone", "chat"})
+        self.assertEqual(self.emit.call_args[0][0].data["handlers"],
+                         ["chat", "phone"])
+        session = self.broker.start_query("video", "rupert smyth", message)
+        self.assertEqual(session.expected, {"phone"})
+
+        # Unknown contacts are broadcast to all handlers
+        session = self.broker.start_query("video", "carol", message)
+        self.assertEqual(session.expected, {"phone", "chat", "other"})
+        self.assertNotIn("handlers", self.emit.call_args[0][0].data)
+
+        # A single confident match is dispatched if the handler allows it
+        self.broker.update_contacts({"skill_id": "chat",
+                                     "added": [{"name": "Alice Jones",
+                                                "data": {"id": 3}}],
+                                     "direct_dispatch": True})
+        self.schedule.reset_mock()
+        session = self.broker.start_query("video", "alice jones", message)
+        dispatch = self.emit.call_args[0][0]
+        self.assertEqual(dispatch.msg_type, "test:start.video")
+        self.assertEqual(dispatch.data["skill_id"], "chat")
+        self.assertEqual(dispatch.data["skill_data"], {"id": 3})
+        self.assertEqual(dispatch.data["contact"], "Alice Jones")
+        self.assertNotIn(session.query_id, self.broker.sessions)
+        self.schedule.assert_not_called()
+
+        # Contacts that only sound alike are queried, not dispatched
+        self.broker.update_contacts({"skill_id": "chat",
+                                     "added": ["Amy"]})
+        session = self.broker.start_query("video", "ann", message)
+        self.assertEqual(session.expected, {"chat"})
+        self.assertEqual(self.emit.call_args[0][0].msg_type,
+                         "test:request.video")
+        self.schedule.assert_called_once()
+
+        # Deltas without the flag keep direct dispatch; bad entries are
+        # skipped
+        self.broker.update_contacts({"skill_id": "chat",
+                                     "added": [{"data": {"id": 4}}, 5,
+                                               "Dave"],
+                                     "removed": [None]})
+        self.assertIn("chat", self.broker.contacts.direct_dispatch)
+        self.assertEqual(len(self.broker.contacts.match("dave")), 1)
+        self.broker.update_contacts({"skill_id": "chat",
+                                     "direct_dispatch": False})
+        self.assertNotIn("chat", self.broker.contacts.direct_dispatch)
+
+        self.broker.deregister_handler("chat")
+        self.assertEqual(self.broker.contacts.handlers, {"phone"})
+
+    def test_no_match(self):
+        session = self.broker.start_query("video", "mom",
+                                          Message("test", {"utterance": "x"}))
+        self._expire(session)
+        self.no_match.assert_called_once_with(session)
+
+    def test_fallback_dispatch(self):
+        self.broker.metrics.enabled = True
+        session = self.broker.start_query("video", "mom",
+                                          Message("test", {"utterance": "x"}))
+        self.broker.register_handler({"skill_id": "slow",
+                                      "query_types": ["video"], "ack": True})
+        self._reply(session, "best", conf=0.9)
+        self._reply(session, "worst", conf=0.5)
+        self._reply(session, "slow", conf=0.7)
+        self.schedule.reset_mock()
+        self._expire(session)
+        self.assertEqual(self.emit.call_args[0][0].data["skill_id"], "best")
+        self.schedule.assert_called_once_with(session,
+                                              self.broker.ack_timeout)
+
+        # A failed handler falls back to the next candidate without a query
+        self.emit.reset_mock()
+        self.broker.handle_result(Message(self.video.result_msg, {
+            "skill_id": "best", "query_id": session.query_id,
+            "success": False}))
+        dispatch = self.emit.call_args[0][0]
+        self.emit.assert_called_once()
+        self.assertEqual(dispatch.msg_type, "test:start.video")
+        self.assertEqual(dispatch.data["skill_id"], "slow")
+
+        # Results from handlers that are no longer dispatched are ignored
+        self.broker.handle_result(Message(self.video.result_msg, {
+            "skill_id": "best", "query_id": session.query_id,
+            "success": False}))
+        self.emit.assert_called_once()
+
+        # A registered handler that does not acknowledge in time has failed
+        self._expire(session)
+        self.assertEqual(self.emit.call_args[0][0].data["skill_id"], "worst")
+        self.broker.handle_result(Message(self.video.result_msg, {
+            "skill_id": "worst", "query_id": session.query_id,
+            "success": True}))
+        self._expire(session)
+        self.assertEqual(self.emit.call_count, 2)
+        self.no_match.assert_not_called()
+        self.assertEqual(self.broker.metrics.snapshot()["outcomes"]["video"],
+                         {"best": {"failed": 1}, "slow": {"timeout": 1},
+                          "worst": {"success": 1}})
+        self.assertEqual(self.broker._dispatched, dict())
+
+    def test_fallback_exhausted(self):
+        session = self.broker.start_query("video", "mom",
+                                          Message("test", {"utterance": "x"}))
+        self._reply(session, "only", conf=0.9)
+        self._expire(session)
+        self.broker.handle_result(Message(self.video.result_msg, {
+            "skill_id": "only", "query_id": session.query_id,
+            "success": False}))
+        self.no_match.assert_called_once_with(session)
+
+        # Handlers that did not register to acknowledge are assumed to succeed
+        self.no_match.reset_mock()
+        session = self.broker.start_query("video", "dad",
+                                          Message("test", {"utterance": "x"}))
+        self._reply(session, "first", conf=0.9)
+        self._reply(session, "second", conf=0.8)
+        self._expire(session)
+        self.emit.reset_mock()
+        self._expire(session)
+        self.emit.assert_not_called()
+        self.assertNotIn(session.query_id, self.broker._dispatched)
+
+    def test_resolve_ties_with_priors(self):
+        message = Message("test", {"utterance": "x"}, {"username": "user"})
+        self.broker.priors.record("user", "video", None, "second", True)
+        session = self.broker.start_query("video", "mom", message)
+        self._reply(session, "first", conf=0.8)
+        self._reply(session, "second", conf=0.8)
+        self._reply(session, "low", conf=0.5)
+        self.assertEqual(session.prepared, "first")
+        self._expire(session)
+        self.assertEqual(self.emit.call_args[0][0].data["skill_id"], "second")
+        self.assertEqual([r["skill_id"] for r in session.fallbacks],
+                         ["first", "low"])
+        # The prepared leader is told it will not be dispatched
+        cancel = self.emit.call_args_list[-2][0][0]
+        self.assertEqual(cancel.msg_type, "communication:prepare.cancel")
+        self.assertEqual(cancel.data["skill_id"], "first")
+
+        # Dispatch outcomes are learned
+        self.broker.handle_result(Message(self.video.result_msg, {
+            "skill_id": "second", "query_id": session.query_id,
+            "success": False}))
+        self.assertEqual(self.emit.call_args[0][0].data["skill_id"], "first")
+        self.broker.handle_result(Message(self.video.result_msg, {
+            "skill_id": "first", "query_id": session.query_id}))
+        scores = self.broker.priors.get_scores("user", "video")
+        self.assertGreater(scores["first"], scores["second"])
+
+    def test_shared_store(self):
+        from tempfile import TemporaryDirectory
+        from os.path import join
+        from skill_communication.broker import CommonQueryBroker
+        from skill_communication.store import SQLiteSessionStore
+        with TemporaryDirectory() as tmp_dir:
+            path = join(tmp_dir, "sessions.db")
+            other_emit = Mock()
+            other = CommonQueryBroker(other_emit, Mock(), Mock(), Mock())
+            other.register_query_type(self.video)
+            other.node_id = "other"
+            self.broker.use_store(SQLiteSessionStore(path))
+            other.use_store(SQLiteSessionStore(path))
+
+            session = self.broker.start_query(
+                "video", "mom", Message("test", {"utterance": "x"}))
+            # Responses may be received by either instance
+            self._reply(session, "local", conf=0.5)
+            other.handle_response(Message(self.video.response_msg, {
+                "request": "mom", "query_id": session.query_id,
+                "skill_id": "remote", "conf": 0.9}))
+            other.handle_response(Message(self.video.response_msg, {
+                "request": "mom", "query_id": session.query_id,
+                "skill_id": "declined", "declined": True}))
+            self.assertEqual(session.reply_count, 1)
+
+            self._expire(session)
+            dispatch = self.emit.call_args[0][0]
+            self.assertEqual(dispatch.data["skill_id"], "remote")
+            self.assertEqual(session.declined, {"declined"})
+            other_emit.assert_not_called()
+            # Late responses are not stored
+            self.assertFalse(other.store.add_reply(session.query_id,
+                                                   {"skill_id": "late"}))
+
+            # A session claimed by another instance is not dispatched again
+            self.emit.reset_mock()
+            session = self.broker.start_query(
+                "video", "dad", Message("test", {"utterance": "x"}))
+            self.assertTrue(other.store.claim(session.query_id, "other"))
+            self._reply(session, "local", conf=0.5)
+            self._expire(session)
+            self.emit.assert_called_once()
+            self.assertNotIn(session.query_id, self.broker.sessions)
+            self.broker.store.close()
+            other.store.close()
+
+    def test_deferred_dispatch(self):
+        from time import time
+        on_deferred = Mock()
+        self.broker._on_deferred = on_deferred
+        session = self.broker.start_query("video", "mom",
+                                          Message("test", {"utterance": "x"}),
+                                          deliver_at=time() + 3600)
+        self.assertEqual(self.emit.call_args[0][0].data["deliver_at"],
+                         session.deliver_at)
+        self._reply(session, "handler", conf=0.5)
+        self.emit.reset_mock()
+        self.schedule.reset_mock()
+        self._expire(session)
+        # The query is resolved now and dispatched later
+        self.emit.assert_not_called()
+        self.schedule.assert_not_called()
+        deferred_session, dispatch = on_deferred.call_args[0]
+        self.assertIs(deferred_session, session)
+        self.assertEqual(dispatch.msg_type, "test:start.video")
+        self.assertEqual(dispatch.data["skill_id"], "handler")
+        self.assertEqual(self.broker._dispatched, dict())
+
+        # A repeat for another delivery time is not coalesced
+        message = Message("test", {"utterance": "x"})
+        self.assertIs(self.broker.start_query("video", "mom", message,
+                                              deliver_at=session.deliver_at),
+                      session)
+        later = self.broker.start_query("video", "mom", message,
+                                        deliver_at=session.deliver_at + 3600)
+        self.assertIsNot(later, session)
+        self.assertEqual(later.deliver_at, session.deliver_at + 3600)
+
+    def test_batch_query(self):
+        from skill_communication.batch import split_recipients
+        request = "message to Alice, Bob and the team saying I'm late"
+        batch = split_recipients(request)
+        session = self.broker.start_query("video", request,
+                                          Message("test", {"utterance": "x"}),
+                                          batch=batch)
+        broadcast = self.emit.call_args[0][0]
+        self.assertEqual(broadcast.data["requests"], batch)
+
+        # Replies with an invalid confidence are rejected as a whole
+        self._reply(session, "bad", replies=[
+            {"recipient": "Alice", "conf": "high"}])
+        self.assertNotIn("bad", session.responders)
+        self.assertEqual(self.broker.circuits.snapshot()["bad"]["strikes"], 1)
+        self._reply(session, "chat", replies=[
+            {"recipient": "Alice", "conf": 0.6, "skill_data": {"id": 1}},
+            {"recipient": "the team", "conf": 0.9, "skill_data": {"id": 2}},
+            {"recipient": "Mallory", "conf": 1.0}])
+        self._reply(session, "sms", replies=[
+            {"recipient": "Alice", "conf": 0.8, "skill_data": {"id": 3}}])
+        self.assertEqual(set(session.batch_best), {"Alice", "the team"})
+
+        self.emit.reset_mock()
+        self._expire(session)
+        messages = [call[0][0] for call in self.emit.call_args_list]
+        self.assertEqual([m.msg_type for m in messages],
+                         ["test:start.video", "test:start.video",
+                          "test:start.video.batch"])
+        self.assertEqual(messages[0].data["skill_id"], "sms")
+        self.assertEqual(messages[0].data["recipient"], "Alice")
+        self.assertEqual(messages[0].data["message"], "I'm late")
+        self.assertEqual(messages[1].data["skill_data"], {"id": 2})
+        self.assertEqual(messages[2].data["outcomes"], [
+            {"recipient": "Alice", "skill_id": "sms", "dispatched": True},
+            {"recipient": "Bob", "skill_id": None, "dispatched": False},
+            {"recipient": "the team", "skill_id": "chat",
+             "dispatched": True}])
+        self.assertEqual(session.unresolved, ["Bob"])
+        self.no_match.assert_called_once_with(session)
+
+    def test_split_recipients(self):
+        from skill_communication.batch import split_recipients
+        self.assertEqual(split_recipients("text to Alice, Bob, and Bob: hi"),
+                         [{"recipient": "Alice", "message": "hi"},
+                          {"recipient": "Bob", "message": "hi"}])
+        self.assertIsNone(split_recipients("message to Alice saying hi"))
+        self.assertIsNone(split_recipients("tell mom and dad hi"))
+        self.assertEqual(split_recipients("I want to send a message to "
+                                          "Alice and Bob saying hi"),
+                         [{"recipient": "Alice", "message": "hi"},
+                          {"recipient": "Bob", "message": "hi"}])
+        self.assertEqual(split_recipients("message to alice, Alice and Bob "
+                                          "saying go to bed"),
+                         [{"recipient": "alice", "message": "go to bed"},
+                          {"recipient": "Bob", "message": "go to bed"}])
+        self.assertIsNone(split_recipients("message to alice and Alice "
+                                           "saying hi"))
+
+
+class TestAsyncioTimers(unittest.TestCase):
+    def setUp(self):
+        from skill_communication.timers import AsyncioTimers
+        self.timed_out = list()
+        self.done = Event()
+
+        def _on_timeout(query_id):
+            self.timed_out.append(query_id)
+            self.done.set()
+        self.timers = AsyncioTimers(_on_timeout)
+        self.timers.start()
+
+    def tearDown(self):
+        self.timers.shutdown()
+
+    def test_schedule(self):
+        session = Mock(query_id="test", priority=1)
+        start = monotonic()
+        self.timers.schedule(session, 0.1)
+        self.assertTrue(self.done.wait(2))
+        self.assertGreaterEqual(monotonic() - start, 0.1)
+        self.assertEqual(self.timed_out, ["test"])
+        self.assertEqual(self.timers.pending, 0)
+
+    def test_rearm_and_cancel(self):
+        extended = Mock(query_id="extended", priority=1)
+        cancelled = Mock(query_id="cancelled", priority=1)
+        start = monotonic()
+        self.timers.schedule(extended, 0.05)
+        self.timers.schedule(cancelled, 0.05)
+        self.timers.cancel(cancelled)
+        self.timers.schedule(extended, 0.3)
+        self.assertTrue(self.done.wait(2))
+        self.assertGreaterEqual(monotonic() - start, 0.3)
+        sleep(0.1)
+        self.assertEqual(self.timed_out, ["extended"])
+
+        # Cancel then re-arm schedules a single new timeout
+        self.done.clear()
+        self.timers.schedule(cancelled, 0.05)
+        self.timers.cancel(cancelled)
+        self.timers.schedule(cancelled, 0.05)
+        self.assertTrue(self.done.wait(2))
+        sleep(0.1)
+        self.assertEqual(self.timed_out, ["extended", "cancelled"])
+
+    def test_shutdown(self):
+        session = Mock(query_id="test", priority=1)
+        self.timers.schedule(session, 0.05)
+        self.timers.shutdown()
+        # Timeouts scheduled after shutdown are ignored
+        self.timers.schedule(session, 0.05)
+        self.timers.cancel(session)
+        sleep(0.2)
+        self.assertEqual(self.timed_out, list())
+        self.assertEqual(self.timers.pending, 0)
+
+        # Timers may be started again
+        self.timers.start()
+        self.timers.schedule(session, 0.05)
+        self.assertTrue(self.done.wait(2))
+        self.assertEqual(self.timed_out, ["test"])
+
+    def test_broker_timeouts(self):
+        from skill_communication.broker import CommonQueryBroker, QueryType
+        emitted = list()
+        broker = CommonQueryBroker(emitted.append, self.timers.schedule,
+                                   self.timers.cancel, Mock())
+        self.timers._on_timeout = broker.handle_timeout
+        broker.register_query_type(QueryType("test", "test:request",
+                                             "test:dispatch", timeout=0.1))
+        session = broker.start_query("test", "mom",
+                                     Message("test", {"utterance": "x"}))
+        broker.handle_response(Message("test:request.response",
+                                       {"query_id": session.query_id,
+                                        "skill_id": "handler",
+                                        "request": "mom", "conf": 0.5}))
+        sleep(0.5)
+        self.assertEqual(emitted[-1].msg_type, "test:dispatch")
+        self.assertEqual(broker.sessions, dict())
+
+    def test_priority(self):
+        from skill_communication.timers import AsyncioTimers
+
+        def _on_timeout(query_id):
+            self.timed_out.append(query_id)
+            if query_id == "busy":
+                sleep(0.2)
+            if len(self.timed_out) == 5:
+                self.done.set()
+        timers = AsyncioTimers(_on_timeout, max_workers=1)
+        timers.start()
+        try:
+            timers.schedule(Mock(query_id="busy", priority=1), 0)
+            sleep(0.05)
+            # Expired calls are handled ahead of expired messages
+            for query_id, priority in (("message1", 1), ("call1", 0),
+                                       ("message2", 1), ("call2", 0)):
+                timers.schedule(Mock(query_id=query_id,
+                                     priority=priority), 0)
+            self.assertTrue(self.done.wait(2))
+        finally:
+            timers.shutdown()
+        self.assertEqual(self.timed_out, ["busy", "call1", "call2",
+                                          "message1", "message2"])
+
+    def test_many_sessions(self):
+        count = 5000
+        finished = Event()
+
+        def _on_timeout(query_id):
+            self.timed_out.append(query_id)
+            if len(self.timed_out) == count:
+                finished.set()
+        self.timers._on_timeout = _on_timeout
+        for i in range(count):
+            self.timers.schedule(Mock(query_id=str(i), priority=1), 0.2)
+        self.assertTrue(finished.wait(10))
+        self.assertEqual(len(set(self.timed_out)), count)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_benchmark(self):
+        from benchmark import run_benchmark
+        results = run_benchmark(handlers=2, requests=20, concurrency=5,
+                                search_rate=0.5, search_latency=0.05,
+                                tie_rate=0.5, run_timeout=30)
+        self.assertTrue(results["completed"])
+        self.assertEqual(results["resolved"], 20)
+        self.assertGreater(results["throughput_per_s"], 0)
+        self.assertIsNotNone(results["latency_p95_s"])
+        self.assertGreater(results["bytes_per_session"], 0)
+
+
+class TestBusRecorder(unittest.TestCase):
+    def test_rotation(self):
+        from os import listdir
+        from os.path import join
+        from tempfile import TemporaryDirectory
+        from skill_communication.recorder import BusRecorder, read_recording
+        with TemporaryDirectory() as tmp_dir:
+            path = join(tmp_dir, "recording.jsonl")
+            recorder = BusRecorder(path, max_bytes=400, backups=2)
+            for i in range(20):
+                recorder.record("in", Message("test", {"i": i}))
+            recorder.close()
+            recorder.record("in", Message("test", {"i": 20}))
+            self.assertEqual(sorted(listdir(tmp_dir)),
+                             ["recording.jsonl", "recording.jsonl.1",
+                              "recording.jsonl.2"])
+            events = list(read_recording(f"{path}.2", f"{path}.1", path))
+        indices = [e["data"]["i"] for e in events]
+        self.assertEqual(indices, list(range(indices[0], 20)))
+        self.assertGreater(indices[0], 0)
+        self.assertEqual(events[-1]["kind"], "in")
+        self.assertEqual(events[-1]["type"], "test")
+
+
+class TestQueryMetrics(unittest.TestCase):
+    def test_disabled(self):
+        from skill_communication.metrics import QueryMetrics
+        metrics = QueryMetrics()
+        session = Mock(query_type="call", phases=set(), created=monotonic())
+        metrics.count("call", "queries")
+        metrics.phase(session, "broadcast", once=True)
+        self.assertEqual(session.phases, set())
+        self.assertEqual(metrics.snapshot()["counters"], dict())
+
+    def test_prometheus(self):
+        from os.path import join
+        from tempfile import TemporaryDirectory
+        from skill_communication.metrics import QueryMetrics
+        metrics = QueryMetrics(enabled=True)
+        session = Mock(query_type="call", phases=set(), created=monotonic())
+        metrics.count("call", "timeouts", 2)
+        metrics.phase(session, "resolved")
+        text = metrics.to_prometheus()
+        self.assertIn('neon_communication_events_total{query_type="call",'
+                      'event="timeouts"} 2', text)
+        self.assertIn('neon_communication_phase_seconds{query_type="call",'
+                      'phase="resolved",quantile="0.95"}', text)
+        with TemporaryDirectory() as tmp:
+            path = join(tmp, "metrics.prom")
+            metrics.write_prometheus(path)
+            with open(path) as f:
+                self.assertEqual(f.read(), text)
+
+
+class TestLatencyTracker(unittest.TestCase):
+    def test_histogram(self):
+        from skill_communication.latency import LatencyHistogram
+        histogram = LatencyHistogram(window=100)
+        self.assertIsNone(histogram.percentile(95))
+        for i in range(100):
+            histogram.record(0.1 if i < 95 else 5)
+        self.assertGreaterEqual(histogram.percentile(95), 0.1)
+        self.assertLess(histogram.percentile(95), 0.2)
+        self.assertGreaterEqual(histogram.percentile(99), 5)
+
+        # Old samples roll out of the histogram
+        for i in range(200):
+            histogram.record(1)
+        self.assertEqual(histogram.count, 200)
+        self.assertGreaterEqual(histogram.percentile(50), 1)
+        self.assertLess(histogram.percentile(99), 2)
+
+    def test_timeout_bounds(self):
+        from skill_communication.latency import LatencyTracker
+        tracker = LatencyTracker(min_timeout=0.5, max_timeout=2,
+                                 max_extension_timeout=4, min_samples=2)
+        self.assertEqual(tracker.get_timeout("call", [], 1), 1)
+        tracker.record_reply("call", "skill", 0.01)
+        self.assertEqual(tracker.get_timeout("call", ["skill"], 1), 1)
+        tracker.record_reply("call", "skill", 0.01)
+        self.assertEqual(tracker.get_timeout("call", ["skill"], 1), 0.5)
+        tracker.record_search("call", "skill", 20)
+        tracker.record_search("call", "skill", 20)
+        self.assertEqual(tracker.get_extension_timeout("call", "skill", 5), 4)
+        self.assertEqual(tracker.get_extension_timeout("call", "other", 5), 5)
+
+
+class TestContactIndex(unittest.TestCase):
+    def test_phonetic_key(self):
+        from skill_communication.contacts import get_phonetic_key
+        self.assertEqual(get_phonetic_key("robert"), "r163")
+        self.assertEqual(get_phonetic_key("rupert"), "r163")
+        self.assertEqual(get_phonetic_key("ashcraft smith"), "a261 s530")
+
+    def test_match(self):
+        from skill_communication.contacts import ContactIndex
+        index = ContactIndex()
+        index.update("one", ["Mom", "Robert Smith", "Alice Jones"])
+        index.update("two", [{"name": "Mother", "data": {"id": 1}},
+                             "Alice Johnson"])
+        matches = index.match("MOM")
+        self.assertEqual(len(matches), 1)
+        self.assertEqual(matches[0].skill_id, "one")
+        self.assertEqual(matches[0].score, 1.0)
+
+        # Phonetic matches
+        matches = index.match("rupert smyth", min_score=0.8)
+        self.assertEqual([m.entry.name for m in matches], ["Robert Smith"])
+        self.assertTrue(matches[0].phonetic)
+        self.assertFalse(index.match("MOM")[0].phonetic)
+
+        # Best match per handler, highest score first
+        matches = index.match("alice jones")
+        self.assertEqual([m.skill_id for m in matches], ["one", "two"])
+        self.assertEqual(matches[1].entry.name, "Alice Johnson")
+        self.assertLess(matches[1].score, 1)
+        self.assertEqual(index.match("zed"), [])
+
+    def test_update(self):
+        from skill_communication.contacts import ContactIndex
+        index = ContactIndex()
+        index.update("one", ["Mom", "Dad"])
+        index.update("one", added=["Bob"], removed=["mom"])
+        self.assertEqual(index.match("mom", min_score=0.9), [])
+        self.assertEqual(len(index.match("bob")), 1)
+        # Snapshots replace all contacts
+        index.update("one", contacts=["Carol"])
+        self.assertEqual(index.match("dad", min_score=0.9), [])
+        self.assertEqual(index.match("bob", min_score=0.9), [])
+        index.remove_handler("one")
+        self.assertEqual(index.match("carol"), [])
+        self.assertEqual(index._trigrams, dict())
+        self.assertEqual(index._phonetic, dict())
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_circuit_breaker(self):
+        from skill_communication.circuit import CircuitBreaker
+        circuits = CircuitBreaker(threshold=2, cooldown=60)
+        self.assertFalse(circuits.strike("skill"))
+        circuits.success("skill")
+        self.assertFalse(circuits.strike("skill"))
+        self.assertTrue(circuits.strike("skill"))
+        self.assertEqual(circuits.get_state("skill"), "open")
+        # Answers during the cool-down do not close the breaker
+        circuits.success("skill")
+        self.assertTrue(circuits.is_open("skill"))
+        self.assertFalse(circuits.strike("skill"))
+
+        # After the cool-down, one strike re-opens the breaker
+        circuits._opened["skill"] -= 60
+        self.assertEqual(circuits.get_state("skill"), "half_open")
+        self.assertTrue(circuits.strike("skill"))
+        circuits._opened["skill"] -= 60
+        circuits.success("skill")
+        self.assertEqual(circuits.get_state("skill"), "closed")
+        self.assertEqual(circuits.snapshot(), dict())
+
+
+class TestSessionStore(unittest.TestCase):
+    def _test_store(self, store):
+        session = Mock(query_id="query", query_type="call")
+        self.assertFalse(store.add_reply("query", {"skill_id": "a"}))
+        store.add(session, "node")
+        self.assertTrue(store.add_reply("query", {"skill_id": "a"}))
+        self.assertTrue(store.add_reply("query", {"skill_id": "b",
+                                                  "conf": 0.5}))
+        self.assertEqual(store.get_replies("query"),
+                         [{"skill_id": "a"}, {"skill_id": "b", "conf": 0.5}])
+        self.assertTrue(store.claim("query", "node"))
+        self.assertFalse(store.claim("query", "other"))
+        self.assertFalse(store.add_reply("query", {"skill_id": "c"}))
+        store.remove("query")
+        self.assertEqual(store.get_replies("query"), list())
+        self.assertFalse(store.claim("query", "node"))
+
+        store.add(session, "node")
+        store.add_reply("query", {"skill_id": "a"})
+        self.assertEqual(store.prune(60), 0)
+        self.assertEqual(store.prune(-1), 1)
+        self.assertEqual(store.get_replies("query"), list())
+        store.close()
+
+    def test_memory_store(self):
+        from skill_communication.store import create_session_store
+        self._test_store(create_session_store("memory"))
+
+    def test_sqlite_store(self):
+        from os.path import join
+        from tempfile import TemporaryDirectory
+        from skill_communication.store import create_session_store
+        with TemporaryDirectory() as tmp_dir:
+            self._test_store(create_session_store(
+                "sqlite", join(tmp_dir, "sessions.db")))
+        with self.assertRaises(ValueError):
+            create_session_store("redis")
+
+
+class TestDeferredDelivery(unittest.TestCase):
+    def test_extract_delivery_time(self):
+        from datetime import datetime, timezone
+        import lingua_franca
+        from skill_communication.deferred import extract_delivery_time
+        lingua_franca.load_language("en")
+        now = datetime(2026, 1, 1, 12, tzinfo=timezone.utc)
+        deliver_at, request = extract_delivery_time(
+            "send bob a message at 5 pm saying see you tomorrow", "en", now)
+        self.assertEqual(deliver_at, datetime(2026, 1, 1, 17,
+                                              tzinfo=timezone.utc))
+        self.assertEqual(request,
+                         "send bob a message saying see you tomorrow")
+        deliver_at, request = extract_delivery_time(
+            "Message Bob tomorrow in 2 hours: Hi", "en", now)
+        self.assertEqual(deliver_at, datetime(2026, 1, 2, 14,
+                                              tzinfo=timezone.utc))
+        self.assertEqual(request, "Message Bob: Hi")
+        deliver_at, request = extract_delivery_time(
+            "message Bob at 11:30 am saying hi", "en",
+            datetime(2026, 1, 1, 9, tzinfo=timezone.utc))
+        self.assertEqual(deliver_at, datetime(2026, 1, 1, 11, 30,
+                                              tzinfo=timezone.utc))
+        self.assertEqual(request, "message Bob saying hi")
+        # Contacts named like a month are not delivery times
+        request = "send a message to May saying hi"
+        self.assertEqual(extract_delivery_time(request, "en", now),
+                         (None, request))
+        # Neither are dates without a time
+        request = "message Bob tomorrow saying hi"
+        self.assertEqual(extract_delivery_time(request, "en", now),
+                         (None, request))
+        # Times in the message body are not delivery times
+        request = "send bob a message saying see you at 5 pm"
+        self.assertEqual(extract_delivery_time(request, "en", now),
+                         (None, request))
+        self.assertEqual(extract_delivery_time("message bob", "en", now),
+                         (None, "message bob"))
+
+    def test_timer_wheel(self):
+        import random
+        from skill_communication.deferred import TimerWheel
+        rand = random.Random(0)
+        wheel = TimerWheel(1000, slots=(10, 10, 10))
+        deadlines = {i: 1000 + rand.uniform(0.5, 3000) for i in range(500)}
+        for i, deadline in deadlines.items():
+            self.assertTrue(wheel.add(deadline, i))
+        self.assertFalse(wheel.add(999, "past"))
+        fired = list()
+        now = 1000
+        while now < 4100:
+            now += rand.uniform(0.5, 30)
+            for i in wheel.advance(now):
+                # Timers expire within one advance of their deadline
+                self.assertLessEqual(deadlines[i], now)
+                self.assertGreater(deadlines[i], now - 31)
+                fired.append(i)
+        self.assertEqual(sorted(fired), list(deadlines))
+
+    def test_deferred_queue(self):
+        import json
+        from os.path import join
+        from tempfile import TemporaryDirectory
+        from time import time
+        from skill_communication.deferred import DeferredQueue
+        with TemporaryDirectory() as tmp_dir:
+            path = join(tmp_dir, "deferred.jsonl")
+            queue = DeferredQueue(Mock(), path)
+            queue.start()
+            now = time()
+            for i in range(100):
+                queue.add(now + 60, Message("test.later", {"i": i}))
+            queue.add(now + 120, Message("test.latest"))
+            queue.add(now + 3600, Message("test.pending"))
+            # Messages due in the same tick are returned together
+            due = queue.advance(now + 61)
+            self.assertEqual(sorted(m.data["i"] for m in due),
+                             list(range(100)))
+            self.assertEqual(len(queue), 2)
+            queue.shutdown()
+
+            # Pending messages are reloaded; overdue ones are due next tick
+            delivered = Event()
+            messages = list()
+
+            def _on_due(due_messages):
+                messages.extend(due_messages)
+                delivered.set()
+            with open(path, "a") as f:
+                f.write(json.dumps({"op": "add", "id": "overdue",
+                                    "at": now - 10,
+                                    "msg": Message("test.overdue")
+                                   .serialize()}) + "\n")
+            queue = DeferredQueue(_on_due, path, tick=0.1)
+            queue.start()
+            with open(path) as f:
+                self.assertEqual(len(f.readlines()), 3)
+            self.assertTrue(delivered.wait(2))
+            self.assertEqual(len(queue), 2)
+            queue.shutdown()
+        self.assertEqual([m.msg_type for m in messages], ["test.overdue"])
+
+
+class TestHandlerPriors(unittest.TestCase):
+    def test_rank(self):
+        from skill_communication.priors import HandlerPriors
+        priors = HandlerPriors()
+        replies = [{"skill_id": "a", "conf": 0.8},
+                   {"skill_id": "b", "conf": 0.8},
+                   {"skill_id": "c", "conf": 0.7}]
+        self.assertEqual(priors.rank("user", "call", "Mom", replies), replies)
+
+        priors.record("user", "call", "Mom", "b", True)
+        priors.record("user", "call", "Dad", "a", True)
+        priors.record("user", "call", "Dad", "a", True)
+        ranked = priors.rank("user", "call", "mom", replies)
+        self.assertEqual([r["skill_id"] for r in ranked], ["b", "a", "c"])
+        # New contacts fall back to the user's history
+        ranked = priors.rank("user", "call", "Bob", replies)
+        self.assertEqual([r["skill_id"] for r in ranked], ["a", "b", "c"])
+        # Other users are unaffected
+        self.assertEqual(priors.rank("other", "call", "mom", replies),
+                         replies)
+
+        # Weighted priors may outrank a higher confidence
+        for _ in range(5):
+            priors.record("user", "call", "Mom", "c", True)
+            priors.record("user", "call", "Mom", "b", False)
+        priors.weight = 0.5
+        ranked = priors.rank("user", "call", "mom", replies)
+        self.assertEqual([r["skill_id"] for r in ranked], ["c", "a", "b"])
+
+    def test_save_load(self):
+        from os.path import isfile, join
+        from tempfile import TemporaryDirectory
+        from skill_communication.priors import HandlerPriors
+        with TemporaryDirectory() as tmp_dir:
+            path = join(tmp_dir, "priors.json")
+            priors = HandlerPriors(path)
+            priors.save()
+            self.assertFalse(isfile(path))
+            priors.record("user", "call", "Mom", "a", True)
+            priors.save()
+            self.assertTrue(isfile(path))
+
+            loaded = HandlerPriors(path, max_entries=1)
+            self.assertIsNone(loaded._entries)
+            self.assertEqual(loaded.get_scores("user", "call", "mom"),
+                             {"a": 2 / 3})
+            loaded.record("user", "call", "Dad", "b", False)
+            self.assertEqual(len(loaded._entries), 1)
+
+
+class TestResolutionCache(unittest.TestCase):
+    def test_normalize_contact(self):
+        from skill_communication.cache import normalize_contact
+        self.assertEqual(normalize_contact("  Mom's   Cell! "), "moms cell")
+        self.assertEqual(normalize_contact(None), "")
+
+    def test_lru_ttl(self):
+        from skill_communication.cache import ResolutionCache
+        cache = ResolutionCache(max_size=2, ttl=60)
+        cache.put("user", "call", "a", "skill", None)
+        cache.put("user", "call", "b", "skill", None)
+        self.assertIsNotNone(cache.get("user", "call", "a"))
+        cache.put("user", "call", "c", "skill", None)
+        # Least recently used entry is evicted
+        self.assertIsNone(cache.get("user", "call", "b"))
+        self.assertIsNotNone(cache.get("user", "call", "a"))
+
+        cache.ttl = -1
+        cache.put("user", "call", "d", "skill", None)
+        self.assertIsNone(cache.get("user", "call", "d"))
+
+    def test_invalidate(self):
+        from skill_communication.cache import ResolutionCache
+        cache = ResolutionCache()
+        cache.put("user", "call", "a", "one", None)
+        cache.put("user", "call", "b", "two", None)
+        cache.put("user", "message", "c", "two", None)
+        self.assertFalse(cache.invalidate("user", "call", "a", "two"))
+        self.assertTrue(cache.invalidate("user", "call", "a", "one"))
+        cache.invalidate_query_types(["message"])
+        self.assertEqual(len(cache), 1)
+        cache.invalidate_skill("two")
+        self.assertEqual(len(cache), 0)
+
+
+class TestHandlerRegistry(unittest.TestCase):
+    def test_get_contact_type(self):
+        from skill_communication.registry import get_contact_type
+        self.assertEqual(get_contact_type("+1 (555) 123-4567"), "number")
+        self.assertEqual(get_contact_type("mom"), "name")
+        self.assertIsNone(get_contact_type(None))
+
+    def test_eligible(self):
+        from skill_communication.registry import HandlerRegistry
+        registry = HandlerRegistry()
+        registry.register({"skill_id": "phone", "query_types": ["call"],
+                           "contact_types": ["number"]})
+        registry.register({"skill_id": "chat",
+                           "query_types": ["call", "message"],
+                           "langs": ["en-us"]})
+        self.assertEqual(registry.eligible("call", "en-us", "number"),
+                         {"phone", "chat"})
+        self.assertEqual(registry.eligible("call", "en-us", "name"), {"chat"})
+        self.assertEqual(registry.eligible("call", "fr-fr", "number"),
+                         {"phone"})
+        self.assertEqual(registry.eligible("message"), {"chat"})
+        self.assertIsNone(registry.register({"query_types": ["call"]}))
+
+    def test_expiry(self):
+        from skill_communication.registry import HandlerRegistry
+        registry = HandlerRegistry()
+        registration = registry.register({"skill_id": "phone",
+                                          "query_types": ["call"],
+                                          "ttl": 10})
+        self.assertEqual(registry.registered("call"), {"phone"})
+        registration.last_seen -= 11
+        self.assertEqual(registry.registered("call"), set())
+        self.assertIsNone(registry.get("phone"))
+        self.assertEqual(registry.prune(), {"phone"})
+        self.assertFalse(registry.deregister("phone"))
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_submit(self):
+        from threading import current_thread
+        from skill_communication.workers import WorkerPool
+        pool = WorkerPool(workers=1, max_queue=2)
+        threads = list()
+        release = Event()
+
+        def _work(name):
+            release.wait(2)
+            threads.append((name, current_thread().name))
+
+        # Items run inline until the pool starts
+        release.set()
+        pool.submit(_work, "inline")
+        self.assertEqual(threads, [("inline", current_thread().name)])
+
+        release.clear()
+        pool.start()
+        try:
+            pool.submit(_work, "busy")
+            sleep(0.1)
+            pool.submit(_work, "queued")
+            pool.submit(_work, "urgent", priority=0)
+            self.assertEqual(pool.depth, 2)
+            # A full queue makes the caller wait for space
+            Thread(target=lambda: (sleep(0.1), release.set())).start()
+            pool.submit(_work, "overflow")
+        finally:
+            pool.shutdown()
+        # Failures are logged, not raised to the caller
+        pool.submit(_work, "failed", "extra arg")
+        self.assertEqual([name for name, _ in threads],
+                         ["inline", "busy", "urgent", "queued", "overflow"])
+        self.assertEqual(threads[1][1], "CommunicationWorker-0")
+        self.assertEqual(pool.snapshot(), {"workers": 0, "depth": 0,
+                                           "max_depth": 2, "max_queue": 2,
+                                           "overflows": 1})
+
+    def test_key_order(self):
+        from threading import current_thread
+        from skill_communication.workers import WorkerPool
+        pool = WorkerPool(workers=4)
+        handled = list()
+        pool.start()
+        try:
+            for i in range(50):
+                for query_id in ("a", "b", "c"):
+                    pool.submit(lambda q, n: handled.append(
+                        (q, n, current_thread().name)), query_id, i,
+                        key=query_id)
+        finally:
+            pool.shutdown()
+        # Items with the same key run on one worker in submission order
+        for query_id in ("a", "b", "c"):
+            items = [(n, thread) for q, n, thread in handled
+                     if q == query_id]
+            self.assertEqual([n for n, _ in items], list(range(50)))
+            self.assertEqual(len({thread for _, thread in items}), 1)
 
 
 if __name__ == '__main__':
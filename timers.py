@@ -0,0 +1,207 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+
+from itertools import count
+from queue import PriorityQueue
+from threading import Event, Thread
+from typing import Callable, Dict, List, Optional
+
+from ovos_utils.log import LOG
+
+from .session import QuerySession
+
+
+class _PendingTimeout:
+    """
+    Deadline for a session and the future used to wake its waiter when the
+    deadline changes or the timeout is cancelled.
+    """
+    def __init__(self, deadline: float, future: asyncio.Future,
+                 priority: int):
+        self.deadline = deadline
+        self.future = future
+        self.priority = priority
+        self.cancelled = False
+
+
+class AsyncioTimers:
+    """
+    Session timeouts backed by one asyncio event loop running in a dedicated
+    thread, as an alternative to the skill's event scheduler. Each pending
+    session waits on a future with `asyncio.wait_for`; re-arming or
+    cancelling a timeout resolves that future instead of round-tripping
+    through the scheduler. Expired timeouts are handled by worker threads in
+    order of session priority, so urgent sessions are resolved ahead of any
+    backlog of less urgent ones.
+    """
+    def __init__(self, on_timeout: Callable[[str], None],
+                 max_workers: int = 4):
+        """
+        @param on_timeout: callback with the `query_id` of a timed out session
+        @param max_workers: threads used to run timeout callbacks
+        """
+        self._on_timeout = on_timeout
+        self._pending: Dict[str, _PendingTimeout] = dict()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[Thread] = None
+        self._max_workers = max_workers
+        self._workers: List[Thread] = list()
+        self._expired = PriorityQueue()
+        self._sequence = count()
+        self._started = Event()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        """
+        Start the event loop thread.
+        """
+        if self._thread:
+            return
+        self._thread = Thread(target=self._run, daemon=True,
+                              name="QueryTimeoutLoop")
+        self._thread.start()
+        self._started.wait()
+        for i in range(self._max_workers):
+            worker = Thread(target=self._work, daemon=True,
+                            name=f"QueryTimeout-{i}")
+            worker.start()
+            self._workers.append(worker)
+
+    def shutdown(self):
+        """
+        Stop the event loop thread. Pending timeouts are discarded, and
+        timeouts scheduled afterwards are ignored.
+        """
+        loop, self._loop = self._loop, None
+        if not loop:
+            return
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(5)
+        self._pending.clear()
+        self._started.clear()
+        for _ in self._workers:
+            # Stop workers ahead of any expired timeouts
+            self._expired.put((-1, next(self._sequence), None))
+        self._workers = list()
+        self._thread = None
+
+    def schedule(self, session: QuerySession, timeout: float):
+        """
+        Schedule (or re-arm) a session timeout.
+        @param session: QuerySession to time out
+        @param timeout: seconds until the session times out
+        """
+        self._call(self._arm, session.query_id, timeout, session.priority)
+
+    def cancel(self, session: QuerySession):
+        """
+        Cancel a pending session timeout.
+        @param session: QuerySession to cancel the timeout for
+        """
+        self._call(self._disarm, session.query_id)
+
+    def _call(self, callback: Callable, *args):
+        """
+        Run a callback on the event loop thread, if it is running.
+        """
+        loop = self._loop
+        if not loop:
+            LOG.debug(f"Timers are shut down; ignoring {callback.__name__}")
+            return
+        try:
+            loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # The loop was closed by a concurrent `shutdown`
+            LOG.debug(f"Timers are shut down; ignoring {callback.__name__}")
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        loop.call_soon(self._started.set)
+        try:
+            loop.run_forever()
+        finally:
+            # Discard pending timeouts without leaving their tasks pending
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+
+    def _arm(self, query_id: str, timeout: float, priority: int):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        pending = self._pending.get(query_id)
+        if pending:
+            # Wake the waiter so it picks up the new deadline
+            pending.deadline = deadline
+            previous = pending.future
+            pending.future = loop.create_future()
+            previous.set_result(None)
+        else:
+            pending = _PendingTimeout(deadline, loop.create_future(),
+                                      priority)
+            self._pending[query_id] = pending
+            loop.create_task(self._wait(query_id, pending))
+
+    def _disarm(self, query_id: str):
+        pending = self._pending.pop(query_id, None)
+        if pending:
+            pending.cancelled = True
+            pending.future.set_result(None)
+
+    async def _wait(self, query_id: str, pending: _PendingTimeout):
+        loop = asyncio.get_running_loop()
+        while not pending.cancelled:
+            remaining = max(pending.deadline - loop.time(), 0)
+            try:
+                await asyncio.wait_for(pending.future, remaining)
+            except asyncio.TimeoutError:
+                if pending.cancelled:
+                    return
+                self._pending.pop(query_id, None)
+                self._expired.put((pending.priority, next(self._sequence),
+                                   query_id))
+                return
+
+    def _work(self):
+        while True:
+            _, _, query_id = self._expired.get()
+            if query_id is None:
+                return
+            try:
+                self._on_timeout(query_id)
+            except Exception as e:
+                LOG.exception(f"Timeout handler failed for {query_id}: {e}")
@@ -0,0 +1,146 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2025 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from itertools import count
+from queue import Full, PriorityQueue
+from threading import Lock, Thread
+from typing import Callable, List, Optional
+
+from ovos_utils.log import LOG
+
+
+class WorkerPool:
+    """
+    Bounded queues of work items run by a fixed set of worker threads, so bus
+    and scheduler callbacks only enqueue an item and return. Each worker has
+    its own queue and items with the same key always go to the same worker,
+    so items for one session run in the order they were submitted. Queued
+    items run in order of priority, then submission. When a worker's queue
+    is full the caller waits for space; while the pool is not running, items
+    run on the calling thread instead. Items are never dropped.
+    """
+    def __init__(self, workers: int = 4, max_queue: int = 1000):
+        """
+        @param workers: number of worker threads; 0 runs items inline
+        @param max_queue: maximum number of queued items per worker
+        """
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_depth = 0
+        self.overflows = 0
+        self._queues: List[PriorityQueue] = list()
+        self._threads: List[Thread] = list()
+        self._sequence = count()
+        self._lock = Lock()
+
+    @property
+    def running(self) -> bool:
+        return bool(self._threads)
+
+    @property
+    def depth(self) -> int:
+        """
+        Number of queued items not yet taken by a worker.
+        """
+        return sum(queue.qsize() for queue in self._queues)
+
+    def start(self):
+        """
+        Start the worker threads.
+        """
+        if self._threads:
+            return
+        self._queues = [PriorityQueue(self.max_queue)
+                        for _ in range(self.workers)]
+        for i, queue in enumerate(self._queues):
+            thread = Thread(target=self._work, args=(queue,), daemon=True,
+                            name=f"CommunicationWorker-{i}")
+            thread.start()
+            self._threads.append(thread)
+
+    def shutdown(self):
+        """
+        Stop the worker threads after they finish queued items.
+        """
+        threads, self._threads = self._threads, list()
+        for queue in self._queues:
+            # Sorts after every queued item
+            queue.put((float("inf"), next(self._sequence), None))
+        for thread in threads:
+            thread.join(5)
+
+    def submit(self, func: Callable, *args, key: Optional[str] = None,
+               priority: int = 1):
+        """
+        Run a function on a worker thread.
+        @param func: function to run
+        @param args: positional arguments to pass to `func`
+        @param key: items with the same key run on the same worker, in order
+            (i.e. a `query_id`)
+        @param priority: items with lower values run first
+        """
+        if not self._threads:
+            self._run(func, args)
+            return
+        queue = self._queues[hash(key) % len(self._queues)]
+        item = (priority, next(self._sequence), (func, args))
+        try:
+            queue.put_nowait(item)
+        except Full:
+            with self._lock:
+                self.overflows += 1
+            # Wait rather than run inline so per-key order is kept
+            queue.put(item)
+        depth = queue.qsize()
+        if depth > self.max_depth:
+            with self._lock:
+                self.max_depth = max(self.max_depth, depth)
+
+    def snapshot(self) -> dict:
+        """
+        Get the worker count and queue depth statistics.
+        @returns: dict with `workers`, `depth`, `max_depth`, `max_queue`,
+            and `overflows`
+        """
+        return {"workers": len(self._threads), "depth": self.depth,
+                "max_depth": self.max_depth, "max_queue": self.max_queue,
+                "overflows": self.overflows}
+
+    def _work(self, queue: PriorityQueue):
+        while True:
+            _, _, item = queue.get()
+            if item is None:
+                return
+            self._run(*item)
+
+    @staticmethod
+    def _run(func: Callable, args: tuple):
+        try:
+            func(*args)
+        except Exception as e:
+            LOG.exception(f"{func.__name__} failed: {e}")